@@ -0,0 +1,184 @@
+#
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+'''Append-only archive of the hardware profiles uploaded by the hosts.
+
+Each profile is stored as a gzip member holding one JSON line at the
+end of a segment file (hw-000000.jsonl.gz, ...). The segments are
+regular multi-member gzip files readable with zcat. An index file has
+a JSON line per profile with its timestamp, sysname, serial, segment,
+offset and length so a profile is read back without scanning the
+segments.
+'''
+
+import collections
+import fcntl
+import json
+import os
+import pprint
+import time
+import zlib
+
+# start a new segment when the current one is bigger than this size
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+Record = collections.namedtuple('Record', ('timestamp', 'sysname', 'serial',
+                                           'segment', 'offset', 'length'))
+
+
+def _encode(elt):
+    'Encode unicode strings as strings else return the object.'
+    try:
+        return elt.encode('ascii', 'ignore')
+    except AttributeError:
+        return elt
+
+
+def _last_entry(index):
+    '''Return the position after the last complete line of an open index
+file and the Record of this line or None, reading only the end of the
+file.'''
+    index.seek(0, os.SEEK_END)
+    pos = index.tell()
+    data = ''
+    while True:
+        end = data.rfind('\n')
+        if end >= 0 and (pos == 0 or data.rfind('\n', 0, end) >= 0):
+            break
+        if pos == 0:
+            # no complete line
+            return 0, None
+        size = min(pos, 4096)
+        pos -= size
+        index.seek(pos)
+        data = index.read(size) + data
+    start = data.rfind('\n', 0, end) + 1
+    return pos + end + 1, Record(*map(_encode,
+                                      json.loads(data[start:end + 1])))
+
+
+class HwArchive(object):
+    '''Archive of the hardware profiles stored in directory. Appends are
+serialized with a lock on the index file so several processes can
+share an archive. Appends only read the last index entry, the index is
+loaded when the archive is queried.'''
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.index_filename = os.path.join(directory, 'index')
+        self._records = []
+        self._latest = {}
+        self._index_pos = 0
+
+    def segment_filename(self, segment):
+        'Return the filename of a segment.'
+        return os.path.join(self.directory, 'hw-%06d.jsonl.gz' % segment)
+
+    def _add(self, record):
+        'Record an index entry in memory.'
+        self._records.append(record)
+        self._latest[record.sysname] = record
+
+    def _refresh(self):
+        'Read the index entries appended since the last call.'
+        try:
+            index = open(self.index_filename)
+        except IOError:
+            return
+        with index:
+            index.seek(self._index_pos)
+            for line in iter(index.readline, ''):
+                # ignore a line being written
+                if not line.endswith('\n'):
+                    break
+                self._add(Record(*map(_encode, json.loads(line))))
+                self._index_pos += len(line)
+
+    def append(self, items, sysname, serial=None, timestamp=None):
+        '''Archive the hw items of a host and return the Record of the
+profile.'''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(json.dumps(items) + '\n') + \
+            compressor.flush()
+        with open(self.index_filename, 'a+') as index:
+            fcntl.flock(index, fcntl.LOCK_EX)
+            end, last = _last_entry(index)
+            # drop the end of an index entry being written when a
+            # previous append was interrupted
+            index.truncate(end)
+            if last:
+                segment = last.segment
+                offset = last.offset + last.length
+                if offset >= self.segment_size:
+                    segment += 1
+                    offset = 0
+            else:
+                segment = offset = 0
+            with open(self.segment_filename(segment), 'ab') as seg_file:
+                # drop the end of a profile whose index entry is missing
+                seg_file.truncate(offset)
+                seg_file.write(data)
+                seg_file.flush()
+                os.fsync(seg_file.fileno())
+            record = Record(timestamp or time.time(), sysname, serial,
+                            segment, offset, len(data))
+            index.write(json.dumps(record) + '\n')
+            index.flush()
+        return record
+
+    def records(self, sysname=None):
+        'Return the Records of all the profiles or the ones of sysname.'
+        self._refresh()
+        if sysname is None:
+            return list(self._records)
+        return [record for record in self._records
+                if record.sysname == sysname]
+
+    def read(self, record):
+        'Return the hw items of a Record.'
+        with open(self.segment_filename(record.segment), 'rb') as seg_file:
+            seg_file.seek(record.offset)
+            data = zlib.decompress(seg_file.read(record.length),
+                                   16 + zlib.MAX_WBITS)
+        return [tuple(map(_encode, item)) for item in json.loads(data)]
+
+    def latest(self, sysname):
+        'Return the Record of the last profile of sysname or None.'
+        self._refresh()
+        return self._latest.get(sysname)
+
+    def sysnames(self):
+        'Return the sysnames of the archived profiles.'
+        self._refresh()
+        return sorted(self._latest)
+
+    def export(self, hwdir, before=None):
+        '''Write the legacy .hw file of the last profile of each host
+archived before the timestamp before (all by default) in hwdir. Return
+the number of files written.'''
+        self._refresh()
+        latest = {}
+        for record in self._records:
+            if before is None or record.timestamp < before:
+                latest[record.sysname] = record
+        for sysname, record in latest.items():
+            with open(os.path.join(hwdir, sysname + '.hw'), 'w') as hw_file:
+                pprint.pprint(self.read(record), stream=hw_file)
+        return len(latest)
+
+# hwarchive.py ends here
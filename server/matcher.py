@@ -17,8 +17,14 @@
 
 '''Functions to match according to a requirement specification.'''
 
+import ast
+import collections
+import functools
+import operator
 import re
 import sys
+import threading
+import time
 try:
     import ipaddr
     _HAS_IPADDR = True
@@ -27,6 +33,33 @@ except ImportError:
 
 _FUNC_REGEXP = re.compile(r'^(.*)\((.*)\)')
 
+# Number of helper arguments kept parsed
+_CACHE_SIZE = 256
+
+
+def _memoize(func):
+    '''Decorator keeping the results of a one argument function in a
+bounded least recently used cache shared by the threads. func is called
+outside of the lock and must not depend on the order of the calls.'''
+    cache = collections.OrderedDict()
+    lock = threading.Lock()
+
+    @functools.wraps(func)
+    def wrapper(arg):
+        'Cached call.'
+        with lock:
+            if arg in cache:
+                value = cache[arg] = cache.pop(arg)
+                return value
+        value = func(arg)
+        with lock:
+            if arg not in cache and len(cache) >= _CACHE_SIZE:
+                cache.popitem(last=False)
+            cache[arg] = value
+        return value
+    wrapper.cache = cache
+    return wrapper
+
 
 def _adder(array, index, value):
     'Auxiliary function to add a value to an array.'
@@ -41,40 +74,105 @@ def _appender(array, index, value):
         array[index] = [value, ]
 
 
+# Multipliers of the units of numbers: K, M, G, T and P are powers of
+# 1000, Ki, Mi, Gi, Ti and Pi powers of 1024. A B can follow the unit.
+_UNITS = {'': 1}
+for _power, _unit in enumerate('KMGTP'):
+    _UNITS[_unit] = 1000 ** (_power + 1)
+    _UNITS[_unit + 'i'] = 1024 ** (_power + 1)
+
+_NUMBER_REGEXP = re.compile(
+    r'^\s*([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)\s*'
+    r'((?:[KMGTP]i?)?)B?\s*$')
+
+
+def _number(value):
+    '''Return the int or float value of a hw value like 300, 300.00 or
+128M, or None if it is not a number.'''
+    if isinstance(value, (int, long, float)):
+        return value
+    try:
+        res = _NUMBER_REGEXP.search(value)
+    except TypeError:
+        return None
+    if not res:
+        return None
+    number = res.group(1)
+    try:
+        number = int(number)
+    except ValueError:
+        number = float(number)
+    if res.group(2):
+        number = number * _UNITS[res.group(2)]
+    return number
+
+
+@_memoize
+def _parse_number(right):
+    'Convert the argument string of a comparison helper.'
+    return _number(right)
+
+
+def _compare(oper, left, right):
+    '''Compare a hw value to an already converted number. Values that are
+not numbers never match.'''
+    left = _number(left)
+    if left is None or right is None:
+        return False
+    return oper(left, right)
+
+
 def _gt(left, right):
     'Helper for match_spec.'
-    return int(left) > int(right)
+    return _compare(operator.gt, left, _parse_number(right))
 
 
 def _ge(left, right):
     'Helper for match_spec.'
-    return int(left) >= int(right)
+    return _compare(operator.ge, left, _parse_number(right))
 
 
 def _lt(left, right):
     'Helper for match_spec.'
-    return int(left) < int(right)
+    return _compare(operator.lt, left, _parse_number(right))
 
 
 def _le(left, right):
     'Helper for match_spec.'
-    return int(left) <= int(right)
+    return _compare(operator.le, left, _parse_number(right))
+
+
+@_memoize
+def _ipv4_network(right):
+    'Build the network object of the argument string of network().'
+    return ipaddr.IPv4Network(right)
 
 
 def _network(left, right):
     'Helper for match_spec.'
     if _HAS_IPADDR:
-        return ipaddr.IPv4Address(left) in ipaddr.IPv4Network(right)
+        return ipaddr.IPv4Address(left) in _ipv4_network(right)
     else:
         return False
 
 
-def _in(elt, _list):
-    'Helper for match_spec.'
-    # build a list from the string or return False
+@_memoize
+def _parse_in(_list):
+    '''Build a set from the argument string of in() or return None. Only
+Python literals are accepted.'''
     try:
-        lst = eval('(' + _list + ')')
-    except Exception:
+        values = ast.literal_eval('[' + _list + ']')
+    except (SyntaxError, ValueError):
+        return None
+    try:
+        return frozenset(values)
+    except TypeError:
+        return tuple(values)
+
+
+def _in_list(elt, lst):
+    'Test if elt is part of an already parsed in() list.'
+    if lst is None:
         return False
     # cast into an int or do nothing
     try:
@@ -84,119 +182,655 @@ def _in(elt, _list):
     return elt in lst
 
 
-def match_spec(spec, lines, arr, adder=_adder):
-    'Match a line according to a spec and store variables in <var>.'
+def _in(elt, _list):
+    'Helper for match_spec.'
+    return _in_list(elt, _parse_in(_list))
+
+
+# Helpers whose argument can be parsed once when compiling specs:
+# helper name -> (argument parser, helper on the parsed argument)
+_ARG_PARSERS = {
+    '_in': (_parse_in, _in_list),
+    '_gt': (_parse_number, functools.partial(_compare, operator.gt)),
+    '_ge': (_parse_number, functools.partial(_compare, operator.ge)),
+    '_lt': (_parse_number, functools.partial(_compare, operator.lt)),
+    '_le': (_parse_number, functools.partial(_compare, operator.le)),
+    }
+
+# Helpers accepting the numbers of typed HwIndex lines
+_NUMERIC_HELPERS = ('_gt', '_ge', '_lt', '_le')
+
+
+# Kinds of compiled fields
+_LITERAL = 0
+_VAR = 1
+_FUNC = 2
+_VARFUNC = 3
+_NEVER = 4
+
+# Compiled form of a spec field. kind is one of the constants above, raw
+# is the field as written in the spec, var the variable name without
+# its leading $, test the one argument predicate built from the helper
+# function and numeric is True when test accepts numbers.
+Field = collections.namedtuple('Field', 'kind raw var test numeric')
+
+# Compiled form of a spec: the original 4-tuple, its compiled fields,
+# the positions of its literal fields and their values.
+CompiledSpec = collections.namedtuple('CompiledSpec',
+                                      'spec fields positions key')
+
+
+def _compile_helper(func):
+    '''Return a one argument predicate for a func(arg) string and whether
+it accepts numbers, None if func is not a helper call or False if it
+is an unknown helper.'''
+    if not func or func[-1] != ')':
+        return None
+    res = _FUNC_REGEXP.search(func)
+    if not res:
+        return None
+    func_name = '_' + res.group(1)
+    if func_name not in globals():
+        return False
+    helper = globals()[func_name]
+    arg = res.group(2)
+    if func_name in _ARG_PARSERS:
+        parser, helper = _ARG_PARSERS[func_name]
+        arg = parser(arg)
+    return (lambda value: helper(value, arg),
+            func_name in _NUMERIC_HELPERS)
+
+
+def compile_field(field):
+    'Compile a spec field into a Field.'
+    if not isinstance(field, basestring):
+        return Field(_LITERAL, field, None, None, False)
+    if field and field[0] == '$':
+        parts = field.split('=')
+        if len(parts) == 2:
+            helper = _compile_helper(parts[1])
+            if helper:
+                return Field(_VARFUNC, field, parts[0][1:], *helper)
+            return Field(_LITERAL, field, None, None, False)
+    helper = _compile_helper(field)
+    if helper:
+        return Field(_FUNC, field, None, *helper)
+    elif helper is False:
+        return Field(_NEVER, field, None, None, False)
+    if field and field[0] == '$':
+        return Field(_VAR, field, field[1:], None, False)
+    return Field(_LITERAL, field, None, None, False)
+
+
+def compile_spec(spec):
+    '''Compile a spec 4-tuple into a CompiledSpec. Already compiled specs
+are returned as is.'''
+    if isinstance(spec, CompiledSpec):
+        return spec
+    spec = tuple(spec)
+    fields = tuple([compile_field(field) for field in spec])
+    positions = tuple([idx for idx in range(len(fields))
+                       if fields[idx].kind == _LITERAL])
+    return CompiledSpec(spec, fields, positions,
+                        tuple([spec[idx] for idx in positions]))
+
+
+def compile_specs(specs):
+    '''Compile a list of specs to be passed to match_spec or match_all
+instead of the raw 4-tuples.'''
+    return [compile_spec(spec) for spec in specs]
+
+
+class SpecStats(object):
+    'Counters of the matching of one spec.'
+
+    def __init__(self):
+        # lines compared to the spec
+        self.comparisons = 0
+        self.helper_calls = 0
+        # lines matched by the spec
+        self.matches = 0
+        # seconds spent looking for matching lines
+        self.time = 0.0
+
+
+class MatchStats(object):
+    '''Optional instrumentation of match_spec and match_all recording a
+SpecStats per spec, the nodes explored and backtracks of the searches
+and the total time.'''
+
+    def __init__(self):
+        # spec 4-tuple -> SpecStats
+        self.specs = collections.OrderedDict()
+        self.nodes = 0
+        self.backtracks = 0
+        self.time = 0.0
+
+    def spec(self, spec):
+        'Return the SpecStats of a compiled spec.'
+        try:
+            return self.specs[spec.spec]
+        except KeyError:
+            stat = self.specs[spec.spec] = SpecStats()
+            return stat
+
+    def ranking(self):
+        '''Return the list of (spec 4-tuple, SpecStats) sorted by
+decreasing time.'''
+        return sorted(self.specs.items(), key=lambda item: -item[1].time)
+
+
+def _match_fields(fields, line, arr, check_bound, stat=None, numbers=None):
+    '''Match a line against compiled fields. Return the list of
+(index, variable) to bind or None if the line doesn't match. Helper
+calls are counted in stat if given. numbers are the already converted
+numbers of the line for the numeric helpers.'''
+    varidx = []
+    for idx, field in enumerate(fields):
+        kind = field.kind
+        if kind == _LITERAL:
+            if line[idx] != field.raw:
+                return None
+        elif kind == _NEVER:
+            return None
+        else:
+            if kind != _VAR:
+                if stat:
+                    stat.helper_calls += 1
+                if numbers and field.numeric:
+                    valid = field.test(numbers[idx])
+                else:
+                    valid = field.test(line[idx])
+                if not valid:
+                    # when the helper of a variable fails, the variable
+                    # is not set and the full string has to match
+                    if kind == _FUNC or line[idx] != field.raw:
+                        return None
+                    continue
+                if kind == _FUNC:
+                    continue
+            if check_bound and field.var in arr:
+                if arr[field.var] != line[idx]:
+                    return None
+            varidx.append((idx, field.var))
+    return varidx
+
+
+class HwIndex(object):
+    '''Hardware lines bucketed by the values of some of their fields.
+
+Matched lines are not removed but marked as consumed so they can be
+released when backtracking. When typed is True, the numbers of the
+values are converted once for the numeric helpers like gt(). The lines
+are kept as tuples to compare them with the specs, even when they are
+lists like in the JSON uploads.'''
+
+    def __init__(self, lines, typed=False):
+        self.lines = tuple([tuple(line) for line in lines])
+        self.consumed = bytearray(len(self.lines))
+        # (positions) -> {(values): [line indexes]}
+        self._buckets = {}
+        if typed:
+            self.numbers = tuple([tuple([_number(value) for value in line])
+                                  for line in self.lines])
+        else:
+            self.numbers = None
+
+    def __len__(self):
+        return len(self.lines) - self.consumed.count(bytearray([1]))
+
+    def copy(self):
+        '''Return an index sharing the lines and buckets but not the
+consumed lines.'''
+        index = HwIndex.__new__(HwIndex)
+        index.lines = self.lines
+        index.consumed = bytearray(self.consumed)
+        index._buckets = self._buckets
+        index.numbers = self.numbers
+        return index
+
+    def bucket(self, positions, key):
+        '''Return the indexes of all the lines having the values of key at
+the positions.'''
+        if not positions:
+            return range(len(self.lines))
+        try:
+            buckets = self._buckets[positions]
+        except KeyError:
+            buckets = {}
+            for idx, line in enumerate(self.lines):
+                try:
+                    values = tuple([line[pos] for pos in positions])
+                except IndexError:
+                    continue
+                try:
+                    buckets[values].append(idx)
+                except KeyError:
+                    buckets[values] = [idx]
+            self._buckets[positions] = buckets
+        return buckets.get(key, ())
+
+    def candidates(self, positions, key):
+        '''Iterate over the indexes of the lines not consumed having the
+values of key at the positions.'''
+        consumed = self.consumed
+        for idx in self.bucket(positions, key):
+            if not consumed[idx]:
+                yield idx
+
+    def consume(self, idx):
+        'Mark a line as matched.'
+        self.consumed[idx] = 1
+
+    def release(self, idx):
+        'Make a consumed line available again.'
+        self.consumed[idx] = 0
+
+    def remaining(self):
+        'Return the list of the lines not consumed.'
+        return [self.lines[idx] for idx in range(len(self.lines))
+                if not self.consumed[idx]]
+
+
+def _match_index(spec, index, arr, adder, stat=None):
+    '''Match a compiled spec against a HwIndex. Return the index of the
+matched line or None.'''
+    # match a line without variable
+    for idx in index.candidates(tuple(range(len(spec.spec))), spec.spec):
+        if stat:
+            stat.comparisons += 1
+        if index.lines[idx] == spec.spec:
+            index.consume(idx)
+            return idx
+    # match a line with a variable, a function or both
+    check_bound = (adder == _adder)
+    for idx in index.candidates(spec.positions, spec.key):
+        if stat:
+            stat.comparisons += 1
+        line = index.lines[idx]
+        varidx = _match_fields(spec.fields, line, arr, check_bound, stat,
+                               index.numbers and index.numbers[idx])
+        if varidx is not None:
+            for i, var in varidx:
+                adder(arr, var, line[i])
+            index.consume(idx)
+            return idx
+    return None
+
+
+def match_spec(spec, lines, arr, adder=_adder, stats=None):
+    '''Match a line according to a spec and store variables in <var>.
+spec can be a 4-tuple or a CompiledSpec. lines can be a list, the
+matched line is then removed from it, or a HwIndex where the matched
+line is marked as consumed. stats is an optional MatchStats.'''
+    spec = compile_spec(spec)
+    if stats:
+        start = time.time()
+        stat = stats.spec(spec)
+    else:
+        stat = None
+    res = _match_line(spec, lines, arr, adder, stat)
+    if stats:
+        stat.time += time.time() - start
+        stats.time += time.time() - start
+        if res:
+            stat.matches += 1
+    return res
+
+
+def _match_line(spec, lines, arr, adder, stat):
+    'Implementation of match_spec.'
+    if isinstance(lines, HwIndex):
+        idx = _match_index(spec, lines, arr, adder, stat)
+        if idx is None:
+            return False
+        return lines.lines[idx]
     # match a line without variable
     for idx in range(len(lines)):
-        if lines[idx] == spec:
+        if lines[idx] == spec.spec:
             res = lines[idx]
             del lines[idx]
             return res
     # match a line with a variable, a function or both
+    check_bound = (adder == _adder)
     for lidx in range(len(lines)):
+        if stat:
+            stat.comparisons += 1
         line = lines[lidx]
-        varidx = []
-        for idx in range(4):
-            # try to split the variable and function parts if we have both
-            if spec[idx][0] == '$':
-                parts = spec[idx].split('=')
-                if len(parts) == 2:
-                    var, func = parts
-                    matched = False
-                else:
-                    var = func = spec[idx]
-            else:
-                var = func = spec[idx]
-            # Match a function
-            if func[-1] == ')':
-                res = _FUNC_REGEXP.search(func)
-                if res:
-                    func_name = '_' + res.group(1)
-                    if func_name in globals():
-                        if not globals()[func_name](line[idx], res.group(2)):
-                            if var == func:
-                                break
-                        else:
-                            if var == func:
-                                continue
-                            matched = True
-                    else:
-                        if var == func:
-                            break
-            # Match a variable
-            if ((var == func) or (var != func and matched)) and var[0] == '$':
-                if adder == _adder and var[1:] in arr:
-                    if arr[var[1:]] != line[idx]:
-                        break
-                varidx.append((idx, var[1:]))
-            # Match the full string
-            elif line[idx] != spec[idx]:
-                break
-        else:
+        varidx = _match_fields(spec.fields, line, arr, check_bound, stat)
+        if varidx is not None:
             for i, var in varidx:
                 adder(arr, var, line[i])
-            res = lines[lidx]
             del lines[lidx]
-            return res
+            return line
     return False
 
 
-def match_all(lines, specs, arr, arr2, debug=False, level=0):
-    '''Match all lines according to a spec and store variables in
-<arr>. Variables starting with 2 $ like $$vda are stored in arr and
-arr2.'''
-    # Work on a copy of lines to avoid changing the real lines because
-    # match_spec removes the matched line to not match it again on next
-    # calls.
-    lines = list(lines)
-    specs = list(specs)
-    copy_arr = dict(arr)
-    points = []
-    # Prevent infinit loops
-    if level == 50:
-        return False
-    # Match lines using specs
-    while len(specs) > 0:
-        copy_specs = list(specs)
-        spec = specs.pop(0)
-        line = match_spec(spec, lines, arr)
-        # No match
-        if not line:
-            # Backtrack on the backtracking points
-            while len(points) > 0:
-                lines, specs, new_arr = points.pop()
-                if match_all(lines, specs, new_arr, arr2, debug, level+1):
-                    # Copy arr back
-                    for k in new_arr:
-                        arr[k] = new_arr[k]
-                    return True
-            if level == 0 and debug:
-                sys.stderr.write('spec: %s not matched\n' % str(spec))
-            return False
-        else:
-            # Store backtraking points when we find a new variable
-            if arr != copy_arr:
-                copy_lines = list(lines)
-                # Put the matching line at the end of the lines
-                copy_lines.append(line)
-                points.append((copy_lines, copy_specs, copy_arr))
-                copy_arr = arr
-    # Manage $$ variables
-    for key in arr:
+# Results of Search.run
+MATCHED = 'matched'
+NOT_MATCHED = 'not matched'
+BUDGET_EXCEEDED = 'budget exceeded'
+
+# Default number of nodes a search can explore before giving up
+DEFAULT_BUDGET = 100000
+
+
+class Search(object):
+    '''Backtracking search of the lines matching a list of compiled specs.
+
+The consumed lines are tracked by a single HwIndex and every matched
+spec records the line it consumed and the variables it bound in a
+trail, so backtracking only undoes the trail instead of copying the
+lines and variables. Only the specs binding new variables are choice
+points, the other ones keep their first matching line. stats is an
+optional MatchStats.'''
+
+    def __init__(self, index, specs, arr, budget=DEFAULT_BUDGET, stats=None):
+        self.index = index
+        self.specs = specs
+        self.arr = arr
+        self.budget = budget
+        self.stats = stats
+        # number of (spec, line) pairs tried
+        self.nodes = 0
+        self.backtracks = 0
+        # deepest spec without matching line
+        self.failed_spec = None
+        # list of (line index, variables bound)
+        self.trail = []
+
+    def _candidates(self, spec):
+        '''Iterate over the (line index, variables to bind) matching a spec
+with the current variables.'''
+        index = self.index
+        lines = index.lines
+        stat = self.stats and self.stats.spec(spec)
+        for idx in index.candidates(tuple(range(len(spec.spec))), spec.spec):
+            if stat:
+                stat.comparisons += 1
+            if lines[idx] == spec.spec:
+                yield idx, ()
+        for idx in index.candidates(spec.positions, spec.key):
+            line = lines[idx]
+            if line == spec.spec:
+                continue
+            if stat:
+                stat.comparisons += 1
+            varidx = _match_fields(spec.fields, line, self.arr, True, stat,
+                                   index.numbers and index.numbers[idx])
+            if varidx is not None:
+                yield idx, varidx
+
+    def _bind(self, idx, varidx):
+        '''Consume a line, bind its variables and record them in the trail.
+Return the list of newly bound variables.'''
+        line = self.index.lines[idx]
+        new_vars = []
+        for i, var in varidx:
+            if var not in self.arr:
+                new_vars.append(var)
+            self.arr[var] = line[i]
+        self.index.consume(idx)
+        self.trail.append((idx, new_vars))
+        return new_vars
+
+    def _undo(self, mark):
+        'Undo the trail down to mark.'
+        while len(self.trail) > mark:
+            idx, new_vars = self.trail.pop()
+            self.index.release(idx)
+            for var in new_vars:
+                del self.arr[var]
+
+    def run(self):
+        '''Search lines for all the specs. Return MATCHED, NOT_MATCHED or
+BUDGET_EXCEEDED. When not matched, arr and the index are restored.'''
+        if self.stats:
+            start = time.time()
+        result = self._run()
+        if self.stats:
+            self.stats.nodes += self.nodes
+            self.stats.backtracks += self.backtracks
+            self.stats.time += time.time() - start
+        return result
+
+    def _run(self):
+        'Implementation of run.'
+        specs = self.specs
+        stats = self.stats
+        # choice points: (spec position, candidates, trail mark)
+        points = []
+        pos = 0
+        candidates = None
+        deepest = -1
+        while pos < len(specs):
+            if candidates is None:
+                candidates = self._candidates(specs[pos])
+            mark = len(self.trail)
+            if stats:
+                start = time.time()
+                found = next(candidates, None)
+                stat = stats.spec(specs[pos])
+                stat.time += time.time() - start
+                if found:
+                    stat.matches += 1
+            else:
+                found = next(candidates, None)
+            if found is None:
+                if pos > deepest:
+                    deepest = pos
+                    self.failed_spec = specs[pos]
+                if not points:
+                    self._undo(0)
+                    return NOT_MATCHED
+                pos, candidates, mark = points.pop()
+                self._undo(mark)
+                self.backtracks += 1
+                continue
+            self.nodes += 1
+            if self.budget is not None and self.nodes > self.budget:
+                self._undo(0)
+                return BUDGET_EXCEEDED
+            idx, varidx = found
+            if self._bind(idx, varidx):
+                points.append((pos, candidates, mark))
+            pos += 1
+            candidates = None
+        return MATCHED
+
+
+def _spec_vars(spec):
+    'Return the set of variables of a compiled spec.'
+    return set([field.var for field in spec.fields if field.var])
+
+
+def count_candidates(index, spec):
+    '''Count the lines of a HwIndex a compiled spec can match whatever the
+values of its variables.'''
+    count = 0
+    lines = index.lines
+    numbers = index.numbers
+    for idx in index.candidates(spec.positions, spec.key):
+        if lines[idx] == spec.spec or \
+                _match_fields(spec.fields, lines[idx], {}, False, None,
+                              numbers and numbers[idx]) is not None:
+            count += 1
+    return count
+
+
+def plan_specs(index, specs):
+    '''Reorder compiled specs to bind the most selective variables first.
+Return None if a spec cannot match any line of the HwIndex.
+
+Variables are bound in the order they appear in specs but each one is
+bound by its spec having the fewest candidate lines, and the specs
+only testing already bound variables are moved right after it. The
+specs without variables keep their order.'''
+    counts = [count_candidates(index, spec) for spec in specs]
+    if 0 in counts:
+        return None
+    variables = [_spec_vars(spec) for spec in specs]
+    placed = [False] * len(specs)
+    order = []
+    bound = set()
+
+    def place(pos):
+        'Add a spec to the plan.'
+        placed[pos] = True
+        order.append(specs[pos])
+
+    for pos in range(len(specs)):
+        if placed[pos]:
+            continue
+        new_vars = variables[pos] - bound
+        if not new_vars:
+            place(pos)
+            continue
+        best = pos
+        for other in range(pos + 1, len(specs)):
+            if not placed[other] and variables[other] - bound == new_vars \
+                    and counts[other] < counts[best]:
+                best = other
+        place(best)
+        bound |= new_vars
+        for other in range(pos, len(specs)):
+            if not placed[other] and variables[other] and \
+                    variables[other] <= bound:
+                place(other)
+    return order
+
+
+def split_vars(arr, arr2):
+    '''Manage $$ variables: variables bound with 2 $ like $$vda are stored
+in arr and arr2 without the remaining $.'''
+    for key in list(arr):
         if key[0] == '$':
             nkey = key[1:]
             arr[nkey] = arr[key]
             arr2[nkey] = arr[key]
             del arr[key]
+
+
+def search_specs(index, specs, arr, arr2, budget=DEFAULT_BUDGET,
+                 plan=False, stats=None):
+    '''Search the lines of a HwIndex, consumed by the search, matching
+compiled specs and set the variables in arr and arr2 like match_all.
+Return the result of the search and the Search, which is None when plan
+is True and a spec cannot match any line.'''
+    if plan:
+        planned = plan_specs(index, specs)
+        if planned is None:
+            return NOT_MATCHED, None
+        specs = planned
+    search = Search(index, specs, arr, budget, stats)
+    result = search.run()
+    if result == MATCHED:
+        split_vars(arr, arr2)
+    return result, search
+
+
+def match_all(lines, specs, arr, arr2, debug=False, budget=DEFAULT_BUDGET,
+              plan=False, stats=None, exceeded=None):
+    '''Match all lines according to a spec and store variables in
+<arr>. Variables starting with 2 $ like $$vda are stored in arr and
+arr2. specs can be the raw 4-tuples or the result of compile_specs.
+lines can be a list or a HwIndex. The search gives up after exploring
+budget nodes (None for no limit) and calls exceeded, if given, without
+argument. When plan is True, the specs are reordered by plan_specs
+before searching. stats is an optional MatchStats.'''
+    # Work on a copy of lines to avoid changing the real lines because
+    # the search consumes the matched lines to not match them again.
+    if isinstance(lines, HwIndex):
+        index = lines.copy()
+    else:
+        index = HwIndex(lines)
+    specs = compile_specs(specs)
+    result, search = search_specs(index, specs, arr, arr2, budget, plan,
+                                  stats)
+    if result == BUDGET_EXCEEDED and exceeded:
+        exceeded()
+    if result != MATCHED:
+        if debug:
+            if search is None:
+                for spec in specs:
+                    if count_candidates(index, spec) == 0:
+                        sys.stderr.write('spec: %s not matched\n' %
+                                         str(spec.spec))
+                        break
+            elif result == BUDGET_EXCEEDED:
+                sys.stderr.write('search budget of %d nodes exceeded\n' %
+                                 budget)
+            else:
+                sys.stderr.write('spec: %s not matched\n' %
+                                 str(search.failed_spec.spec))
+        return False
     return True
 
 
+def match_roles(lines, roles, budget=DEFAULT_BUDGET, plan=False,
+                exceeded=None):
+    '''Match lines against the specs of several roles. roles is a dict or
+an iterable of (role, specs) pairs. Yield (role, arr, arr2) for each
+matching role, in order, like match_all would set arr and arr2. Take
+the first item for the first matching role or make a list for all.
+exceeded is called with the role when its search exceeds the budget.
+
+The lines are indexed once for all the roles and the number of lines
+available for the specs without variables nor helpers is shared
+between roles to skip the search when a role needs more of them.'''
+    index = HwIndex(lines, typed=True)
+    exact_counts = {}
+    if isinstance(roles, dict):
+        roles = roles.items()
+    for role, specs in roles:
+        specs = compile_specs(specs)
+        needed = {}
+        for spec in specs:
+            if spec.positions == tuple(range(len(spec.spec))) or \
+                    _NEVER in [field.kind for field in spec.fields]:
+                needed[spec.spec] = needed.get(spec.spec, 0) + 1
+        for spec, count in needed.items():
+            if spec not in exact_counts:
+                exact_counts[spec] = len([
+                    idx for idx in index.bucket(tuple(range(len(spec))), spec)
+                    if index.lines[idx] == spec])
+            if count > exact_counts[spec]:
+                break
+        else:
+            arr = {}
+            arr2 = {}
+            if exceeded:
+                role_exceeded = functools.partial(exceeded, role)
+            else:
+                role_exceeded = None
+            if match_all(index, specs, arr, arr2, budget=budget, plan=plan,
+                         exceeded=role_exceeded):
+                yield role, arr, arr2
+
+
 def match_multiple(lines, spec, arr):
-    'Use spec to find all the matching lines and gather variables.'
-    ret = False
-    lines = list(lines)
-    while match_spec(spec, lines, arr, adder=_appender):
-        ret = True
-    return ret
+    '''Use spec to find all the matching lines and gather variables.
+Return the list of matching lines, the lines equal to the spec first,
+in one pass over lines which can be a list or a HwIndex.'''
+    spec = compile_spec(spec)
+    numbers = None
+    if isinstance(lines, HwIndex):
+        indexes = list(lines.candidates(spec.positions, spec.key))
+        if lines.numbers:
+            numbers = [lines.numbers[idx] for idx in indexes]
+        lines = [lines.lines[idx] for idx in indexes]
+    exact = []
+    matched = []
+    for num, line in enumerate(lines):
+        if line == spec.spec:
+            exact.append(line)
+        else:
+            varidx = _match_fields(spec.fields, line, arr, False, None,
+                                   numbers and numbers[num])
+            if varidx is not None:
+                matched.append(line)
+                for i, var in varidx:
+                    _appender(arr, var, line[i])
+    return exact + matched
 
 # matcher.py ends here
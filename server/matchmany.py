@@ -0,0 +1,132 @@
+#
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+'''Match many .hw files against many .specs files in worker processes
+for match-many.'''
+
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+import matcher
+
+# Set in each worker process by init_worker
+_ROLES = []
+_BUDGET = matcher.DEFAULT_BUDGET
+_PLAN = False
+
+
+def role_name(filename):
+    'Return the role name of a .specs file.'
+    name = os.path.basename(filename)
+    if name.endswith('.specs'):
+        name = name[:-6]
+    return name
+
+
+def host_name(filename):
+    'Return the host name of a .hw file.'
+    name = os.path.basename(filename)
+    if name.endswith('.hw'):
+        name = name[:-3]
+    return name
+
+
+def load_roles(filenames):
+    'Return the list of (role name, specs) of .specs files.'
+    roles = []
+    for filename in filenames:
+        with open(filename, 'r') as specs_file:
+            roles.append((role_name(filename), eval(specs_file.read(-1))))
+    return roles
+
+
+def init_worker(roles, budget, plan):
+    '''Compile the specs once per worker process. roles is a list of
+(role name, specs).'''
+    global _ROLES, _BUDGET, _PLAN
+    _ROLES = [(name, matcher.compile_specs(specs)) for name, specs in roles]
+    _BUDGET = budget
+    _PLAN = plan
+
+
+def match_host(filename):
+    '''Match a .hw file against all the roles. Return the host name and
+the list of results, or the error message if the file can't be read.'''
+    host = host_name(filename)
+    try:
+        with open(filename, 'r') as hw_file:
+            hw_items = eval(hw_file.read(-1))
+    except Exception, excpt:
+        return host, str(excpt)
+    index = matcher.HwIndex(hw_items, typed=True)
+    results = []
+    for name, specs in _ROLES:
+        start = time.time()
+        arr = {}
+        result, search = matcher.search_specs(index.copy(), specs, arr, {},
+                                              _BUDGET, _PLAN)
+        results.append({'role': name,
+                        'result': result,
+                        'nodes': search.nodes if search else 0,
+                        'time': time.time() - start,
+                        'vars': arr})
+    return host, results
+
+
+def match_hosts(filenames, roles, budget=matcher.DEFAULT_BUDGET,
+                plan=False, jobs=None):
+    '''Match .hw files against roles in jobs worker processes (one per
+CPU by default). Return the list of match_host results.'''
+    pool = multiprocessing.Pool(jobs, init_worker, (roles, budget, plan))
+    try:
+        return pool.map(match_host, filenames, chunksize=8)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def output_csv(output, matrix):
+    'Write the results as CSV, one row per (host, role).'
+    writer = csv.writer(output)
+    writer.writerow(('host', 'role', 'result', 'nodes', 'time', 'vars'))
+    for host, results in matrix:
+        if isinstance(results, str):
+            writer.writerow((host, '', results, '', '', ''))
+            continue
+        for res in results:
+            writer.writerow((host, res['role'], res['result'], res['nodes'],
+                             '%.6f' % res['time'],
+                             json.dumps(res['vars'], sort_keys=True)))
+
+
+def output_json(output, matrix):
+    'Write the results as a JSON dict of host -> role -> result.'
+    data = {}
+    for host, results in matrix:
+        if isinstance(results, str):
+            data[host] = {'error': results}
+        else:
+            data[host] = dict([(res['role'],
+                                dict([(key, value)
+                                      for key, value in res.items()
+                                      if key != 'role']))
+                               for res in results])
+    json.dump(data, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+# matchmany.py ends here
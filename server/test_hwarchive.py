@@ -0,0 +1,112 @@
+#
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import hwarchive
+
+HW1 = [('system', 'product', 'name', 'test1'),
+       ('network', 'eth0', 'serial', '52:54:00:00:00:01')]
+HW2 = [('system', 'product', 'name', 'test2'),
+       ('network', 'eth0', 'serial', '52:54:00:00:00:02')]
+
+
+class TestHwArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmp_dir, 'archive')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_append(self):
+        archive = hwarchive.HwArchive(self.directory)
+        record = archive.append(HW1, 'host1', 'S1', timestamp=1)
+        archive.append(HW2, 'host2', timestamp=2)
+        archive.append(HW2, 'host1', 'S1', timestamp=3)
+        self.assertEqual(archive.read(record), HW1)
+        self.assertEqual(archive.read(archive.latest('host1')), HW2)
+        self.assertEqual(archive.latest('host3'), None)
+        self.assertEqual([rec.timestamp for rec in archive.records('host1')],
+                         [1, 3])
+        self.assertEqual(archive.sysnames(), ['host1', 'host2'])
+
+    def test_shared(self):
+        archive1 = hwarchive.HwArchive(self.directory)
+        archive2 = hwarchive.HwArchive(self.directory)
+        archive1.append(HW1, 'host1')
+        archive2.append(HW2, 'host1')
+        self.assertEqual(archive1.read(archive1.latest('host1')), HW2)
+        self.assertEqual(len(archive1.records()), 2)
+        self.assertEqual(archive2.records(), archive1.records())
+
+    def test_segments(self):
+        archive = hwarchive.HwArchive(self.directory, segment_size=1)
+        archive.append(HW1, 'host1')
+        archive.append(HW2, 'host2')
+        self.assertEqual([rec.segment for rec in archive.records()], [0, 1])
+        self.assertEqual(archive.read(archive.latest('host2')), HW2)
+        # segments are plain gzip files
+        self.assertEqual(
+            gzip.open(archive.segment_filename(0)).read().count('\n'), 1)
+
+    def test_partial_write(self):
+        archive = hwarchive.HwArchive(self.directory)
+        archive.append(HW1, 'host1')
+        # profile written without its index entry
+        with open(archive.segment_filename(0), 'ab') as seg_file:
+            seg_file.write('garbage')
+        with open(archive.index_filename, 'a') as index:
+            index.write('[1, "host')
+        archive = hwarchive.HwArchive(self.directory)
+        self.assertEqual(len(archive.records()), 1)
+        archive.append(HW2, 'host2')
+        self.assertEqual(
+            [archive.read(rec) for rec in archive.records()], [HW1, HW2])
+
+    def test_append_reads_last_entry(self):
+        archive = hwarchive.HwArchive(self.directory)
+        archive.append(HW1, 'h' * 10000)
+        record = archive.append(HW2, 'h' * 5000)
+        # entries before the last one are not parsed by appends
+        with open(archive.index_filename) as index:
+            lines = index.readlines()
+        with open(archive.index_filename, 'w') as index:
+            index.write('garbage\n' + lines[-1])
+        archive = hwarchive.HwArchive(self.directory)
+        self.assertEqual(archive.append(HW1, 'host1').offset,
+                         record.offset + record.length)
+        self.assertEqual(archive._records, [])
+
+    def test_export(self):
+        archive = hwarchive.HwArchive(self.directory)
+        archive.append(HW1, 'host1', timestamp=1)
+        archive.append(HW2, 'host1', timestamp=3)
+        archive.append(HW2, 'host2', timestamp=4)
+        self.assertEqual(archive.export(self.tmp_dir, before=4), 1)
+        self.assertEqual(
+            eval(open(os.path.join(self.tmp_dir, 'host1.hw')).read()), HW2)
+        self.assertEqual(archive.export(self.tmp_dir, before=2), 1)
+        self.assertEqual(
+            eval(open(os.path.join(self.tmp_dir, 'host1.hw')).read()), HW1)
+        self.assertEqual(archive.export(self.tmp_dir), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,10 +15,57 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
+import threading
 import unittest
 
 import matcher
 
+_TOPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+_HW_SAMPLES = [os.path.join(_TOPDIR, 'config', 'hw', name)
+               for name in os.listdir(os.path.join(_TOPDIR, 'config', 'hw'))
+               if name.endswith('.hw')] + \
+    [os.path.join(_TOPDIR, 'health', name)
+     for name in os.listdir(os.path.join(_TOPDIR, 'health'))
+     if name.endswith('.hw')]
+
+
+def _load_samples():
+    'Load the hw samples of the repository.'
+    return [eval(open(filename).read(-1)) for filename in sorted(_HW_SAMPLES)]
+
+
+def _sample_specs(lines):
+    '''Derive specs from hw lines: literal ones, ones with variables and
+ones with helpers.'''
+    specs = []
+    for num, line in enumerate(lines):
+        specs.append(line)
+        specs.append((line[0], '$var%d' % (num % 3), line[2], line[3]))
+        specs.append((line[0], '$var%d' % (num % 3), line[2], '$val'))
+        specs.append((line[0], line[1], line[2],
+                      '$val%d=in(%r, "1")' % (num % 2, line[3])))
+    return specs
+
+
+def _list_match_all(lines, specs, arr):
+    '''Reference implementation of match_all: a depth first search on
+copies of a plain list of lines. Return the variables or None.'''
+    if not specs:
+        return arr
+    probe = list(lines)
+    while True:
+        new_arr = dict(arr)
+        line = matcher.match_spec(specs[0], probe, new_arr)
+        if not line:
+            return None
+        rest = list(lines)
+        rest.remove(line)
+        res = _list_match_all(rest, specs[1:], new_arr)
+        # only the lines binding new variables are choice points
+        if res is not None or len(new_arr) == len(arr):
+            return res
+
 
 class TestMatcher(unittest.TestCase):
 
@@ -188,6 +235,23 @@ class TestMatcher(unittest.TestCase):
         self.assertTrue(matcher.match_multiple(lines, spec, arr))
         self.assertEqual(arr['disk'], ['vda', 'vdb'])
 
+    def test_multiple_lines(self):
+        spec = ('network', '$eth', 'serial', '$serial')
+        lines = [
+            ('network', 'eth0', 'serial', 'aa'),
+            ('disk', 'vda', 'size', '8'),
+            ('network', '$eth', 'serial', '$serial'),
+            ('network', 'eth1', 'serial', 'bb'),
+            ]
+        arr = {}
+        self.assertEqual(matcher.match_multiple(lines, spec, arr),
+                         [lines[2], lines[0], lines[3]])
+        self.assertEqual(arr, {'eth': ['eth0', 'eth1'],
+                               'serial': ['aa', 'bb']})
+        self.assertFalse(matcher.match_multiple(lines, ('cpu', 'logical',
+                                                        'number', '$nb'),
+                                                arr))
+
     def test_gt(self):
         specs = [('disk', '$disk', 'size', 'gt(10)')]
         lines = [
@@ -224,6 +288,32 @@ class TestMatcher(unittest.TestCase):
         self.assertTrue(matcher.match_all(lines, specs, arr, {}))
         self.assertEqual(arr['disk'], 'vda')
 
+    def test_gt_float(self):
+        self.assertTrue(matcher._gt('300.00', '299.5'))
+        self.assertFalse(matcher._gt('300.00', '300'))
+        self.assertTrue(matcher._ge('300.00', '300'))
+
+    def test_gt_units(self):
+        self.assertTrue(matcher._gt('1G', '128M'))
+        self.assertTrue(matcher._lt('1000MB', '1GiB'))
+        self.assertTrue(matcher._le('1Ki', '1024'))
+        self.assertFalse(matcher._gt('1K', '1Ki'))
+
+    def test_gt_not_number(self):
+        specs = [('disk', '$disk', 'size', 'gt(10)')]
+        lines = [
+            ('disk', 'vda', 'size', 'unknown'),
+            ('disk', 'vdb', 'size', '20'),
+            ]
+        arr = {}
+        self.assertTrue(matcher.match_all(lines, specs, arr, {}))
+        self.assertEqual(arr['disk'], 'vdb')
+        self.assertFalse(matcher._lt('20', 'ten'))
+
+    def test_parse_number_cache(self):
+        self.assertEqual(matcher._parse_number('2.5G'), 2500000000.0)
+        self.assertTrue('2.5G' in matcher._parse_number.cache)
+
     def test_network(self):
         specs = [('network', '$eth', 'ipv4', 'network(192.168.2.0/24)')]
         lines = [
@@ -253,6 +343,52 @@ class TestMatcher(unittest.TestCase):
         self.assertTrue(matcher.match_all(lines, specs, arr, {}))
         self.assertEqual(arr['disk'], 'vda')
 
+    def test_in_single(self):
+        specs = [('disk', '$disk=in("vda")', 'size', '20')]
+        lines = [
+            ('disk', 'vd', 'size', '20'),
+            ('disk', 'vda', 'size', '20'),
+            ]
+        arr = {}
+        self.assertTrue(matcher.match_all(lines, specs, arr, {}))
+        self.assertEqual(arr['disk'], 'vda')
+
+    def test_in_no_eval(self):
+        self.assertEqual(matcher._parse_in('__import__("os").getpid()'),
+                         None)
+        self.assertFalse(matcher._in('1', '__import__("os").getpid()'))
+
+    def test_in_cache(self):
+        self.assertEqual(matcher._parse_in('1, 2, "a"'),
+                         frozenset([1, 2, 'a']))
+        self.assertTrue(matcher._parse_in('1, 2, "a"') is
+                        matcher._parse_in('1, 2, "a"'))
+        for num in range(matcher._CACHE_SIZE + 10):
+            matcher._parse_in(str(num))
+        self.assertEqual(len(matcher._parse_in.cache), matcher._CACHE_SIZE)
+
+    def test_in_cache_threads(self):
+        errors = []
+
+        def parse(first):
+            'Parse helper arguments evicting each other.'
+            try:
+                for num in range(first, first + 2000):
+                    if matcher._parse_in(str(num % 300)) != \
+                            frozenset([num % 300]):
+                        errors.append(num)
+            except Exception, excpt:
+                errors.append(excpt)
+
+        threads = [threading.Thread(target=parse, args=(first,))
+                   for first in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(matcher._parse_in.cache), matcher._CACHE_SIZE)
+
     def test_in2(self):
         specs = [('disk', '$disk=in("vda", "vdb")', 'size', '20')]
         lines = [
@@ -309,5 +445,362 @@ class TestMatcher(unittest.TestCase):
         arr = {}
         self.assertFalse(matcher.match_all(lines, specs, arr, {}))
 
+    def test_compile_spec(self):
+        spec = matcher.compile_spec(('disk', '$disk', 'size', 'gt(10)'))
+        self.assertEqual(spec.spec, ('disk', '$disk', 'size', 'gt(10)'))
+        self.assertEqual([field.var for field in spec.fields],
+                         [None, 'disk', None, None])
+        self.assertTrue(spec.fields[3].test('20'))
+        self.assertFalse(spec.fields[3].test('5'))
+        self.assertTrue(matcher.compile_spec(spec) is spec)
+
+    def test_compile_unknown_func(self):
+        spec = matcher.compile_spec(('system', 'product', 'name',
+                                     'PowerEdge M520 (SKU=NotProvided)'))
+        lines = [('system', 'product', 'name',
+                  'PowerEdge M520 (SKU=NotProvided)')]
+        self.assertTrue(matcher.match_spec(spec, lines, {}))
+
+    def test_compiled_var_func_fallback(self):
+        spec = matcher.compile_spec(('disk', '$disk', 'size', '$size=gt(10)'))
+        lines = [('disk', 'vda', 'size', '5')]
+        arr = {}
+        self.assertFalse(matcher.match_spec(spec, lines, arr))
+        self.assertEqual(arr, {})
+
+    def test_compiled_match_all(self):
+        specs = matcher.compile_specs([
+            ('disk', '$disk', 'size', 'in(8, 16)'),
+            ('disk', '$disk', 'type', 'b'),
+            ])
+        lines = [
+            ('disk', 'vda', 'size', '8'),
+            ('disk', 'vda', 'type', 'a'),
+            ('disk', 'vdb', 'size', '16'),
+            ('disk', 'vdb', 'type', 'b'),
+            ]
+        arr = {}
+        self.assertTrue(matcher.match_all(lines, specs, arr, {}))
+        self.assertEqual(arr, {'disk': 'vdb'})
+        arr = {}
+        self.assertTrue(matcher.match_all(lines, specs, arr, {}))
+        self.assertEqual(arr, {'disk': 'vdb'})
+
+
+class TestHwIndex(unittest.TestCase):
+
+    lines = [
+        ('disk', 'vda', 'size', '8'),
+        ('disk', 'vda', 'type', 'a'),
+        ('disk', 'vdb', 'size', '8'),
+        ('network', 'eth0', 'serial', 'mac'),
+        ]
+
+    def test_bucket(self):
+        index = matcher.HwIndex(self.lines)
+        self.assertEqual(list(index.bucket((0, 2), ('disk', 'size'))),
+                         [0, 2])
+        self.assertEqual(list(index.bucket((0,), ('cpu',))), [])
+        self.assertEqual(list(index.bucket((), ())), [0, 1, 2, 3])
+
+    def test_consume(self):
+        index = matcher.HwIndex(self.lines)
+        self.assertEqual(matcher.match_spec(('disk', '$disk', 'size', '8'),
+                                            index, {}),
+                         ('disk', 'vda', 'size', '8'))
+        self.assertEqual(len(index), 3)
+        self.assertEqual(list(index.candidates((0, 2), ('disk', 'size'))),
+                         [2])
+        self.assertEqual(index.remaining(), self.lines[1:])
+
+    def test_copy(self):
+        index = matcher.HwIndex(self.lines)
+        copy = index.copy()
+        copy.consume(0)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(len(copy), 3)
+
+    def test_match_spec_equivalence(self):
+        for lines in _load_samples():
+            index = matcher.HwIndex(lines)
+            lst = list(lines)
+            arr_index = {}
+            arr_list = {}
+            for spec in _sample_specs(lines):
+                self.assertEqual(
+                    matcher.match_spec(spec, index, arr_index),
+                    matcher.match_spec(spec, lst, arr_list),
+                    spec)
+                self.assertEqual(arr_index, arr_list)
+            self.assertEqual(index.remaining(), lst)
+
+    def test_match_multiple_equivalence(self):
+        for lines in _load_samples():
+            for spec in _sample_specs(lines)[::5]:
+                arr_index = {}
+                arr_list = {}
+                lst = list(lines)
+                res = False
+                while matcher.match_spec(spec, lst, arr_list,
+                                         adder=matcher._appender):
+                    res = True
+                self.assertEqual(bool(matcher.match_multiple(lines, spec,
+                                                             arr_index)),
+                                 res, spec)
+                self.assertEqual(arr_index, arr_list)
+
+    def test_typed(self):
+        index = matcher.HwIndex([('disk', 'vda', 'size', '1G'),
+                                 ('disk', 'vda', 'vendor', 'ATA')],
+                                typed=True)
+        self.assertEqual(index.numbers, ((None, None, None, 1000000000),
+                                         (None, None, None, None)))
+        self.assertTrue(index.copy().numbers is index.numbers)
+        self.assertTrue(matcher.match_spec(('disk', '$disk', 'size',
+                                            'gt(128M)'),
+                                           index, {}))
+
+    def test_typed_equivalence(self):
+        for lines in _load_samples():
+            index = matcher.HwIndex(lines, typed=True)
+            for line in lines[::7]:
+                for helper in ('gt', 'ge', 'lt', 'le'):
+                    spec = (line[0], '$var', line[2],
+                            '%s(%s)' % (helper, line[3]))
+                    arr_index = {}
+                    arr_list = {}
+                    self.assertEqual(
+                        matcher.match_multiple(index, spec, arr_index),
+                        matcher.match_multiple(lines, spec, arr_list),
+                        spec)
+                    self.assertEqual(arr_index, arr_list)
+
+    def test_match_all_equivalence(self):
+        for lines in _load_samples():
+            specs = _sample_specs(lines)
+            for start in range(0, len(specs), 53):
+                for length in (1, 4, 12):
+                    sub_specs = specs[start:start + length]
+                    arr = {}
+                    expected = _list_match_all(lines, sub_specs, {})
+                    self.assertEqual(
+                        matcher.match_all(lines, sub_specs, arr, {}),
+                        expected is not None,
+                        sub_specs)
+                    if expected is None:
+                        self.assertEqual(arr, {})
+                    else:
+                        self.assertEqual(arr, expected)
+
+
+class TestSearch(unittest.TestCase):
+
+    specs = matcher.compile_specs([
+        ('disk', '$disk', 'size', '8'),
+        ('disk', '$disk', 'type', 'c'),
+        ])
+    lines = [
+        ('disk', 'vda', 'size', '8'),
+        ('disk', 'vdb', 'size', '8'),
+        ('disk', 'vdc', 'size', '8'),
+        ('disk', 'vdc', 'type', 'c'),
+        ]
+
+    def test_nodes(self):
+        arr = {}
+        search = matcher.Search(matcher.HwIndex(self.lines), self.specs, arr)
+        self.assertEqual(search.run(), matcher.MATCHED)
+        self.assertEqual(arr, {'disk': 'vdc'})
+        self.assertEqual(search.nodes, 4)
+        self.assertEqual(search.backtracks, 2)
+
+    def test_budget(self):
+        arr = {}
+        index = matcher.HwIndex(self.lines)
+        search = matcher.Search(index, self.specs, arr, budget=2)
+        self.assertEqual(search.run(), matcher.BUDGET_EXCEEDED)
+        self.assertEqual(arr, {})
+        self.assertEqual(len(index), 4)
+        self.assertFalse(matcher.match_all(self.lines, self.specs, {}, {},
+                                           budget=2))
+
+    def test_not_matched(self):
+        arr = {'disk': 'vda'}
+        index = matcher.HwIndex(self.lines)
+        search = matcher.Search(index, self.specs, arr)
+        self.assertEqual(search.run(), matcher.NOT_MATCHED)
+        self.assertEqual(search.failed_spec, self.specs[1])
+        self.assertEqual(arr, {'disk': 'vda'})
+        self.assertEqual(len(index), 4)
+
+    def test_search_specs(self):
+        arr = {}
+        arr2 = {}
+        specs = matcher.compile_specs([('disk', '$$disk', 'type', 'c')])
+        result, search = matcher.search_specs(matcher.HwIndex(self.lines),
+                                              specs, arr, arr2)
+        self.assertEqual(result, matcher.MATCHED)
+        self.assertEqual(search.nodes, 1)
+        self.assertEqual(arr, {'disk': 'vdc'})
+        self.assertEqual(arr2, {'disk': 'vdc'})
+        specs = matcher.compile_specs([('disk', '$disk', 'type', 'd')])
+        self.assertEqual(matcher.search_specs(matcher.HwIndex(self.lines),
+                                              specs, {}, {}, plan=True),
+                         (matcher.NOT_MATCHED, None))
+
+    def test_backtrack_deep(self):
+        specs = []
+        lines = []
+        for num in range(6):
+            specs.append(('network', '$eth%d' % num, 'link', 'yes'))
+            lines.append(('network', 'eth%d' % num, 'link', 'yes'))
+        specs.append(('network', '$eth0', 'ipv4', '$ip'))
+        lines.append(('network', 'eth5', 'ipv4', '10.0.0.1'))
+        arr = {}
+        self.assertTrue(matcher.match_all(lines, specs, arr, {}))
+        self.assertEqual(arr['eth0'], 'eth5')
+        self.assertEqual(arr['ip'], '10.0.0.1')
+
+    def test_stats(self):
+        stats = matcher.MatchStats()
+        specs = matcher.compile_specs(self.specs)
+        self.assertTrue(matcher.match_all(self.lines, specs, {}, {},
+                                          stats=stats))
+        self.assertEqual(stats.nodes, 4)
+        self.assertEqual(stats.backtracks, 2)
+        size = stats.specs[specs[0].spec]
+        self.assertEqual((size.comparisons, size.matches), (3, 3))
+        kind = stats.specs[specs[1].spec]
+        self.assertEqual((kind.comparisons, kind.matches), (3, 1))
+        self.assertEqual(sorted([spec for spec, _ in stats.ranking()]),
+                         sorted([spec.spec for spec in specs]))
+
+    def test_stats_helpers(self):
+        stats = matcher.MatchStats()
+        lines = list(self.lines)
+        self.assertTrue(matcher.match_spec(('disk', '$disk', 'size',
+                                            'gt(10)'),
+                                           lines, {}, stats=stats)
+                        is False)
+        stat = stats.specs[('disk', '$disk', 'size', 'gt(10)')]
+        self.assertEqual((stat.comparisons, stat.helper_calls,
+                          stat.matches), (4, 3, 0))
+
+
+class TestPlan(unittest.TestCase):
+
+    lines = [
+        ('disk', 'sda', 'size', '200'),
+        ('disk', 'sda', 'vendor', 'HITACHI'),
+        ('disk', 'sdb', 'size', '300'),
+        ('disk', 'sdb', 'vendor', 'SEAGATE'),
+        ('disk', 'sdc', 'size', '150'),
+        ('disk', 'sdc', 'vendor', 'SEAGATE'),
+        ]
+
+    def test_most_selective_first(self):
+        specs = matcher.compile_specs([
+            ('disk', '$disk', 'size', 'gt(100)'),
+            ('cpu', 'logical', 'number', '$nbcpu'),
+            ('disk', '$disk', 'vendor', 'SEAGATE'),
+            ])
+        index = matcher.HwIndex(self.lines + [('cpu', 'logical',
+                                               'number', '8')])
+        self.assertEqual(matcher.plan_specs(index, specs),
+                         [specs[2], specs[0], specs[1]])
+
+    def test_fail_fast(self):
+        specs = [
+            ('disk', '$disk', 'size', 'gt(100)'),
+            ('disk', '$disk', 'vendor', 'FUJITSU'),
+            ]
+        index = matcher.HwIndex(self.lines)
+        self.assertEqual(matcher.plan_specs(index,
+                                            matcher.compile_specs(specs)),
+                         None)
+        self.assertFalse(matcher.match_all(self.lines, specs, {}, {},
+                                           plan=True))
+
+    def test_same_results(self):
+        specs = [
+            ('disk', '$disk', 'size', 'gt(100)'),
+            ('disk', '$disk', 'vendor', 'SEAGATE'),
+            ('disk', '$disk2', 'size', '$size2'),
+            ]
+        arr = {}
+        arr_plan = {}
+        self.assertTrue(matcher.match_all(self.lines, specs, arr, {}))
+        self.assertTrue(matcher.match_all(self.lines, specs, arr_plan, {},
+                                          plan=True))
+        self.assertEqual(arr_plan, arr)
+        self.assertEqual(arr, {'disk': 'sdb', 'disk2': 'sda', 'size2': '200'})
+
+    def test_samples_equivalence(self):
+        for lines in _load_samples():
+            specs = _sample_specs(lines)
+            for start in range(0, len(specs), 29):
+                sub_specs = list(reversed(specs[start:start + 12]))
+                arr = {}
+                arr_plan = {}
+                self.assertEqual(
+                    matcher.match_all(lines, sub_specs, arr, {}),
+                    matcher.match_all(lines, sub_specs, arr_plan, {},
+                                      plan=True),
+                    sub_specs)
+                self.assertEqual(arr, arr_plan)
+
+
+class TestMatchRoles(unittest.TestCase):
+
+    lines = [
+        ('system', 'product', 'vendor', 'HP'),
+        ('disk', 'sda', 'size', '100'),
+        ('disk', 'sdb', 'size', '200'),
+        ]
+    roles = [
+        ('dell', [('system', 'product', 'vendor', 'Dell')]),
+        ('hp-big', [('system', 'product', 'vendor', 'HP'),
+                    ('disk', '$disk', 'size', 'gt(500)')]),
+        ('hp', [('system', 'product', 'vendor', 'HP'),
+                ('disk', '$$disk', 'size', 'gt(150)')]),
+        ('any', [('disk', '$disk', 'size', '$size')]),
+        ]
+
+    def test_first(self):
+        self.assertEqual(next(matcher.match_roles(self.lines, self.roles)),
+                         ('hp', {'disk': 'sdb'}, {'disk': 'sdb'}))
+
+    def test_all(self):
+        self.assertEqual(list(matcher.match_roles(self.lines, self.roles)),
+                         [('hp', {'disk': 'sdb'}, {'disk': 'sdb'}),
+                          ('any', {'disk': 'sda', 'size': '100'}, {})])
+
+    def test_list_lines(self):
+        lines = [list(line) for line in self.lines]
+        self.assertEqual(list(matcher.match_roles(lines, self.roles)),
+                         list(matcher.match_roles(self.lines, self.roles)))
+        for role, specs in self.roles:
+            self.assertEqual(
+                [found for found, _, _ in matcher.match_roles(
+                    lines, [(role, specs)])] == [role],
+                matcher.match_all(lines, specs, {}, {}))
+
+    def test_budget_exceeded(self):
+        exceeded = []
+        self.assertEqual([role for role, _, _ in matcher.match_roles(
+            self.lines, self.roles, budget=1, exceeded=exceeded.append)],
+                         ['any'])
+        self.assertEqual(exceeded, ['hp'])
+
+    def test_dict(self):
+        self.assertEqual(list(matcher.match_roles(self.lines,
+                                                  dict(self.roles[:2]))),
+                         [])
+
+    def test_exact_count(self):
+        roles = [('twice', [('system', 'product', 'vendor', 'HP'),
+                            ('system', 'product', 'vendor', 'HP')])]
+        self.assertEqual(list(matcher.match_roles(self.lines, roles)), [])
+
 if __name__ == "__main__":
     unittest.main()
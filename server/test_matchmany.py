@@ -0,0 +1,128 @@
+#
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import csv
+import glob
+import json
+import os
+import StringIO
+import unittest
+
+import matcher
+import matchmany
+
+_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'config')
+_HW_FILES = sorted(glob.glob(os.path.join(_CONFIG, 'hw', '*.hw')))
+_SPECS_FILES = [os.path.join(_CONFIG, name + '.specs')
+                for name in ('devstack', 'vm', 'kvm-test')]
+
+
+class TestMatchMany(unittest.TestCase):
+
+    def setUp(self):
+        self.roles = matchmany.load_roles(_SPECS_FILES)
+
+    def tearDown(self):
+        matchmany.init_worker([], matcher.DEFAULT_BUDGET, False)
+
+    def test_names(self):
+        self.assertEqual(matchmany.role_name('/etc/edeploy/vm.specs'), 'vm')
+        self.assertEqual(matchmany.host_name('/var/hw/host1.hw'), 'host1')
+        self.assertEqual(matchmany.host_name('host1.json'), 'host1.json')
+        self.assertEqual([name for name, _ in self.roles],
+                         ['devstack', 'vm', 'kvm-test'])
+
+    def check_match_host(self, plan):
+        'Compare match_host with match_all on the samples.'
+        matchmany.init_worker(self.roles, matcher.DEFAULT_BUDGET, plan)
+        matched = []
+        for filename in _HW_FILES:
+            host, results = matchmany.match_host(filename)
+            self.assertEqual(host, matchmany.host_name(filename))
+            hw_items = eval(open(filename).read(-1))
+            self.assertEqual([res['role'] for res in results],
+                             [name for name, _ in self.roles])
+            for (name, specs), res in zip(self.roles, results):
+                arr = {}
+                found = matcher.match_all(hw_items, specs, arr, {})
+                self.assertEqual(res['result'] == matcher.MATCHED, found)
+                if found:
+                    self.assertEqual(res['vars'], arr)
+                    matched.append((host, name))
+        self.assertEqual(len(matched), 2)
+
+    def test_match_host(self):
+        self.check_match_host(False)
+
+    def test_match_host_plan(self):
+        self.check_match_host(True)
+
+    def test_match_host_budget(self):
+        matchmany.init_worker(self.roles, 1, False)
+        _, results = matchmany.match_host(_HW_FILES[0])
+        self.assertEqual(results[0]['result'], matcher.BUDGET_EXCEEDED)
+        self.assertEqual(results[0]['vars'], {})
+
+    def test_match_host_error(self):
+        host, results = matchmany.match_host('/nonexistent/host1.hw')
+        self.assertEqual(host, 'host1')
+        self.assertTrue('No such file' in results)
+
+    def test_match_hosts(self):
+        matrix = matchmany.match_hosts(_HW_FILES, self.roles, jobs=1)
+        matchmany.init_worker(self.roles, matcher.DEFAULT_BUDGET, False)
+        for (host, results), filename in zip(matrix, _HW_FILES):
+            self.assertEqual(
+                [(res['role'], res['result'], res['vars'])
+                 for res in results],
+                [(res['role'], res['result'], res['vars'])
+                 for res in matchmany.match_host(filename)[1]])
+
+    def matrix(self):
+        'Return results of a host and of an unreadable .hw file.'
+        return [('host1', [{'role': 'vm', 'result': matcher.MATCHED,
+                            'nodes': 3, 'time': 0.5,
+                            'vars': {'disk': 'vda'}},
+                           {'role': 'hp', 'result': matcher.NOT_MATCHED,
+                            'nodes': 0, 'time': 0.25, 'vars': {}}]),
+                ('host2', 'invalid syntax')]
+
+    def test_output_csv(self):
+        output = StringIO.StringIO()
+        matchmany.output_csv(output, self.matrix())
+        self.assertEqual(
+            list(csv.reader(StringIO.StringIO(output.getvalue()))),
+            [['host', 'role', 'result', 'nodes', 'time', 'vars'],
+             ['host1', 'vm', 'matched', '3', '0.500000',
+              '{"disk": "vda"}'],
+             ['host1', 'hp', 'not matched', '0', '0.250000', '{}'],
+             ['host2', '', 'invalid syntax', '', '', '']])
+
+    def test_output_json(self):
+        output = StringIO.StringIO()
+        matrix = self.matrix()
+        matchmany.output_json(output, matrix)
+        self.assertEqual(
+            json.loads(output.getvalue()),
+            {'host1': {'vm': {'result': 'matched', 'nodes': 3, 'time': 0.5,
+                              'vars': {'disk': 'vda'}},
+                       'hp': {'result': 'not matched', 'nodes': 0,
+                              'time': 0.25, 'vars': {}}},
+             'host2': {'error': 'invalid syntax'}})
+        self.assertEqual(matrix, self.matrix())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,11 +15,41 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import errno
+import fcntl
+import json
+import os
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
+import matcher
 import upload
 
 
+def _linear_update_cmdb(cmdb, var, pref, forced_find):
+    '''Reference implementation of update_cmdb with linear scans.'''
+    for idx, entry in enumerate(cmdb):
+        if upload.is_included(pref, entry):
+            break
+    else:
+        if forced_find:
+            return False
+        for idx, entry in enumerate(cmdb):
+            if 'used' not in entry:
+                break
+        else:
+            return False
+    cmdb[idx] = upload.claim_entry(entry, var)
+    return True
+
+
 class TestUpload(unittest.TestCase):
 
     def test_is_included_same(self):
@@ -136,6 +166,42 @@ class TestUpload(unittest.TestCase):
         result = upload.generate(model)
         self.assertEqual(result, [model])
 
+    def test_generate_lazy(self):
+        result = upload.generate({'ip': '10.0-255.0-255.1-254',
+                                  'hostname': 'host1-20000000'})
+        self.assertEqual(len(result), 256 * 256 * 254)
+        self.assertEqual(result[-1], {'ip': '10.255.255.254',
+                                      'hostname': 'host16646144'})
+        self.assertEqual(result.overrides, {})
+
+    def test_generate_equivalence(self):
+        for model in ({'ip': '10.0.1:3.5-7', 'hostname': 'n08-11'},
+                      {'ip': '10.1-0.3-1.5', 'hostname': 'n8-1'},
+                      {'hostname': 'host1-3:7-9', 'role': ('a', 'b'),
+                       'version': 'D7-H.1.0.0'}):
+            gens = dict([(key, upload._generate_values(value))
+                         for key, value in model.items()])
+            expected = []
+            try:
+                while True:
+                    expected.append(dict([(key, gen.next())
+                                          for key, gen in gens.items()]))
+            except StopIteration:
+                pass
+            self.assertEqual(list(upload.generate(model)), expected)
+
+    def test_generated_cmdb_update(self):
+        cmdb = upload.generate({'ip': '10.0.0.1-3', 'hostname': 'host1-3'})
+        var = {'mac': 'm1'}
+        self.assertTrue(upload.update_cmdb(cmdb, var, var, False))
+        self.assertTrue(upload.update_cmdb(cmdb, var, var, False))
+        self.assertEqual(cmdb.overrides.keys(), [0])
+        self.assertEqual(var, {'mac': 'm1', 'ip': '10.0.0.1',
+                               'hostname': 'host1', 'used': 1})
+        self.assertEqual(eval(repr(cmdb), {'generate': upload.generate}),
+                         cmdb)
+        self.assertEqual(cmdb[1], {'ip': '10.0.0.2', 'hostname': 'host2'})
+
     def test_update_cmdb_simple(self):
         cmdb = [{'b': 1}]
         var = {'a': 1}
@@ -174,6 +240,33 @@ class TestUpload(unittest.TestCase):
         result = upload.update_cmdb(cmdb, var, var, True)
         self.assertFalse(result, cmdb)
 
+    def test_update_cmdb_index(self):
+        rand = random.Random(1)
+        values = [1, 1.0, '1', [1], (1,), ['a', 'b']]
+        cmdb = [dict([(key, rand.choice(values))
+                      for key in 'abc' if rand.random() < .7])
+                for _ in range(50)]
+        cmdb_list = [dict(entry) for entry in cmdb]
+        index = upload.CmdbIndex(cmdb)
+        out = StringIO.StringIO()
+        for _ in range(80):
+            pref = dict([(key, rand.choice(values))
+                         for key in 'ab' if rand.random() < .6])
+            var = dict(pref, c=rand.choice(values))
+            var_list = dict(var)
+            forced = rand.random() < .3
+            self.assertEqual(
+                upload.update_cmdb(cmdb, var, pref, forced, out, index),
+                _linear_update_cmdb(cmdb_list, var_list, pref, forced))
+            self.assertEqual(cmdb, cmdb_list)
+            self.assertEqual(var, var_list)
+
+    def test_cmdb_index_cache(self):
+        cmdb = [{'a': 1}]
+        index = upload.cmdb_index('role.cmdb', cmdb)
+        self.assertTrue(upload.cmdb_index('role.cmdb', cmdb) is index)
+        self.assertFalse(upload.cmdb_index('role.cmdb', list(cmdb)) is index)
+
     def test_generate_filename_and_macs(self):
         items = [('system', 'product', 'serial', 'Sysname'),
                  ('network', 'eth0', 'serial', 'mac')]
@@ -216,5 +309,681 @@ class TestUpload(unittest.TestCase):
         self.assertTrue('serial' in result, result)
         self.assertTrue('eth' in result, result)
 
+    def test_load_specs_cache(self):
+        cfg_dir = tempfile.mkdtemp() + '/'
+        try:
+            filename = upload.specs_filename(cfg_dir, 'role')
+            with open(filename, 'w') as specs_file:
+                specs_file.write("[('disk', '$disk', 'size', '8')]")
+            specs = upload.load_specs(cfg_dir, 'role')
+            self.assertEqual([spec.spec for spec in specs],
+                             [('disk', '$disk', 'size', '8')])
+            self.assertTrue(upload.load_specs(cfg_dir, 'role') is specs)
+            with open(filename, 'w') as specs_file:
+                specs_file.write("[('disk', '$disk', 'size', '16')]")
+            os.utime(filename, (0, 0))
+            specs = upload.load_specs(cfg_dir, 'role')
+            self.assertEqual([spec.spec for spec in specs],
+                             [('disk', '$disk', 'size', '16')])
+        finally:
+            shutil.rmtree(cfg_dir)
+
+    def test_save_file_read_only_dir(self):
+        cfg_dir = tempfile.mkdtemp() + '/'
+
+        def read_only_open(name, *args):
+            'open failing to create files like in a read-only directory.'
+            if not os.path.exists(name):
+                raise IOError(errno.EACCES, 'Permission denied', name)
+            return open(name, *args)
+
+        try:
+            state_filename = cfg_dir + 'state'
+            upload.save_state(state_filename, [('role', 2)])
+            inode = os.stat(state_filename).st_ino
+            upload.open = read_only_open
+            try:
+                upload.save_state(state_filename, [('role', 1)])
+            finally:
+                del upload.open
+            self.assertEqual(os.stat(state_filename).st_ino, inode)
+            self.assertEqual(os.listdir(cfg_dir), ['state'])
+            self.assertEqual(upload._read_state(state_filename),
+                             [('role', 1)])
+            upload.save_state(state_filename, [('role', 0)])
+            self.assertNotEqual(os.stat(state_filename).st_ino, inode)
+            self.assertEqual(os.listdir(cfg_dir), ['state'])
+        finally:
+            shutil.rmtree(cfg_dir)
+
+    def test_load_state_copy(self):
+        cfg_dir = tempfile.mkdtemp() + '/'
+        try:
+            state_filename = cfg_dir + 'state'
+            with open(state_filename, 'w') as state_file:
+                state_file.write("[('role', 2)]")
+            names = upload.load_state(state_filename)
+            names[0] = ('role', 1)
+            self.assertEqual(upload.load_state(state_filename),
+                             [('role', 2)])
+            upload.save_state(state_filename, names)
+            self.assertEqual(upload.load_state(state_filename),
+                             [('role', 1)])
+        finally:
+            shutil.rmtree(cfg_dir)
+
+    def test_lock(self):
+        cfg_dir = tempfile.mkdtemp() + '/'
+        try:
+            lockfd = upload.lock(cfg_dir + 'lock')
+            otherfd = os.open(cfg_dir + 'lock', os.O_RDWR)
+            self.assertRaises(IOError, fcntl.flock, otherfd,
+                              fcntl.LOCK_EX | fcntl.LOCK_NB)
+            upload.unlock(lockfd, cfg_dir + 'lock')
+            fcntl.flock(otherfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.close(otherfd)
+        finally:
+            shutil.rmtree(cfg_dir)
+
+    def test_timed(self):
+        upload._TIMINGS.phases = {}
+        try:
+            with upload.timed('a'):
+                pass
+            self.assertEqual(list(upload.timed_iter('b', [1, 2])), [1, 2])
+            self.assertEqual(sorted(upload._TIMINGS.phases), ['a', 'b'])
+        finally:
+            del upload._TIMINGS.phases
+        # no request in progress
+        with upload.timed('a'):
+            pass
+
+    def test_application(self):
+        cfg_dir = tempfile.mkdtemp() + '/'
+        config_file = upload._CONFIG_FILE
+        try:
+            with open(cfg_dir + 'edeploy.conf', 'w') as conf:
+                conf.write('[SERVER]\nCONFIGDIR=%s\nLOCKFILE=%slock\n'
+                           % (cfg_dir, cfg_dir))
+            upload._CONFIG_FILE = cfg_dir + 'edeploy.conf'
+            with open(cfg_dir + 'state', 'w') as state_file:
+                state_file.write("[('role', 1)]")
+            with open(cfg_dir + 'role.specs', 'w') as specs_file:
+                specs_file.write("[('system', 'product', 'name', '$name')]")
+            with open(cfg_dir + 'role.configure', 'w') as cfg_file:
+                cfg_file.write("print var['name']\n")
+            body = ('--XX\r\n'
+                    'Content-Disposition: form-data; name="file"; '
+                    'filename="hw.json"\r\n\r\n'
+                    '[["system", "product", "name", "test"]]\r\n'
+                    '--XX--\r\n')
+            environ = {'REQUEST_METHOD': 'POST',
+                       'CONTENT_TYPE': 'multipart/form-data; boundary=XX',
+                       'CONTENT_LENGTH': str(len(body))}
+            status = []
+
+            def start_response(code, headers):
+                status.append((code, dict(headers)))
+
+            environ['wsgi.input'] = StringIO.StringIO(body)
+            res = ''.join(upload.application(environ, start_response))
+            self.assertTrue('#EDEPLOY_PROFILE = role' in res)
+            self.assertTrue("'name': 'test'" in res)
+            self.assertEqual(status[0][1]['Content-Length'], str(len(res)))
+            self.assertEqual(
+                upload.SqliteStorage(cfg_dir + 'edeploy.db').load_state(),
+                [('role', 0)])
+            environ['wsgi.input'] = StringIO.StringIO(body)
+            res = ''.join(upload.application(environ, start_response))
+            self.assertTrue(res.startswith('#!/bin/sh'))
+            self.assertTrue('No more role available' in res)
+            environ['wsgi.input'] = StringIO.StringIO(body)
+            environ['HTTP_ACCEPT_ENCODING'] = 'gzip'
+            res = ''.join(upload.application(environ, start_response))
+            self.assertEqual(status[-1][1]['Content-Encoding'], 'gzip')
+            self.assertTrue('No more role available' in
+                            zlib.decompress(res, 16 + zlib.MAX_WBITS))
+            # too big for LOGMAXSIZE: rejected without reading the body
+            with open(cfg_dir + 'edeploy.conf', 'a') as conf:
+                conf.write('LOGMAXSIZE=10\n')
+            environ['wsgi.input'] = StringIO.StringIO(body)
+            environ['CONTENT_LENGTH'] = str(upload._FORM_OVERHEAD + 11)
+            del environ['HTTP_ACCEPT_ENCODING']
+            res = ''.join(upload.application(environ, start_response))
+            self.assertTrue('request too big' in res)
+            self.assertEqual(environ['wsgi.input'].tell(), 0)
+        finally:
+            upload._CONFIG_FILE = config_file
+            shutil.rmtree(cfg_dir)
+
+    def test_process_hw_budget_exceeded(self):
+        cfg_dir = tempfile.mkdtemp() + '/'
+        config = {'CONFIGDIR': cfg_dir, 'HWARCHIVE': ''}
+        stderr = sys.stderr
+        try:
+            with open(cfg_dir + 'state', 'w') as state_file:
+                state_file.write("[('slow', 1), ('role', 1)]")
+            # every permutation of the disks is tried before failing
+            with open(cfg_dir + 'slow.specs', 'w') as specs_file:
+                specs_file.write(repr(
+                    [('disk', '$disk%d' % num, 'size', '10')
+                     for num in range(8)] +
+                    [('disk', '$disk0', 'size', '20')]))
+            for name in ('slow', 'role'):
+                with open(cfg_dir + name + '.configure', 'w') as cfg_file:
+                    cfg_file.write("print var\n")
+            with open(cfg_dir + 'role.specs', 'w') as specs_file:
+                specs_file.write("[('disk', '$disk', 'size', '10')]")
+            hw_file = StringIO.StringIO(json.dumps(
+                [['system', 'product', 'name', 'test']] +
+                [['disk', 'sd%s' % letter, 'size', '10']
+                 for letter in 'abcdefghij']))
+            out = StringIO.StringIO()
+            sys.stderr = StringIO.StringIO()
+            upload.process_hw(lambda section, name, default:
+                              config.get(name, default),
+                              'SERVER', hw_file, out=out)
+            self.assertTrue('#EDEPLOY_PROFILE = role' in out.getvalue())
+            self.assertTrue('Search budget of %d nodes exceeded for role '
+                            'slow' % matcher.DEFAULT_BUDGET
+                            in sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+            shutil.rmtree(cfg_dir)
+
+    def test_process_hw_read_only_config(self):
+        tmp_dir = tempfile.mkdtemp()
+        cfg_dir = tmp_dir + '/config/'
+        hw_dir = tmp_dir + '/hw/'
+        config = {'CONFIGDIR': cfg_dir, 'HWDIR': hw_dir,
+                  'USEPXEMNGR': 'True'}
+        try:
+            os.mkdir(cfg_dir)
+            os.mkdir(hw_dir)
+            with open(cfg_dir + 'state', 'w') as state_file:
+                state_file.write("[('role', 1)]")
+            with open(cfg_dir + 'role.specs', 'w') as specs_file:
+                specs_file.write("[('system', 'product', 'name', '$name')]")
+            with open(cfg_dir + 'role.configure', 'w') as cfg_file:
+                cfg_file.write("print var['name']\n")
+            with open(cfg_dir + 'role.cmdb', 'w') as cmdb_file:
+                cmdb_file.write("[{'ip': '10.0.0.1'}]")
+            content = sorted(os.listdir(cfg_dir))
+            os.chmod(cfg_dir, 0555)
+            out = StringIO.StringIO()
+            upload.process_hw(lambda section, name, default:
+                              config.get(name, default),
+                              'SERVER', StringIO.StringIO(
+                                  '[["system", "product", "name", "test"]]'),
+                              out=out)
+            self.assertTrue('#EDEPLOY_PROFILE = role' in out.getvalue())
+            self.assertTrue("'ip': '10.0.0.1'" in out.getvalue())
+            # root can write anyway
+            self.assertEqual(sorted(os.listdir(cfg_dir)), content)
+            self.assertEqual(upload.SqliteStorage(hw_dir + 'edeploy.db')
+                             .load_state(), [('role', 0)])
+            self.assertTrue(os.path.getsize(hw_dir + 'hooks.outbox') > 0)
+            # the role is kept when the hook can't be queued
+            config['OUTBOX'] = tmp_dir + '/missing/hooks.outbox'
+            storage = upload.SqliteStorage(hw_dir + 'edeploy.db')
+            storage.save_state([('role', 1)])
+            self.assertRaises(IOError, upload.process_hw,
+                              lambda section, name, default:
+                              config.get(name, default),
+                              'SERVER', StringIO.StringIO(
+                                  '[["system", "product", "name", "test"]]'),
+                              out=out)
+            self.assertEqual(storage.load_state(), [('role', 1)])
+        finally:
+            upload._HOOK_QUEUES.pop(hw_dir + 'hooks.outbox', None)
+            upload._HOOK_QUEUES.pop(config.get('OUTBOX'), None)
+            os.chmod(cfg_dir, 0755)
+            shutil.rmtree(tmp_dir)
+
+    def test_load_configure_cache(self):
+        cfg_dir = tempfile.mkdtemp() + '/'
+        try:
+            with open(cfg_dir + 'role.configure', 'w') as cfg_file:
+                cfg_file.write("print var['name']\n")
+            cfg = upload.load_configure(cfg_dir, 'role')
+            self.assertTrue(upload.load_configure(cfg_dir, 'role') is cfg)
+            res = ''.join(cfg.render({'name': 'test'}, 'http://pxe/'))
+            self.assertTrue(
+                res.startswith('#!/usr/bin/env python\n'
+                               '#EDEPLOY_PROFILE = role\n'))
+            self.assertTrue("var = {'name': 'test'}\nprint var['name']\n"
+                            in res)
+            self.assertTrue('PXEMNGR_URL=http://pxe/' in res)
+            self.assertFalse('METADATA_URL' in res)
+        finally:
+            shutil.rmtree(cfg_dir)
+
+    def test_accepts_gzip(self):
+        self.assertTrue(upload.accepts_gzip('gzip, deflate'))
+        self.assertTrue(upload.accepts_gzip('deflate, gzip;q=0.5'))
+        self.assertTrue(upload.accepts_gzip('*'))
+        self.assertFalse(upload.accepts_gzip(''))
+        self.assertFalse(upload.accepts_gzip('identity'))
+        self.assertFalse(upload.accepts_gzip('gzip;q=0'))
+
+    def test_encode_response(self):
+        body = 'x' * 40000
+        headers, chunks = upload.encode_response(body)
+        headers = dict(headers)
+        self.assertEqual(''.join(chunks), body)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(headers['Content-Length'], '40000')
+        self.assertFalse('Content-Encoding' in headers)
+        headers, chunks = upload.encode_response(body, 'gzip')
+        headers = dict(headers)
+        data = ''.join(chunks)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Content-Length'], str(len(data)))
+        self.assertEqual(zlib.decompress(data, 16 + zlib.MAX_WBITS), body)
+
+
+class LogItem(object):
+    'Uploaded file field.'
+
+    def __init__(self, filename, content):
+        self.filename = filename
+        self.file = StringIO.StringIO(content)
+
+
+class TestSaveLog(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp() + '/'
+        self.config = {'LOGDIR': self.log_dir}
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def config_get(self, section, name, default):
+        'Config getter.'
+        return self.config.get(name, default)
+
+    def save(self, content, mtime=None):
+        filename = self.log_dir + 'host.log.gz'
+        if mtime and os.path.exists(filename):
+            os.utime(filename, (mtime, mtime))
+        upload.save_log(self.config_get, 'SERVER', self.log_dir,
+                        LogItem('/tmp/host.log.gz', content),
+                        StringIO.StringIO())
+        return open(filename).read()
+
+    def test_save_log(self):
+        content = 'x' * (3 * upload._LOG_CHUNK_SIZE + 1)
+        self.assertEqual(self.save(content), content)
+        self.assertEqual(os.listdir(self.log_dir), ['host.log.gz'])
+
+    def test_rotate(self):
+        self.save('1')
+        self.save('2', 1000000000)
+        self.save('3', 1000000001)
+        self.assertEqual(upload.rotated_logs(self.log_dir + 'host.log.gz'),
+                         [self.log_dir + 'host.20010909014640.log.gz',
+                          self.log_dir + 'host.20010909014641.log.gz'])
+        self.config['LOGKEEP'] = '1'
+        self.assertEqual(self.save('4', 1000000002), '4')
+        self.assertEqual(
+            sorted(os.listdir(self.log_dir)),
+            ['host.20010909014642.log.gz', 'host.log.gz'])
+
+    def test_check_request_size(self):
+        out = StringIO.StringIO()
+        upload.check_request_size(self.config_get, '1000', out)
+        upload.check_request_size(self.config_get, None, out)
+        self.config['LOGMAXSIZE'] = '10'
+        upload.check_request_size(self.config_get,
+                                  str(upload._FORM_OVERHEAD + 10), out)
+        upload.check_request_size(self.config_get, '', out)
+        self.assertEqual(out.getvalue(), '')
+        self.assertRaises(SystemExit, upload.check_request_size,
+                          self.config_get, str(upload._FORM_OVERHEAD + 11),
+                          out)
+        self.assertTrue('request too big' in out.getvalue())
+
+    def test_max_size(self):
+        self.config['LOGMAXSIZE'] = '10'
+        self.save('0123456789')
+        self.assertRaises(SystemExit, self.save, '0123456789a')
+        self.assertEqual(os.listdir(self.log_dir), ['host.log.gz'])
+        self.assertEqual(open(self.log_dir + 'host.log.gz').read(),
+                         '0123456789')
+
+
+class TestHookQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.outbox = os.path.join(self.tmp_dir, 'outbox')
+        self.calls = []
+        self.results = []
+        upload.HOOKS['test'] = self.hook
+
+    def tearDown(self):
+        del upload.HOOKS['test']
+        shutil.rmtree(self.tmp_dir)
+
+    def hook(self, *args):
+        self.calls.append(list(args))
+        return self.results.pop(0) if self.results else True
+
+    def test_drain(self):
+        queue = upload.HookQueue(self.outbox)
+        queue.post('test', 'a', {'b': 1})
+        queue.post('test', 'c')
+        self.assertEqual(self.calls, [])
+        self.assertEqual(queue.drain(), 0)
+        self.assertEqual(self.calls, [['a', {'b': 1}], ['c']])
+        self.assertEqual(queue.drain(), 0)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_retry(self):
+        queue = upload.HookQueue(self.outbox)
+        queue.post('test', 'a')
+        self.results = [False, False]
+        self.assertEqual(queue.drain(now=1000), 1)
+        # not due yet
+        self.assertEqual(queue.drain(now=1000 + 59), 1)
+        self.assertEqual(len(self.calls), 1)
+        # the failed call is persisted
+        queue = upload.HookQueue(self.outbox)
+        self.assertEqual(queue.drain(now=1000 + 60), 1)
+        self.assertEqual(queue.drain(now=1000 + 60 + 119), 1)
+        self.assertEqual(queue.drain(now=1000 + 60 + 120), 0)
+        self.assertEqual(self.calls, [['a'], ['a'], ['a']])
+
+    def test_give_up(self):
+        queue = upload.HookQueue(self.outbox)
+        queue.post('test', 'a')
+        queue.post('unknown', 'b')
+        self.results = [False] * upload._HOOK_MAX_ATTEMPTS
+        now = 0
+        while queue.drain(now=now):
+            now += upload._HOOK_MAX_DELAY
+        self.assertEqual(len(self.calls), upload._HOOK_MAX_ATTEMPTS)
+
+    def test_drain_locked(self):
+        queue = upload.HookQueue(self.outbox)
+        queue.post('test', 'a')
+        lock_fd = upload.lock(queue.lock_filename)
+        try:
+            self.assertEqual(queue.drain(), None)
+        finally:
+            upload.unlock(lock_fd, queue.lock_filename)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(queue.drain(), 0)
+
+    def test_drain_posted(self):
+        queue = upload.HookQueue(self.outbox)
+        other = upload.HookQueue(self.outbox)
+
+        def post(*args):
+            # another request posts a call while the drain runs
+            self.calls.append(list(args))
+            other.post('test', 'b')
+            self.assertEqual(other.drain(), None)
+            return True
+        upload.HOOKS['post'] = post
+        try:
+            queue.post('post', 'a')
+            self.assertEqual(queue.drain(), 0)
+        finally:
+            del upload.HOOKS['post']
+        self.assertEqual(self.calls, [['a'], ['b']])
+
+    def test_start(self):
+        queue = upload.HookQueue(self.outbox)
+        queue.start()
+        queue.post('test', 'a')
+        for _ in range(100):
+            if self.calls:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.calls, [['a']])
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.cfg_dir = tempfile.mkdtemp() + '/'
+        with open(self.cfg_dir + 'state', 'w') as state_file:
+            state_file.write("[('all', '*'), ('role', 1)]")
+        with open(self.cfg_dir + 'role.cmdb', 'w') as cmdb_file:
+            cmdb_file.write("[{'a': 1, 'b': 1, 'used': 1}, {'a': 2}, "
+                            "{'a': 3, 'b': 'x'}]")
+
+    def tearDown(self):
+        shutil.rmtree(self.cfg_dir)
+
+    def storages(self):
+        'Return a file and a SQLite storage of the same files.'
+        return (upload.FileStorage(self.cfg_dir, self.cfg_dir + 'lock'),
+                upload.SqliteStorage(self.cfg_dir + 'edeploy.db',
+                                     self.cfg_dir))
+
+    def test_update_state(self):
+        for storage in self.storages():
+            self.assertTrue(storage.update_state('all', -1, 0))
+            self.assertFalse(storage.update_state('role', -1, 0))
+            self.assertTrue(storage.update_state('role', -1, 1))
+            self.assertFalse(storage.update_state('role', -1, 1))
+            self.assertTrue(storage.update_state('role', 1))
+            self.assertFalse(storage.update_state('other', 1))
+            self.assertEqual(storage.load_state(),
+                             [('all', '*'), ('role', 1)])
+
+    def rewrite(self, filename, old, new, in_place):
+        '''Rewrite a file like another process, keeping its size and the
+modification time set by the test.'''
+        content = open(filename).read().replace(old, new)
+        target = filename if in_place else filename + '.new'
+        with open(target, 'w') as new_file:
+            new_file.write(content)
+        os.utime(target, (1000000000, 1000000000))
+        if not in_place:
+            os.rename(target, filename)
+
+    def test_update_state_stale_cache(self):
+        storage = upload.FileStorage(self.cfg_dir, self.cfg_dir + 'lock')
+        os.utime(self.cfg_dir + 'state', (1000000000, 1000000000))
+        self.assertEqual(storage.load_state(), [('all', '*'), ('role', 1)])
+        self.rewrite(self.cfg_dir + 'state', '1', '2', True)
+        self.assertTrue(storage.update_state('role', -1, 1))
+        self.assertEqual(storage.load_state(), [('all', '*'), ('role', 1)])
+
+    def test_assign_cmdb_replaced(self):
+        storage = upload.FileStorage(self.cfg_dir, self.cfg_dir + 'lock')
+        os.utime(self.cfg_dir + 'role.cmdb', (1000000000, 1000000000))
+        self.assertEqual(storage.load_cmdb('role')[1], {'a': 2})
+        self.rewrite(self.cfg_dir + 'role.cmdb', "'a': 2", "'a': 7", False)
+        var = {'a': 7}
+        self.assertTrue(storage.assign_cmdb('role', var, var, True))
+        self.assertEqual(var, {'a': 7, 'used': 1})
+
+    def test_assign_cmdb(self):
+        out = StringIO.StringIO()
+        for storage in self.storages():
+            var = {'a': 1, 'b': 2}
+            self.assertTrue(storage.assign_cmdb('role', var, {'a': 1},
+                                                False))
+            self.assertEqual(var, {'a': 1, 'b': 2, 'used': 1})
+            var = {'b': 'x'}
+            self.assertTrue(storage.assign_cmdb('role', var, var, True))
+            self.assertEqual(var, {'a': 3, 'b': 'x', 'used': 1})
+            var = {'a': 4}
+            self.assertFalse(storage.assign_cmdb('role', var, var, True,
+                                                 out))
+            self.assertTrue(storage.assign_cmdb('role', var, var, False))
+            self.assertEqual(var, {'a': 4, 'used': 1})
+            self.assertFalse(storage.assign_cmdb('role', {'a': 5},
+                                                 {'a': 5}, False, out))
+            self.assertTrue(storage.assign_cmdb('all', {'a': 5},
+                                                {'a': 5}, False))
+            self.assertEqual(storage.load_cmdb('role'),
+                             [{'a': 1, 'b': 2, 'used': 1},
+                              {'a': 4, 'used': 1},
+                              {'a': 3, 'b': 'x', 'used': 1}])
+            self.assertEqual(storage.cmdb_roles(), ['role'])
+            self.assertEqual(storage.load_cmdb('all'), None)
+        self.assertTrue('No more entry in the CMDB' in out.getvalue())
+
+    def test_assign_cmdb_random(self):
+        rand = random.Random(42)
+        storage = upload.SqliteStorage(self.cfg_dir + 'edeploy.db')
+        for _ in range(20):
+            cmdb = [dict([(key, rand.randint(0, 2))
+                          for key in 'abc' if rand.random() < .6])
+                    for _ in range(5)]
+            for entry in cmdb:
+                if rand.random() < .3:
+                    entry['used'] = 1
+            storage.save_cmdb('role', cmdb)
+            for _ in range(3):
+                pref = dict([(key, rand.randint(0, 2))
+                             for key in 'ab' if rand.random() < .7])
+                var = dict(pref, c=rand.randint(0, 2))
+                forced = rand.random() < .3
+                var_list = dict(var)
+                out = StringIO.StringIO()
+                self.assertEqual(
+                    storage.assign_cmdb('role', var, pref, forced, out),
+                    upload.update_cmdb(cmdb, var_list, pref, forced, out))
+                self.assertEqual(var, var_list)
+                self.assertEqual(storage.load_cmdb('role'), cmdb)
+
+    def test_assign_cmdb_equality(self):
+        rand = random.Random(1)
+        values = [1, 1.0, True, '1', u'1', u'\xe9', [1], (1,), ['a', 'b'],
+                  {'a': 1, 'b': [2]}, {'b': [2.0], 'a': u'1'},
+                  {'b': [2], 'a': 1.0}]
+        cmdb = [dict([(key, rand.choice(values))
+                      for key in 'abc' if rand.random() < .7])
+                for _ in range(50)]
+        storage = upload.SqliteStorage(self.cfg_dir + 'edeploy.db')
+        storage.save_cmdb('role', cmdb)
+        for _ in range(80):
+            pref = dict([(key, rand.choice(values))
+                         for key in 'ab' if rand.random() < .6])
+            var = dict(pref, c=rand.choice(values))
+            var_list = dict(var)
+            forced = rand.random() < .3
+            self.assertEqual(
+                storage.assign_cmdb('role', var, pref, forced,
+                                    StringIO.StringIO()),
+                _linear_update_cmdb(cmdb, var_list, pref, forced))
+            self.assertEqual(storage.load_cmdb('role'), cmdb)
+            self.assertEqual(var, var_list)
+
+    def test_upgrade_value_index(self):
+        storage = upload.SqliteStorage(self.cfg_dir + 'edeploy.db',
+                                       self.cfg_dir)
+        # schema and value index of the first databases
+        storage.conn.execute("UPDATE cmdb_values SET value = '1.0' "
+                             "WHERE key = 'b' AND value = '1'")
+        storage.conn.execute('DROP TABLE cmdb_models')
+        storage.conn.execute('PRAGMA user_version = 0')
+        storage = upload.SqliteStorage(self.cfg_dir + 'edeploy.db')
+        var = {'b': 1}
+        self.assertTrue(storage.assign_cmdb('role', var, var, True))
+        self.assertEqual(var, {'a': 1, 'b': 1, 'used': 1})
+
+    def test_assign_generated_cmdb(self):
+        rand = random.Random(3)
+        storage = upload.SqliteStorage(self.cfg_dir + 'edeploy.db')
+        for _ in range(10):
+            cmdb = upload.generate({'ip': '10.0.0.1-6',
+                                    'a': ('1', '2', '1', '2', '3', '1')})
+            for idx in rand.sample(range(6), 2):
+                cmdb[idx] = dict(cmdb[idx], used=1)
+            storage.save_cmdb('role', cmdb)
+            for _ in range(8):
+                pref = dict([(key, str(rand.randint(1, 3)))
+                             for key in 'ab' if rand.random() < .6])
+                var = dict(pref, c=rand.randint(0, 2))
+                forced = rand.random() < .3
+                var_list = dict(var)
+                out = StringIO.StringIO()
+                self.assertEqual(
+                    storage.assign_cmdb('role', var, pref, forced, out),
+                    upload.update_cmdb(cmdb, var_list, pref, forced, out))
+                self.assertEqual(var, var_list)
+                self.assertEqual(storage.load_cmdb('role'), cmdb)
+
+    def test_import_generated_cmdb(self):
+        with open(self.cfg_dir + 'big.cmdb', 'w') as cmdb_file:
+            cmdb_file.write("generate({'ip': '10.0-255.0-255.1-254',\n"
+                            "          'hostname': 'host1-20000000'},\n"
+                            "         {1: {'ip': '10.0.0.2', 'used': 1}})")
+        storage = upload.SqliteStorage(self.cfg_dir + 'edeploy.db',
+                                       self.cfg_dir)
+        self.assertEqual(storage.conn.execute(
+            "SELECT COUNT(*) FROM cmdb WHERE role = 'big'").fetchone()[0], 1)
+        var = {'mac': 'm1'}
+        self.assertTrue(storage.assign_cmdb('big', var, var, False))
+        self.assertEqual(var['hostname'], 'host1')
+        var = {'mac': 'm2'}
+        self.assertTrue(storage.assign_cmdb('big', var, var, False))
+        self.assertEqual(var['ip'], '10.0.0.3')
+        var = {'hostname': 'host5'}
+        self.assertTrue(storage.assign_cmdb('big', var, var, True))
+        var = {'mac': 'm1'}
+        self.assertTrue(storage.assign_cmdb('big', var, var, True))
+        self.assertEqual(var['ip'], '10.0.0.1')
+        cmdb = storage.load_cmdb('big')
+        self.assertEqual(len(cmdb), 256 * 256 * 254)
+        self.assertEqual(sorted(cmdb.overrides), [0, 1, 2, 4])
+        self.assertEqual(cmdb[4], {'ip': '10.0.0.5', 'hostname': 'host5',
+                                   'used': 1})
+
+    def test_copy_storage(self):
+        files, database = self.storages()
+        self.assertEqual(database.load_state(), files.load_state())
+        self.assertEqual(database.load_cmdb('role'), files.load_cmdb('role'))
+        database.update_state('role', -1, 1)
+        database.assign_cmdb('role', {'a': 2}, {'a': 2}, False)
+        upload.copy_storage(database, files)
+        self.assertEqual(upload.load_state(self.cfg_dir + 'state'),
+                         [('all', '*'), ('role', 0)])
+        self.assertEqual(files.load_cmdb('role')[1], {'a': 2, 'used': 1})
+
+    def test_get_storage(self):
+        config = {'STORAGE': 'files'}
+
+        def config_get(section, name, default):
+            'Config getter.'
+            return config.get(name, default)
+
+        self.assertTrue(isinstance(upload.get_storage(config_get, 'SERVER',
+                                                      self.cfg_dir),
+                                   upload.FileStorage))
+        config['STORAGE'] = 'sqlite'
+        config['HWDIR'] = self.cfg_dir + 'hw'
+        self.assertEqual(upload.database_filename(config_get, 'SERVER',
+                                                  self.cfg_dir),
+                         self.cfg_dir + 'hw/edeploy.db')
+        config['DATADIR'] = self.cfg_dir + 'data/'
+        self.assertEqual(upload.database_filename(config_get, 'SERVER',
+                                                  self.cfg_dir),
+                         self.cfg_dir + 'data/edeploy.db')
+        # database of the previous versions
+        open(self.cfg_dir + 'edeploy.db', 'w').close()
+        storage = upload.get_storage(config_get, 'SERVER', self.cfg_dir)
+        self.assertEqual(storage.location, self.cfg_dir + 'edeploy.db')
+        self.assertTrue(upload.get_storage(config_get, 'SERVER',
+                                           self.cfg_dir) is storage)
+        others = []
+        thread = threading.Thread(
+            target=lambda: others.append(
+                upload.get_storage(config_get, 'SERVER', self.cfg_dir)))
+        thread.start()
+        thread.join()
+        self.assertFalse(others[0] is storage)
+        config['STORAGE'] = 'other'
+        self.assertRaises(ValueError, upload.get_storage, config_get,
+                          'SERVER', self.cfg_dir)
+
 if __name__ == "__main__":
     unittest.main()
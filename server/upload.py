@@ -28,24 +28,41 @@ its configuration.
 On the to be configured host, it is usually called like that:
 
 $ curl -i -F name=test -F file=@/tmp/hw.lst http://localhost/cgi-bin/upload.py
+
+It can also be run as a long-running service, as a WSGI application
+or standalone with "upload.py -s [address:]port", to keep the
+configuration, specs, CMDBs and configure scripts in memory between
+requests.
 '''
 
-import atexit
+import ast
+import bisect
 import ConfigParser
 import cgi
 import cgitb
+import collections
 import commands
+import contextlib
 from datetime import datetime
 import errno
+import fcntl
+import glob
 import json
 import os
 import pprint
 import re
 import sys
 import shutil
+import SocketServer
+import sqlite3
+import StringIO
+import threading
 import time
 import traceback
+import wsgiref.simple_server
+import zlib
 
+import hwarchive
 import matcher
 
 
@@ -113,9 +130,164 @@ defined like 10-12:15-18 or from a list of entries.'''
 STRING_TYPE = type('')
 
 
-def generate(model):
+class _LazySeq(object):
+    'Sequence of length items computed from their position by get.'
+
+    def __init__(self, length, get):
+        self.length = length
+        self.get = get
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.length:
+            raise IndexError(idx)
+        return self.get(idx)
+
+
+def _range_seq(num_range):
+    'Lazy sequence of the values of _generate_range(num_range).'
+    # (format, xrange) or (None, [value]) segments
+    segments = []
+    offsets = []
+    length = 0
+    for rang in num_range.split(':'):
+        boundaries = rang.split('-')
+        segment = (None, [num_range])
+        if len(boundaries) == 2:
+            try:
+                if boundaries[0][0] == '0':
+                    fmt = '%%0%dd' % len(boundaries[0])
+                else:
+                    fmt = '%d'
+                start = int(boundaries[0])
+                stop = int(boundaries[1]) + 1
+                if stop > start:
+                    step = 1
+                else:
+                    step = -1
+                    stop = stop - 2
+                segment = (fmt, xrange(start, stop, step))
+            except ValueError:
+                pass
+        offsets.append(length)
+        segments.append(segment)
+        length += len(segment[1])
+
+    def get(idx):
+        'Compute the value at position idx.'
+        num = bisect.bisect_right(offsets, idx) - 1
+        fmt, values = segments[num]
+        value = values[idx - offsets[num]]
+        if fmt:
+            return fmt % value
+        return value
+
+    return _LazySeq(length, get)
+
+
+def _product_seq(seqs, sep):
+    '''Lazy sequence of the sep joined values of the cartesian product of
+seqs, the last one varying the fastest.'''
+    length = 1
+    for seq in seqs:
+        length *= len(seq)
+
+    def get(idx):
+        'Compute the value at position idx.'
+        values = []
+        for seq in reversed(seqs):
+            idx, rem = divmod(idx, len(seq))
+            values.append(seq[rem])
+        return sep.join(reversed(values))
+
+    return _LazySeq(length, get)
+
+
+def _values_seq(pattern):
+    'Lazy sequence of the values of _generate_values(pattern).'
+    if isinstance(pattern, list) or isinstance(pattern, tuple):
+        return pattern
+    parts = pattern.split('.')
+    if _IPV4_RANGE_REGEXP.search(pattern) and \
+            len(parts) == 4 and (pattern.find(':') != -1 or
+                                 pattern.find('-') != -1):
+        return _product_seq([_range_seq(part) for part in parts], '.')
+    res = _RANGE_REGEXP.search(pattern)
+    if res:
+        head = res.group(1)
+        foot = res.group(res.lastindex)
+        nums = _range_seq(res.group(2))
+        return _LazySeq(len(nums), lambda idx: head + nums[idx] + foot)
+    return _LazySeq(16387064, lambda idx: pattern)
+
+
+class GeneratedCmdb(collections.Sequence):
+    '''CMDB generated from a model like generate() does. The entries are
+computed from their position and only the entries that have been
+replaced (overrides) are stored. Entries must be replaced by assignment
+as modifying the computed dicts has no effect.'''
+
+    def __init__(self, model, overrides=None):
+        self.model = model
+        self.overrides = dict(overrides or {})
+        self._columns = [(key, _values_seq(value))
+                         for key, value in model.items()]
+        self._len = min([len(seq) for _, seq in self._columns])
+
+    def __len__(self):
+        return self._len
+
+    def _position(self, idx):
+        'Check idx and return it as a positive position.'
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError(idx)
+        return idx
+
+    def __getitem__(self, idx):
+        idx = self._position(idx)
+        try:
+            return self.overrides[idx]
+        except KeyError:
+            return dict([(key, seq[idx]) for key, seq in self._columns])
+
+    def __setitem__(self, idx, entry):
+        self.overrides[self._position(idx)] = entry
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, GeneratedCmdb)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def positions(self, keys):
+        '''Return the positions of the entries that can have all the keys
+in increasing order.'''
+        if set(keys) <= set(self.model):
+            return xrange(self._len)
+        return sorted(self.overrides)
+
+    def __repr__(self):
+        'Form read back by eval() with generate() defined.'
+        args = [pprint.pformat(self.model)]
+        if self.overrides:
+            args.append(pprint.pformat(self.overrides))
+        # align the continuation lines after 'generate('
+        return 'generate(%s)' % ',\n'.join(args).replace('\n', '\n' + 9 * ' ')
+
+
+def generate(model, overrides=None):
     '''Generate a list of dict according to a model. Ipv4 ranges are
-handled by _generate_ip.'''
+handled by _generate_ip. When the model has ranges, a GeneratedCmdb
+with the overrides is returned.'''
     # Safe guard for models without ranges
     for value in model.values():
         if type(value) != STRING_TYPE:
@@ -125,45 +297,44 @@ handled by _generate_ip.'''
     else:
         return [model]
     # The model has a range starting from here
-    result = []
-    copy = {}
-    copy.update(model)
-    for key, value in copy.items():
-        copy[key] = _generate_values(value)
-    while True:
-        try:
-            entry = {}
-            for key in copy:
-                entry[key] = copy[key].next()
-            result.append(entry)
-        except StopIteration:
-            break
-    return result
+    return GeneratedCmdb(model, overrides)
 
 
 def lock(filename):
     '''Lock a file and return a file descriptor. Need to call unlock to release
 the lock.'''
-    count = 0
-    while True:
+    lock_fd = os.open(filename, os.O_CREAT | os.O_RDWR, 0644)
+    try:
+        # flock locks belong to the open file so they also exclude the
+        # other threads of the service
         try:
-            lock_fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_RDWR)
-            break
-        except OSError, xcpt:
-            if xcpt.errno != errno.EEXIST:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, xcpt:
+            if xcpt.errno not in (errno.EAGAIN, errno.EACCES):
                 raise
-            if count % 30 == 0:
-                log('waiting for lock %s' % filename)
-            time.sleep(1)
-            count += 1
+            log('waiting for lock %s' % filename)
+            with timed('lock'):
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    except:
+        os.close(lock_fd)
+        raise
     return lock_fd
 
 
 def unlock(lock_fd, filename):
-    'Called after the lock function to release a lock.'
+    '''Called after the lock function to release a lock. The file is kept
+as other processes can be waiting on it.'''
     if lock_fd:
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
         os.close(lock_fd)
-        os.unlink(filename)
+
+
+def lock_or_fail(filename, out=None):
+    'Lock a file or report a fatal error on out.'
+    try:
+        return lock(filename)
+    except Exception, excpt:
+        fatal_error("'Error on server's lock file : %s'" % str(excpt), out)
 
 
 def log(msg, prefix='eDeploy', module='upload.py'):
@@ -187,19 +358,152 @@ def is_included(dict1, dict2):
     return True
 
 
+# phase -> seconds spent in it by the request of the current thread
+_TIMINGS = threading.local()
+
+
+@contextlib.contextmanager
+def timed(phase):
+    'Add the time spent in a block to a phase of the current request.'
+    start = time.time()
+    try:
+        yield
+    finally:
+        phases = getattr(_TIMINGS, 'phases', None)
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0) + time.time() - start
+
+
+def timed_iter(phase, iterable):
+    'Iterate on iterable adding the time to get each item to a phase.'
+    iterator = iter(iterable)
+    while True:
+        with timed(phase):
+            item = next(iterator)
+        yield item
+
+
+# filename -> (file_key of the file, loaded content)
+_CACHE = {}
+
+
+def file_key(filename):
+    '''Return what identifies a version of a file: files replaced by
+save_file get a new inode, and the size also catches most in place
+rewrites done within the resolution of the modification time.'''
+    stat = os.stat(filename)
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+def load_cached(filename, loader, cached=True):
+    '''Return loader(filename) reusing the previous result as long as the
+file_key of the file doesn't change. With cached False, the file is
+always loaded, as needed under the lock of a read-modify-write.'''
+    key = file_key(filename)
+    if cached:
+        try:
+            cached_key, content = _CACHE[filename]
+            if cached_key == key:
+                return content
+        except KeyError:
+            pass
+    content = loader(filename)
+    _CACHE[filename] = (key, content)
+    return content
+
+
+def store_cached(filename, content):
+    'Record the content just written in filename.'
+    _CACHE[filename] = (file_key(filename), content)
+
+
+_CONFIG_FILE = os.environ.get('EDEPLOY_CONF', '/etc/edeploy.conf')
+
+
+def _read_config(filename):
+    'Read the configuration file.'
+    config = ConfigParser.ConfigParser()
+    config.read(filename)
+    return config
+
+
+def load_config():
+    '''Return a secured getter on the configuration file called like
+config_get(section, name, default).'''
+    try:
+        config = load_cached(_CONFIG_FILE, _read_config)
+    except OSError:
+        config = ConfigParser.ConfigParser()
+
+    def config_get(section, name, default):
+        'Secured config getter.'
+        try:
+            return config.get(section, name)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            return default
+
+    return config_get
+
+
+def sync_dir(dirname):
+    'Flush the renames and the creations of files in a directory.'
+    dir_fd = os.open(dirname or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def save_file(filename, content):
+    '''Save the pprint representation of content in filename. The file is
+written aside, synced and renamed so readers never see a partial file
+and a crash leaves the previous or the new content. When the directory
+can't be written, like CONFIGDIR in the standard installation, the
+file is rewritten in place.'''
+    tmp_filename = filename + '.new'
+    try:
+        tmp_file = open(tmp_filename, 'w')
+    except IOError, xcpt:
+        if xcpt.errno not in (errno.EACCES, errno.EPERM):
+            raise
+        tmp_file = None
+    if tmp_file is None:
+        with open(filename, 'w') as out_file:
+            pprint.pprint(content, stream=out_file)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+    else:
+        with tmp_file:
+            pprint.pprint(content, stream=tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp_filename)
+        os.rename(tmp_filename, filename)
+        sync_dir(os.path.dirname(filename))
+    store_cached(filename, content)
+
+
 def cmdb_filename(cfg_dir, name):
     'Return the cmdb filename.'
     return cfg_dir + name + '.cmdb'
 
 
+def _read_cmdb(filename):
+    'Read a cmdb file keeping a copy of its initial generate() form.'
+    cmdb = eval(open(filename).read(-1))
+    if "generate(" in open(filename).read(20) and \
+            not getattr(cmdb, 'overrides', None):
+        shutil.copy2(filename, filename + ".orig")
+    return cmdb
+
+
 def load_cmdb(cfg_dir, name):
     'Load the cmdb.'
     filename = cmdb_filename(cfg_dir, name)
     try:
-        if "generate(" in open(filename).read(20):
-            shutil.copy2(filename, filename + ".orig")
-        return eval(open(filename).read(-1))
-    except IOError, xcpt:
+        return load_cached(filename, _read_cmdb)
+    except (IOError, OSError), xcpt:
         if xcpt.errno != errno.ENOENT:
             log("exception while processing CMDB %s" % str(xcpt))
         return None
@@ -209,47 +513,718 @@ def save_cmdb(cfg_dir, name, cmdb):
     'Save the cmdb.'
     filename = cmdb_filename(cfg_dir, name)
     try:
-        pprint.pprint(cmdb, stream=open(filename, 'w'))
-    except IOError, xcpt:
+        save_file(filename, cmdb)
+    except (IOError, OSError), xcpt:
+        # the cached cmdb has been modified
+        _CACHE.pop(filename, None)
         log("exception while saving CMDB %s" % str(xcpt))
 
 
-def update_cmdb(cmdb, var, pref, forced_find):
+def claim_entry(entry, var):
+    '''Merge var and a cmdb entry, mark it as used and return the new
+entry, which is var itself.'''
+    entry.update(var)
+    var.update(entry)
+    var['used'] = 1
+    return var
+
+
+def _hashable(value):
+    '''Return a hashable form of a cmdb value keeping the equality of
+the original values.'''
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple([_hashable(elt) for elt in value]))
+    if isinstance(value, dict):
+        return (dict, frozenset([(key, _hashable(elt))
+                                 for key, elt in value.items()]))
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+def _value_key(value):
+    '''Return the text indexing a cmdb value in SqliteStorage. Equal
+values have the same key like 1 and 1.0, u'a' and 'a' or dicts built in
+a different order.'''
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    if isinstance(value, (int, long, float)):
+        return '%d' % value
+    if isinstance(value, unicode):
+        try:
+            return repr(value.encode('ascii'))
+        except UnicodeError:
+            return repr(value)
+    if isinstance(value, list):
+        return '[%s]' % ', '.join([_value_key(elt) for elt in value])
+    if isinstance(value, tuple):
+        return '(%s)' % ', '.join([_value_key(elt) for elt in value])
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(sorted(['%s: %s' % (_value_key(key),
+                                                      _value_key(elt))
+                                          for key, elt in value.items()]))
+    if isinstance(value, (set, frozenset)):
+        return 'set(%s)' % ', '.join(sorted([_value_key(elt)
+                                             for elt in value]))
+    return repr(value)
+
+
+class CmdbIndex(object):
+    '''Index of the entries of a cmdb list to find the first entry
+including some values and the first unused entry without scanning the
+list. Entries must only be replaced through claim.'''
+
+    def __init__(self, cmdb):
+        self.cmdb = cmdb
+        # (sorted keys) -> {(values): [sorted entry indexes]}
+        self._indexes = {}
+        # all the entries before _free are used
+        self._free = 0
+
+    @staticmethod
+    def _values(entry, keys):
+        'Return the hashable values of keys in entry or None.'
+        try:
+            return tuple([_hashable(entry[key]) for key in keys])
+        except KeyError:
+            return None
+
+    def _keys_index(self, keys):
+        'Return the index of the entries on keys, building it if needed.'
+        try:
+            return self._indexes[keys]
+        except KeyError:
+            pass
+        if isinstance(self.cmdb, GeneratedCmdb):
+            positions = self.cmdb.positions(keys)
+        else:
+            positions = xrange(len(self.cmdb))
+        index = {}
+        for idx in positions:
+            values = self._values(self.cmdb[idx], keys)
+            if values is not None:
+                index.setdefault(values, []).append(idx)
+        self._indexes[keys] = index
+        return index
+
+    def lookup(self, pref):
+        'Return the position of the first entry including pref or None.'
+        keys = tuple(sorted(pref))
+        found = self._keys_index(keys).get(self._values(pref, keys))
+        if found:
+            return found[0]
+        return None
+
+    def first_free(self):
+        'Return the position of the first unused entry or None.'
+        while self._free < len(self.cmdb) and \
+                'used' in self.cmdb[self._free]:
+            self._free += 1
+        if self._free < len(self.cmdb):
+            return self._free
+        return None
+
+    def claim(self, idx, var):
+        'Replace the entry at position idx by claim_entry(entry, var).'
+        for keys, index in self._indexes.items():
+            values = self._values(self.cmdb[idx], keys)
+            if values is not None:
+                index[values].remove(idx)
+                if not index[values]:
+                    del index[values]
+        self.cmdb[idx] = claim_entry(self.cmdb[idx], var)
+        for keys, index in self._indexes.items():
+            values = self._values(self.cmdb[idx], keys)
+            if values is not None:
+                bisect.insort(index.setdefault(values, []), idx)
+
+
+# cmdb filename -> (cmdb, CmdbIndex)
+_CMDB_INDEXES = {}
+
+
+def cmdb_index(filename, cmdb):
+    '''Return the CmdbIndex of the cmdb loaded from filename. It is kept
+as long as the same cmdb is loaded.'''
+    try:
+        cached_cmdb, index = _CMDB_INDEXES[filename]
+        if cached_cmdb is cmdb:
+            return index
+    except KeyError:
+        pass
+    index = CmdbIndex(cmdb)
+    _CMDB_INDEXES[filename] = (cmdb, index)
+    return index
+
+
+def update_cmdb(cmdb, var, pref, forced_find, out=None, index=None):
     '''Handle CMDB settings if present. CMDB is updated with var.
-var is also augmented with the cmdb entry found.'''
+var is also augmented with the cmdb entry found. Errors are reported on
+out (sys.stdout by default). index is a CmdbIndex of cmdb that can be
+kept between calls.'''
 
-    def update_entry(entry, cmdb, idx):
-        'Update var using a cmdb entry and save the full cmdb on disk.'
-        entry.update(var)
-        var.update(entry)
-        var['used'] = 1
-        cmdb[idx] = var
+    if index is None:
+        index = CmdbIndex(cmdb)
 
     # First pass to lookup if the var is already in the database
     # and if this is the case, reuse the entry.
-    idx = 0
-    for entry in cmdb:
-        if is_included(pref, entry):
-            update_entry(entry, cmdb, idx)
-            break
-        idx += 1
-    else:
+    idx = index.lookup(pref)
+    if idx is None:
         # not looking for $$ type matches
-        if not forced_find:
-            # Second pass, find a not used entry.
-            idx = 0
-            for entry in cmdb:
-                if 'used' not in entry:
-                    update_entry(entry, cmdb, idx)
-                    break
-                idx += 1
+        if forced_find:
+            warning_error("No entry matched in the CMDB, aborting.", out)
+            return False
+        # Second pass, find a not used entry.
+        idx = index.first_free()
+        if idx is None:
+            warning_error("No more entry in the CMDB, aborting.", out)
+            return False
+    index.claim(idx, var)
+    return True
+
+
+def specs_filename(cfg_dir, name):
+    'Return the specs filename.'
+    return cfg_dir + name + '.specs'
+
+
+def _read_specs(filename):
+    'Read a specs file and compile it.'
+    return matcher.compile_specs(eval(open(filename, 'r').read(-1)))
+
+
+def load_specs(cfg_dir, name):
+    '''Load the specs of a role and compile them. The compiled specs are
+cached per file modification time.'''
+    return load_cached(specs_filename(cfg_dir, name), _read_specs)
+
+
+def _read_state(filename):
+    'Read a state file.'
+    return eval(open(filename).read(-1))
+
+
+def load_state(state_filename, cached=True):
+    '''Load the list of (role, times) of a state file. The returned list
+can be modified.'''
+    return list(load_cached(state_filename, _read_state, cached))
+
+
+def save_state(state_filename, names):
+    'Save the list of (role, times) of a state file.'
+    save_file(state_filename, list(names))
+
+
+class FileStorage(object):
+    '''Storage of the state and the CMDBs as pprint files in the
+configuration directory. Updates are protected by lock files.'''
+
+    def __init__(self, cfg_dir, lock_filename):
+        self.cfg_dir = cfg_dir
+        self.lock_filename = lock_filename
+        self.location = cfg_dir + 'state'
+
+    def load_state(self):
+        'Return the list of (role, times) of the state.'
+        return load_state(self.location)
+
+    def save_state(self, names):
+        'Replace the state.'
+        save_state(self.location, names)
+
+    def update_state(self, name, delta, idx=None, out=None):
+        '''Add delta to the counter of the role name in the state. If idx
+is given, the role must be at this position in the state, else the
+first role named name with a counter is used. Roles with a '*' counter
+are left unchanged. Return False if the role is not found or its
+counter would become negative.'''
+        lockfd = lock_or_fail(self.lock_filename, out)
+        try:
+            # the state is small: reread it rather than trust the cache
+            names = load_state(self.location, False)
+            if idx is None:
+                for idx, (role, times) in enumerate(names):
+                    if role == name and times != '*':
+                        break
+                else:
+                    return False
+            elif idx >= len(names) or names[idx][0] != name:
+                return False
+            times = names[idx][1]
+            if times == '*':
+                return True
+            times = int(times) + delta
+            if times < 0:
+                return False
+            names[idx] = (name, times)
+            self.save_state(names)
+        finally:
+            unlock(lockfd, self.lock_filename)
+        log('Setting %s to %d' % (name, times))
+        return True
+
+    def cmdb_roles(self):
+        'Return the names of the roles having a cmdb.'
+        return sorted([os.path.basename(filename)[:-len('.cmdb')]
+                       for filename in glob.glob(self.cfg_dir + '*.cmdb')])
+
+    def load_cmdb(self, name):
+        'Return the cmdb of the role name or None.'
+        return load_cmdb(self.cfg_dir, name)
+
+    def save_cmdb(self, name, cmdb):
+        'Replace the cmdb of the role name.'
+        save_cmdb(self.cfg_dir, name, cmdb)
+
+    def assign_cmdb(self, name, var, pref, forced_find, out=None):
+        '''Assign an entry of the cmdb of the role name, if any, like
+update_cmdb. Return False if no entry can be assigned.'''
+        cmdb_lock = '%s.%s' % (self.lock_filename, name)
+        lockfd = lock_or_fail(cmdb_lock, out)
+        try:
+            cmdb = self.load_cmdb(name)
+            if cmdb:
+                index = cmdb_index(cmdb_filename(self.cfg_dir, name), cmdb)
+                if not update_cmdb(cmdb, var, pref, forced_find, out,
+                                   index):
+                    return False
+                self.save_cmdb(name, cmdb)
+            return True
+        finally:
+            unlock(lockfd, cmdb_lock)
+
+
+class SqliteStorage(object):
+    '''Storage of the state and the CMDBs in a SQLite database. Role
+counters and CMDB entries are updated in transactions and the values
+of the CMDB entries are indexed. Only the model and the overrides of
+a GeneratedCmdb are stored.'''
+
+    _MODELS_TABLE = ('CREATE TABLE cmdb_models (role TEXT PRIMARY KEY, '
+                     'model TEXT)')
+
+    _SCHEMA = (
+        'CREATE TABLE state (idx INTEGER PRIMARY KEY, name TEXT, times)',
+        'CREATE TABLE cmdb_roles (role TEXT PRIMARY KEY)',
+        'CREATE TABLE cmdb (role TEXT, idx INTEGER, used INTEGER, '
+        'entry TEXT, PRIMARY KEY (role, idx))',
+        'CREATE INDEX cmdb_used ON cmdb (role, used, idx)',
+        'CREATE TABLE cmdb_values (role TEXT, key TEXT, value TEXT, '
+        'idx INTEGER)',
+        'CREATE INDEX cmdb_values_lookup '
+        'ON cmdb_values (role, key, value, idx)',
+        _MODELS_TABLE,
+        )
+    # PRAGMA user_version of the databases created with _SCHEMA
+    _VERSION = 2
+
+    def __init__(self, filename, cfg_dir=None):
+        '''Open the database filename. When the database is created, it is
+filled with the pprint files of cfg_dir if given.'''
+        self.location = filename
+        self.conn = sqlite3.connect(filename, timeout=60,
+                                    isolation_level=None)
+        self.conn.text_factory = str
+        if not self._created():
+            self._create(cfg_dir)
+        elif self._version() < self._VERSION:
+            self._upgrade()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        'Run a block in a transaction locking the database for writing.'
+        cursor = self.conn.cursor()
+        with timed('lock'):
+            cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+
+    def _created(self):
+        'Return True if the tables exist.'
+        return self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+            "AND name = 'state'").fetchone() is not None
+
+    def _create(self, cfg_dir):
+        'Create the tables and import the pprint files of cfg_dir.'
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self._transaction() as cursor:
+            if self._created():
+                return
+            for statement in self._SCHEMA:
+                cursor.execute(statement)
+            cursor.execute('PRAGMA user_version = %d' % self._VERSION)
+            if not cfg_dir:
+                return
+            log('Importing state and CMDBs from %s in %s' %
+                (cfg_dir, self.location))
+            files = FileStorage(cfg_dir, None)
+            try:
+                self._save_state(cursor, files.load_state())
+            except (IOError, OSError):
+                pass
+            for name in files.cmdb_roles():
+                self._save_cmdb(cursor, name, files.load_cmdb(name))
+
+    def _version(self):
+        'Return the schema version of the database.'
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def _upgrade(self):
+        '''Upgrade the databases created with a previous schema: rebuild
+the value index of the databases created before the values were indexed
+by _value_key and add the table of the models.'''
+        with self._transaction() as cursor:
+            version = self._version()
+            if version >= self._VERSION:
+                return
+            log('Upgrading the schema of %s' % self.location)
+            if version < 1:
+                cursor.execute('DELETE FROM cmdb_values')
+                for name, idx, entry in cursor.execute(
+                        'SELECT role, idx, entry FROM cmdb').fetchall():
+                    self._set_values(cursor, name, idx,
+                                     ast.literal_eval(entry))
+            if version < 2:
+                cursor.execute(self._MODELS_TABLE)
+            cursor.execute('PRAGMA user_version = %d' % self._VERSION)
+
+    def load_state(self):
+        'Return the list of (role, times) of the state.'
+        return [tuple(row) for row in self.conn.execute(
+            'SELECT name, times FROM state ORDER BY idx')]
+
+    @staticmethod
+    def _save_state(cursor, names):
+        'Replace the state in the current transaction.'
+        cursor.execute('DELETE FROM state')
+        cursor.executemany('INSERT INTO state VALUES (?, ?, ?)',
+                           [(idx, name, times)
+                            for idx, (name, times) in enumerate(names)])
+
+    def save_state(self, names):
+        'Replace the state.'
+        with self._transaction() as cursor:
+            self._save_state(cursor, names)
+
+    def update_state(self, name, delta, idx=None, out=None):
+        '''Add delta to the counter of the role name in the state like
+FileStorage.update_state.'''
+        with self._transaction() as cursor:
+            if idx is None:
+                cursor.execute("SELECT idx, times FROM state WHERE name = ? "
+                               "AND times != '*' ORDER BY idx LIMIT 1",
+                               (name,))
             else:
-                warning_error("No more entry in the CMDB, aborting.")
+                cursor.execute('SELECT idx, times FROM state '
+                               'WHERE idx = ? AND name = ?', (idx, name))
+            row = cursor.fetchone()
+            if not row:
+                return False
+            idx, times = row
+            if times == '*':
+                return True
+            times = int(times) + delta
+            if times < 0:
                 return False
+            cursor.execute('UPDATE state SET times = ? WHERE idx = ?',
+                           (times, idx))
+        log('Setting %s to %d' % (name, times))
+        return True
+
+    def cmdb_roles(self):
+        'Return the names of the roles having a cmdb.'
+        return [row[0] for row in self.conn.execute(
+            'SELECT role FROM cmdb_roles ORDER BY role')]
+
+    @staticmethod
+    def _model(cursor, name):
+        'Return the model of the generated cmdb of the role name or None.'
+        row = cursor.execute('SELECT model FROM cmdb_models WHERE role = ?',
+                             (name,)).fetchone()
+        if row:
+            return ast.literal_eval(row[0])
+        return None
+
+    def load_cmdb(self, name):
+        'Return the cmdb of the role name or None.'
+        if not self.conn.execute('SELECT 1 FROM cmdb_roles WHERE role = ?',
+                                 (name,)).fetchone():
+            return None
+        entries = [(idx, ast.literal_eval(entry))
+                   for idx, entry in self.conn.execute(
+                       'SELECT idx, entry FROM cmdb WHERE role = ? '
+                       'ORDER BY idx', (name,))]
+        model = self._model(self.conn, name)
+        if model is not None:
+            return GeneratedCmdb(model, entries)
+        return [entry for _, entry in entries]
+
+    @staticmethod
+    def _set_values(cursor, name, idx, entry):
+        'Index the values of a cmdb entry.'
+        cursor.executemany('INSERT INTO cmdb_values VALUES (?, ?, ?, ?)',
+                           [(name, key, _value_key(value), idx)
+                            for key, value in entry.items()])
+
+    def _set_entry(self, cursor, name, idx, entry, insert=False):
+        'Write a cmdb entry and its indexed values.'
+        if insert:
+            cursor.execute('INSERT INTO cmdb VALUES (?, ?, ?, ?)',
+                           (name, idx, 'used' in entry, repr(entry)))
         else:
-            warning_error("No entry matched in the CMDB, aborting.")
-            return False
-    return True
+            cursor.execute('UPDATE cmdb SET used = ?, entry = ? '
+                           'WHERE role = ? AND idx = ?',
+                           ('used' in entry, repr(entry), name, idx))
+            cursor.execute('DELETE FROM cmdb_values '
+                           'WHERE role = ? AND idx = ?', (name, idx))
+        self._set_values(cursor, name, idx, entry)
+
+    def _save_cmdb(self, cursor, name, cmdb):
+        'Replace the cmdb of the role name in the current transaction.'
+        for table in ('cmdb_roles', 'cmdb', 'cmdb_values', 'cmdb_models'):
+            cursor.execute('DELETE FROM %s WHERE role = ?' % table, (name,))
+        cursor.execute('INSERT INTO cmdb_roles VALUES (?)', (name,))
+        if isinstance(cmdb, GeneratedCmdb):
+            cursor.execute('INSERT INTO cmdb_models VALUES (?, ?)',
+                           (name, repr(cmdb.model)))
+            entries = sorted(cmdb.overrides.items())
+        else:
+            entries = enumerate(cmdb)
+        for idx, entry in entries:
+            self._set_entry(cursor, name, idx, entry, insert=True)
+
+    def save_cmdb(self, name, cmdb):
+        'Replace the cmdb of the role name.'
+        with self._transaction() as cursor:
+            self._save_cmdb(cursor, name, cmdb)
+
+    @staticmethod
+    def _lookup_stored(cursor, name, pref):
+        '''Return the (idx, entry) of the first stored cmdb entry
+including pref or None. The entries selected by the value index are
+checked with is_included as their values only have the same
+_value_key.'''
+        if not pref:
+            cursor.execute('SELECT idx, entry FROM cmdb WHERE role = ? '
+                           'ORDER BY idx LIMIT 1', (name,))
+            return cursor.fetchone()
+        items = pref.items()
+        cursor.execute(
+            'SELECT idx, entry FROM cmdb WHERE role = ? AND idx IN '
+            '(SELECT idx FROM cmdb_values WHERE role = ? AND (%s) '
+            'GROUP BY idx HAVING COUNT(*) = ?) ORDER BY idx' %
+            ' OR '.join(['(key = ? AND value = ?)'] * len(items)),
+            [name, name] +
+            [param for key, value in items
+             for param in (key, _value_key(value))] +
+            [len(items)])
+        for idx, entry in cursor:
+            if is_included(pref, ast.literal_eval(entry)):
+                return idx, entry
+        return None
+
+    def _lookup(self, cursor, name, pref, generated=None):
+        '''Return the (idx, entry, stored) of the first cmdb entry
+including pref or None. generated is the GeneratedCmdb of the model of
+the role, if any, to look up the entries that are not stored.'''
+        found = self._lookup_stored(cursor, name, pref)
+        if found:
+            found = (found[0], ast.literal_eval(found[1]), True)
+        if generated is None or not set(pref) <= set(generated.model):
+            return found
+        # only the entries before the stored one can be generated ones
+        end = found[0] if found else len(generated)
+        stored = set([row[0] for row in cursor.execute(
+            'SELECT idx FROM cmdb WHERE role = ? AND idx < ?', (name, end))])
+        for idx in xrange(end):
+            if idx not in stored:
+                entry = generated[idx]
+                if is_included(pref, entry):
+                    return idx, entry, False
+        return found
+
+    @staticmethod
+    def _first_free(cursor, name, generated=None):
+        '''Return the (idx, entry, stored) of the first unused cmdb entry
+or None. generated is the GeneratedCmdb of the model of the role, if
+any, whose entries that are not stored are unused.'''
+        cursor.execute('SELECT idx, entry FROM cmdb WHERE role = ? '
+                       'AND used = 0 ORDER BY idx LIMIT 1', (name,))
+        found = cursor.fetchone()
+        if found:
+            found = (found[0], ast.literal_eval(found[1]), True)
+        if generated is None:
+            return found
+        idx = cursor.execute(
+            'SELECT MIN(idx) FROM (SELECT 0 AS idx UNION '
+            'SELECT idx + 1 FROM cmdb WHERE role = ?) '
+            'WHERE idx NOT IN (SELECT idx FROM cmdb WHERE role = ?)',
+            (name, name)).fetchone()[0]
+        if idx < len(generated) and (not found or idx < found[0]):
+            return idx, generated[idx], False
+        return found
+
+    def assign_cmdb(self, name, var, pref, forced_find, out=None):
+        '''Assign an entry of the cmdb of the role name, if any, like
+update_cmdb. Return False if no entry can be assigned.'''
+        with self._transaction() as cursor:
+            model = self._model(cursor, name)
+            if model is not None:
+                generated = GeneratedCmdb(model)
+            else:
+                generated = None
+                cursor.execute('SELECT 1 FROM cmdb WHERE role = ? LIMIT 1',
+                               (name,))
+                if not cursor.fetchone():
+                    return True
+            found = self._lookup(cursor, name, pref, generated)
+            if not found:
+                if forced_find:
+                    warning_error("No entry matched in the CMDB, aborting.",
+                                  out)
+                    return False
+                found = self._first_free(cursor, name, generated)
+                if not found:
+                    warning_error("No more entry in the CMDB, aborting.",
+                                  out)
+                    return False
+            idx, entry, stored = found
+            self._set_entry(cursor, name, idx, claim_entry(entry, var),
+                            insert=not stored)
+        return True
+
+
+# values of the STORAGE setting
+_STORAGES = ('sqlite', 'files')
+
+# database filename -> SqliteStorage opened by the current thread
+_DATABASES = threading.local()
+
+
+def database_filename(config_get, section, cfg_dir):
+    '''Return the SQLite database of a section: DATABASE, edeploy.db in
+the data directory by default. The databases created in CONFIGDIR by
+the previous versions are kept.'''
+    filename = config_get(section, 'DATABASE', None)
+    if filename:
+        return filename
+    filename = cfg_dir + 'edeploy.db'
+    if os.path.exists(filename):
+        return filename
+    return get_data_dir(config_get, section, cfg_dir) + 'edeploy.db'
+
+
+def get_storage(config_get, section, cfg_dir):
+    '''Return the storage of the state and the CMDBs of a section
+according to its STORAGE setting. A thread opens each database once and
+keeps its connection until it exits.'''
+    storage = config_get(section, 'STORAGE', 'sqlite')
+    if storage not in _STORAGES:
+        raise ValueError('Invalid STORAGE %s, expected one of %s' %
+                         (storage, ', '.join(_STORAGES)))
+    if storage == 'files':
+        return FileStorage(cfg_dir,
+                           config_get(section, 'LOCKFILE',
+                                      '/var/run/httpd/edeploy.lock'))
+    filename = database_filename(config_get, section, cfg_dir)
+    databases = getattr(_DATABASES, 'storages', None)
+    if databases is None:
+        databases = _DATABASES.storages = {}
+    try:
+        return databases[filename]
+    except KeyError:
+        databases[filename] = SqliteStorage(filename, cfg_dir)
+        return databases[filename]
+
+
+def copy_storage(src, dst):
+    'Copy the state and the CMDBs from the storage src to dst.'
+    dst.save_state(src.load_state())
+    for name in src.cmdb_roles():
+        dst.save_cmdb(name, src.load_cmdb(name))
+
+
+_CONFIGURE_HEADER = '''
+import commands
+import os
+import sys
+
+import hpacucli
+import ipmi
+import time
+
+def run(cmd):
+    sys.stderr.write('+ ' + cmd + '\\n')
+    status, output = commands.getstatusoutput(cmd)
+    sys.stderr.write(output + '\\n')
+    if status != 0:
+        sys.stderr.write("Command '%s' failed\\n" % cmd)
+        sys.stderr.write("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\\n")
+        sys.stderr.write("!!! Configure script exited prematurely !!!\\n")
+        sys.stderr.write("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\\n")
+        sys.exit(status)
+
+def set_role(role, version, disk):
+    with open('/vars', 'a') as f:
+        f.write("ROLE=%s\\nVERS=%s\\nDISK=%s\\n" % (role,
+                                                    version,
+                                                    disk))
+        f.write("PROFILE=%s\\n" % var['edeploy-profile'])
+
+def config(name, mode='w', basedir='/post_rsync', fmod=0644, uid=0, gid=0):
+    path = basedir + name
+    dir_ = '/'.join(path.split('/')[:-1])
+    if not os.path.exists(dir_):
+        os.makedirs(dir_)
+    f = open(path, mode)
+    os.fchmod(f.fileno(), fmod)
+    os.fchown(f.fileno(), uid, gid)
+    return f
+
+var = '''
+
+
+class ConfigureTemplate(object):
+    '''Configure script of a role. The parts that don't depend on the
+host are assembled once so a script is rendered by writing a few
+chunks.'''
+
+    def __init__(self, name, cfg):
+        self.name = name
+        self.head = ('#!/usr/bin/env python\n#EDEPLOY_PROFILE = %s\n'
+                     % name) + _CONFIGURE_HEADER
+        self.cfg = cfg
+
+    def render(self, var, pxemngr_url=None, metadata_url=None):
+        'Return the chunks of the configure script for var.'
+        chunks = [self.head, pprint.pformat(var) + '\n', self.cfg]
+        if pxemngr_url:
+            chunks.append('''
+run('echo "PXEMNGR_URL=%s" >> /vars')
+
+''' % pxemngr_url)
+        if metadata_url:
+            chunks.append('''
+run('echo "METADATA_URL=%s" >> /vars')
+
+''' % metadata_url)
+        return chunks
+
+
+def _read_configure(filename):
+    'Read the configure script of a role as a ConfigureTemplate.'
+    name = os.path.basename(filename)[:-len('.configure')]
+    return ConfigureTemplate(name, open(filename).read(-1))
+
+
+def load_configure(cfg_dir, name):
+    'Load the ConfigureTemplate of a role.'
+    return load_cached(cfg_dir + name + '.configure', _read_configure)
 
 
 def save_hw(items, name, hwdir):
@@ -261,8 +1236,22 @@ def save_hw(items, name, hwdir):
         log("exception while saving hw file: %s" % str(xcpt))
 
 
+# archive directory -> HwArchive
+_HW_ARCHIVES = {}
+
+
+def archive_hw(items, sysvars, directory):
+    'Append hw items to the archive of directory.'
+    try:
+        archive = _HW_ARCHIVES.setdefault(directory,
+                                          hwarchive.HwArchive(directory))
+        archive.append(items, sysvars['sysname'], sysvars.get('sysserial'))
+    except Exception, xcpt:
+        log("exception while archiving hw file: %s" % str(xcpt))
+
+
 def register_pxemngr(sysvars):
-    'Register the system in pxemngr.'
+    'Register the system in pxemngr. Return True on success.'
     # only use Ethernet mac addresses with pxemngr
     macs = ' '.join(filter(lambda x: len(x) == 17, sysvars['serial']))
     cmd = 'pxemngr addsystem %s %s' % (sysvars['sysname'],
@@ -270,9 +1259,201 @@ def register_pxemngr(sysvars):
     status, output = commands.getstatusoutput(cmd)
     if status != 0:
         log('%s -> %d / %s' % (cmd, status, output))
-    else:
-        log('added %s under pxemngr for MAC addresses %s'
-            % (sysvars['sysname'], macs))
+        return False
+    log('added %s under pxemngr for MAC addresses %s'
+        % (sysvars['sysname'], macs))
+    return True
+
+
+# hook name -> function called with the arguments posted to a HookQueue
+HOOKS = {'pxemngr': register_pxemngr}
+
+# delay before retrying a failed hook, doubled at each attempt up to
+# _HOOK_MAX_DELAY
+_HOOK_RETRY_DELAY = 60
+_HOOK_MAX_DELAY = 3600
+_HOOK_MAX_ATTEMPTS = 10
+
+
+def try_lock(filename):
+    '''Lock a file without waiting. Return a file descriptor to pass to
+unlock or None if the file is already locked.'''
+    lock_fd = os.open(filename, os.O_CREAT | os.O_RDWR, 0644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, xcpt:
+        os.close(lock_fd)
+        if xcpt.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return None
+    return lock_fd
+
+
+class HookQueue(object):
+    '''Calls to HOOKS run once the response is sent. The calls are
+appended as JSON lines to an outbox file. A drain moves them to a work
+file, runs the calls which are due and keeps the failed ones there to
+retry them later. A call can run twice if a drain is interrupted.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.work_filename = filename + '.work'
+        self.lock_filename = filename + '.lock'
+        self.event = threading.Event()
+        self.worker = None
+
+    def post(self, hook, *args):
+        'Queue a call to HOOKS[hook](*args).'
+        line = json.dumps({'hook': hook, 'args': args,
+                           'attempts': 0, 'next': 0})
+        with open(self.filename, 'a') as outbox:
+            fcntl.flock(outbox, fcntl.LOCK_EX)
+            outbox.write(line + '\n')
+        self.event.set()
+
+    def _load_work(self):
+        'Read the calls of the work file.'
+        try:
+            return json.load(open(self.work_filename))
+        except IOError, xcpt:
+            if xcpt.errno != errno.ENOENT:
+                raise
+            return []
+
+    def _save_work(self, calls):
+        'Replace the work file by calls.'
+        tmp_filename = self.work_filename + '.new'
+        with open(tmp_filename, 'w') as work_file:
+            json.dump(calls, work_file)
+        os.rename(tmp_filename, self.work_filename)
+
+    def _take(self):
+        'Move the calls of the outbox to the work file.'
+        try:
+            outbox = open(self.filename, 'r+')
+        except IOError, xcpt:
+            if xcpt.errno != errno.ENOENT:
+                raise
+            return
+        with outbox:
+            fcntl.flock(outbox, fcntl.LOCK_EX)
+            lines = outbox.readlines()
+            if lines:
+                self._save_work(self._load_work() +
+                                [json.loads(line) for line in lines])
+                outbox.truncate(0)
+
+    @staticmethod
+    def _run(call, now):
+        '''Run a call. Return True if it is done or has to be dropped else
+schedule its next attempt.'''
+        if call['hook'] not in HOOKS:
+            log('Dropping unknown hook %s' % call['hook'])
+            return True
+        try:
+            if HOOKS[call['hook']](*call['args']):
+                return True
+        except Exception, xcpt:
+            log('Hook %s failed: %s' % (call['hook'], str(xcpt)))
+        call['attempts'] += 1
+        if call['attempts'] >= _HOOK_MAX_ATTEMPTS:
+            log('Giving up hook %s after %d attempts'
+                % (call['hook'], call['attempts']))
+            return True
+        call['next'] = now + min(
+            _HOOK_RETRY_DELAY * 2 ** (call['attempts'] - 1), _HOOK_MAX_DELAY)
+        return False
+
+    def _posted(self):
+        'Tell if calls are waiting in the outbox.'
+        try:
+            return os.path.getsize(self.filename) > 0
+        except OSError, xcpt:
+            if xcpt.errno != errno.ENOENT:
+                raise
+            return False
+
+    def drain(self, now=None):
+        '''Run the queued calls which are due. Return the number of calls
+left or None if another drain is running. The calls posted during a
+drain are run by it: the drains which cannot get the lock leave them
+to the running one, which checks the outbox again after unlocking.'''
+        while True:
+            lock_fd = try_lock(self.lock_filename)
+            if lock_fd is None:
+                return None
+            try:
+                self._take()
+                calls = self._load_work()
+                if now is None:
+                    now = time.time()
+                left = []
+                for idx, call in enumerate(calls):
+                    if call['next'] > now or not self._run(call, now):
+                        left.append(call)
+                    # record the progress in case we are interrupted
+                    self._save_work(left + calls[idx + 1:])
+            finally:
+                unlock(lock_fd, self.lock_filename)
+            if not self._posted():
+                return len(left)
+
+    def _work(self):
+        'Drain the queue when a call is posted or a retry can be due.'
+        while True:
+            self.event.wait(_HOOK_RETRY_DELAY)
+            self.event.clear()
+            try:
+                self.drain()
+            except Exception, xcpt:
+                log('Unable to drain %s: %s' % (self.filename, str(xcpt)))
+
+    def start(self):
+        'Start a thread draining the queue in the background.'
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._work)
+            self.worker.daemon = True
+            self.worker.start()
+
+
+# outbox filename -> HookQueue
+_HOOK_QUEUES = {}
+
+
+def get_hook_queue(config_get, section, cfg_dir):
+    '''Return the HookQueue of the OUTBOX setting of section,
+hooks.outbox in the data directory by default. The outboxes created in
+CONFIGDIR by the previous versions are kept.'''
+    filename = config_get(section, 'OUTBOX', None)
+    if not filename:
+        filename = cfg_dir + 'hooks.outbox'
+        if not os.path.exists(filename):
+            filename = get_data_dir(config_get, section, cfg_dir) + \
+                'hooks.outbox'
+    return _HOOK_QUEUES.setdefault(filename, HookQueue(filename))
+
+
+def run_hooks(background=False):
+    '''Drain the hook queues used by the requests, in background threads
+for a long-running service.'''
+    for queue in _HOOK_QUEUES.values():
+        if background:
+            queue.start()
+        else:
+            try:
+                queue.drain()
+            except Exception, xcpt:
+                log('Unable to drain %s: %s' % (queue.filename, str(xcpt)))
+
+
+def close_stdout():
+    '''Close the standard output so the client gets the end of the
+response while the hooks run.'''
+    sys.stdout.close()
+    # keep file descriptor 1 used so no file opened later gets it
+    null_fd = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(null_fd, 1)
+    os.close(null_fd)
 
 
 def generate_filename_and_macs(items):
@@ -320,133 +1501,164 @@ def generate_filename_and_macs(items):
     return sysvars
 
 
-def warning_error(error):
-    '''Report a shell script with the error message and log
-    the message on stderr.'''
-    print('''#!/bin/sh
+def warning_error(error, out=None):
+    '''Report a shell script with the error message on out (sys.stdout
+    by default) and log the message on stderr.'''
+    (out or sys.stdout).write('''#!/bin/sh
 
 cat <<EOF
 %s
 EOF
 
 exit 1
+
 ''' % error)
     log('Aborting: ' + error)
     if sys.exc_info()[0] is not None:
         traceback.print_exc(file=sys.stderr)
 
 
-def fatal_error(error):
+def fatal_error(error, out=None):
     '''Report a shell script with the error message and log
     the message on stderr.'''
-    warning_error(error)
+    warning_error(error, out)
     sys.exit(1)
 
 
-def main():
-    '''CGI entry point.'''
+# Size of the chunks used to copy the log files
+_LOG_CHUNK_SIZE = 65536
 
-    config = ConfigParser.ConfigParser()
-    config.read('/etc/edeploy.conf')
 
-    def config_get(section, name, default):
-        'Secured config getter.'
-        try:
-            return config.get(section, name)
-        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
-            return default
+def field_size(field):
+    'Return the size of a form field without reading it in memory.'
+    field_file = getattr(field, 'file', None)
+    if field_file is None:
+        return len(field.value)
+    pos = field_file.tell()
+    field_file.seek(0, os.SEEK_END)
+    size = field_file.tell()
+    field_file.seek(pos)
+    return size
 
-    failure_role = ''
-    section = 'SERVER'
 
-    # parse hw file given in argument or passed to cgi script
-    if len(sys.argv) >= 3 and sys.argv[1] == '-f':
-        hw_file = open(sys.argv[2])
-        if len(sys.argv) >= 5 and sys.argv[3] == '-F':
-            failure_role = sys.argv[4]
-
-        cfg_dir = os.path.normpath(config_get(
-            'SERVER', 'CONFIGDIR',
-            os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                         '..',
-                         'config'))) + '/'
+def rotated_logs(filename):
+    'Return the renamed previous versions of a log file, oldest first.'
+    return sorted(glob.glob('%s.%s.log.gz' % (filename[:-7], '[0-9]' * 14)))
 
-        hw_dir = os.path.normpath(config_get(
-            'SERVER', 'HWDIR', cfg_dir)) + '/'
 
-    else:
-        cgitb.enable()
+def save_log(config_get, section, cfg_dir, logitem, out=None):
+    '''Save a log file sent by a host in LOGDIR. The file is copied aside
+in chunks and renamed once on disk. The previous log of the host is
+renamed with its date and only the last LOGKEEP of them are kept.'''
+    max_size = int(config_get(section, 'LOGMAXSIZE', 0))
+    keep = int(config_get(section, 'LOGKEEP', -1))
+    size = field_size(logitem)
+    if max_size and size > max_size:
+        fatal_error('log file %s too big: %d bytes > LOGMAXSIZE (%d)'
+                    % (logitem.filename, size, max_size), out)
+    try:
+        # Let's save the file in LOGDIR directory
+        log_dir = os.path.normpath(config_get(section,
+                                              'LOGDIR',
+                                              cfg_dir)) + '/'
+        filename = os.path.join(log_dir,
+                                os.path.basename(logitem.filename))
+        # unique name as the same host can send its log twice at once
+        tmp_filename = '%s.%d.%d.new' % (filename, os.getpid(),
+                                         threading.current_thread().ident)
+        try:
+            with open(tmp_filename, 'wb') as output_file:
+                logitem.file.seek(0)
+                shutil.copyfileobj(logitem.file, output_file,
+                                   _LOG_CHUNK_SIZE)
+                output_file.flush()
+                os.fsync(output_file.fileno())
+            if os.path.exists(filename):
+                backupname = '%s.%s.log.gz' % \
+                             (filename[:-7],
+                              time.strftime('%Y%m%d%H%M%S',
+                                            time.gmtime(
+                                                os.path.getmtime(
+                                                    filename))))
+                log('Renaming log file %s to %s' % (filename, backupname))
+                os.rename(filename, backupname)
+            os.rename(tmp_filename, filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.unlink(tmp_filename)
+        if keep >= 0:
+            old_logs = rotated_logs(filename)
+            for old_log in old_logs[:max(len(old_logs) - keep, 0)]:
+                log('Removing old log file %s' % old_log)
+                os.unlink(old_log)
+        sync_dir(log_dir)
+    except Exception, xcpt:
+        # If we fails at saving, let's exit
+        fatal_error("exception while saving log file: %s" % str(xcpt),
+                    out)
+    log('Log file %s saved (%d bytes)' % (logitem.filename, size))
 
-        form = cgi.FieldStorage()
 
-        log('Called from %s' % os.getenv('REMOTE_ADDR', '<no address>'))
+# Room for the other fields and the encoding of a request sending a log
+_FORM_OVERHEAD = 1024 * 1024
 
-        print "Content-Type: text/x-python"     # HTML is following
-        print                                   # blank line, end of headers
 
-        # Log form fields
-        for key in form:
-            if key == 'file':
-                log('form[%s]: %d bytes' % (key, len(form.getvalue(key))))
-            else:
-                log('form[%s]: "%s"' % (key, form.getvalue(key)))
+def check_request_size(config_get, content_length, out=None):
+    '''Reject a request too big to send a log file of LOGMAXSIZE bytes
+before its form is parsed, as FieldStorage stores the whole body.'''
+    max_size = int(config_get('SERVER', 'LOGMAXSIZE', 0))
+    try:
+        length = int(content_length)
+    except (TypeError, ValueError):
+        return
+    if max_size and length > max_size + _FORM_OVERHEAD:
+        fatal_error('request too big: %d bytes > LOGMAXSIZE (%d)'
+                    % (length, max_size), out)
 
-        section = form.getvalue('section', 'SERVER')
 
-        cfg_dir = os.path.normpath(config_get(
-            section, 'CONFIGDIR',
-            os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                         '..',
-                         'config'))) + '/'
+def get_cfg_dir(config_get, section):
+    'Return the configuration directory of a section.'
+    return os.path.normpath(config_get(
+        section, 'CONFIGDIR',
+        os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                     '..',
+                     'config'))) + '/'
 
-        # If the filename ends with a .log, we need to process it as a log file
-        if ('file' in form) and (form['file'].filename.endswith('.log.gz')):
-            logitem = form['file']
-            logfile = logitem.file
-            try:
-                # Let's save the file in LOGDIR directory
-                log_dir = os.path.normpath(config_get(section,
-                                                      'LOGDIR',
-                                                      cfg_dir)) + '/'
-                filename = os.path.join(log_dir,
-                                        os.path.basename(logitem.filename))
-                if os.path.exists(filename):
-                    backupname = '%s.%s.log.gz' % \
-                                 (filename[:-7],
-                                  time.strftime('%Y%m%d%H%M%S',
-                                                time.gmtime(
-                                                    os.path.getmtime(
-                                                        filename))))
-                    log('Renaming log file %s to %s' % (filename, backupname))
-                    os.rename(filename, backupname)
-                output_file = open(filename, 'w')
-                output_file.write(logfile.read(-1))
-                output_file.close()
-            except Exception, xcpt:
-                # If we fails at saving, let's exit
-                fatal_error("exception while saving log file: %s" % str(xcpt))
-                sys.exit(1)
-            # If the succeed at saving log file, let's also exit
-            # In fact we have nothing more to do once its saved.
-            log('Log file %s saved' % logitem.filename)
-            sys.exit(0)
 
-        if 'file' not in form:
-            fatal_error('No file passed to the CGI')
+def get_data_dir(config_get, section, cfg_dir):
+    '''Return the directory where the files written by upload.py like
+the database are kept: DATADIR, HWDIR by default as the http service
+can write it, unlike CONFIGDIR.'''
+    return os.path.normpath(config_get(
+        section, 'DATADIR', config_get(section, 'HWDIR', cfg_dir))) + '/'
 
-        fileitem = form['file']
-        hw_file = fileitem.file
 
-        if form.getvalue('failure'):
-            failure_role = form.getvalue('failure')
+# phases logged at the end of process_hw
+_PHASES = ('parse', 'save', 'match', 'cmdb', 'lock', 'render')
 
-        hw_dir = os.path.normpath(config_get(
-            section, 'HWDIR', cfg_dir)) + '/'
 
+def process_hw(config_get, section, hw_file, failure_role='', out=None):
+    '''Match the hw file against the roles of the state of section and
+write the configure script of the matching role on out (sys.stdout by
+default). The time spent in each phase is logged.'''
+    _TIMINGS.phases = {}
+    start = time.time()
     try:
-        json_hw_items = json.loads(hw_file.read(-1))
-    except Exception, excpt:
-        fatal_error("'Invalid hardware file: %s'" % str(excpt))
+        _process_hw(config_get, section, hw_file, failure_role,
+                    out or sys.stdout)
+    finally:
+        phases = _TIMINGS.phases
+        del _TIMINGS.phases
+        log('Timings (ms): total=%.1f %s'
+            % ((time.time() - start) * 1000,
+               ' '.join(['%s=%.1f' % (phase, phases.get(phase, 0) * 1000)
+                         for phase in _PHASES])))
+
+
+def _process_hw(config_get, section, hw_file, failure_role, out):
+    'Body of process_hw.'
+    cfg_dir = get_cfg_dir(config_get, section)
+    hw_dir = os.path.normpath(config_get(section, 'HWDIR', cfg_dir)) + '/'
 
     def encode(elt):
         'Encode unicode strings as strings else return the object'
@@ -455,159 +1667,268 @@ def main():
         except AttributeError:
             return elt
 
-    hw_items = []
-    for info in json_hw_items:
-        hw_items.append(tuple(map(encode, info)))
-
-    # avoid concurrent accesses
-    lock_filename = config_get(section, 'LOCKFILE',
-                               '/var/run/httpd/edeploy.lock')
-    try:
-        lockfd = lock(lock_filename)
-    except Exception, excpt:
-        fatal_error("'Error on server's lock file : %s'" % str(excpt))
+    with timed('parse'):
+        try:
+            json_hw_items = json.loads(hw_file.read(-1))
+        except Exception, excpt:
+            fatal_error("'Invalid hardware file: %s'" % str(excpt), out)
 
-    def cleanup():
-        'Remove lock.'
-        unlock(lockfd, lock_filename)
+        hw_items = []
+        for info in json_hw_items:
+            hw_items.append(tuple(map(encode, info)))
 
-    atexit.register(cleanup)
+        filename_and_macs = generate_filename_and_macs(hw_items)
 
-    filename_and_macs = generate_filename_and_macs(hw_items)
-    save_hw(hw_items, filename_and_macs['sysname'], hw_dir)
+    with timed('save'):
+        save_hw(hw_items, filename_and_macs['sysname'], hw_dir)
+        archive_dir = config_get(section, 'HWARCHIVE', hw_dir + 'archive')
+        if archive_dir:
+            archive_hw(hw_items, filename_and_macs, archive_dir)
 
     use_pxemngr = (config_get(section, 'USEPXEMNGR', False) == 'True')
     pxemngr_url = config_get(section, 'PXEMNGRURL', None)
     metadata_url = config_get(section, 'METADATAURL', None)
 
     if use_pxemngr:
-        register_pxemngr(filename_and_macs)
+        # run once the response is sent by run_hooks. Queued before
+        # updating the state so a failure doesn't consume a role.
+        get_hook_queue(config_get, section, cfg_dir).post(
+            'pxemngr', filename_and_macs)
 
-    state_filename = cfg_dir + 'state'
-    log('Reading state from %s' % state_filename)
-    names = eval(open(state_filename).read(-1))
+    storage = get_storage(config_get, section, cfg_dir)
+    state_filename = storage.location
 
     if failure_role:
         # If we get a failure report, let's reincrement the counter
         log("Received failure for role %s" % failure_role)
-        idx = 0
-        times = '*'
-        name = None
-        for name, times in names:
-            if name == failure_role:
-                # Only consider if time in a numeric entry
-                if times != '*':
-                    names[idx] = (name, int(times) + 1)
-                    with open(state_filename, 'w') as state_file:
-                        pprint.pprint(names, stream=state_file)
-                    break
-            idx += 1
-        sys.exit(0)
+        storage.update_state(failure_role, 1, out=out)
+        return
+
+    log('Reading state from %s' % state_filename)
+    names = storage.load_state()
+
+    # roles are identified by their position in the state
+    valid_roles = [idx for idx, (name, times) in enumerate(names)
+                   if times == '*' or int(times) > 0]
+    roles = ((idx, load_specs(cfg_dir, names[idx][0])) for idx in valid_roles)
+
+    def budget_exceeded(idx):
+        'Log the roles not matched because the search was too long.'
+        log('Search budget of %d nodes exceeded for role %s, '
+            'considered not matching' % (matcher.DEFAULT_BUDGET,
+                                         names[idx][0]))
 
-    idx = 0
-    times = '*'
     name = None
-    valid_roles = []
-    for name, times in names:
-        if times == '*' or int(times) > 0:
-            valid_roles.append(name)
-            specs = eval(open(cfg_dir + name + '.specs', 'r').read(-1))
-            var = {}
-            var2 = {}
-            if matcher.match_all(hw_items, specs, var, var2):
-                log('Specs %s matches' % name)
-
-                forced = (var2 != {})
-
-                if var2 == {}:
-                    var2 = var
-
-                if times != '*':
-                    names[idx] = (name, int(times) - 1)
-                    log('Decrementing %s to %d' % (name, int(times) - 1))
-
-                cmdb = load_cmdb(cfg_dir, name)
-                if cmdb:
-                    if update_cmdb(cmdb, var, var2, forced):
-                        save_cmdb(cfg_dir, name, cmdb)
-                    else:
-                        idx += 1
-                        continue
-                var['edeploy-profile'] = name
-                break
-        idx += 1
+    for idx, var, var2 in timed_iter('match',
+                                     matcher.match_roles(
+                                         hw_items, roles,
+                                         exceeded=budget_exceeded)):
+        name = names[idx][0]
+        log('Specs %s matches' % name)
+
+        cfg = load_configure(cfg_dir, name)
+
+        forced = (var2 != {})
+
+        if var2 == {}:
+            var2 = var
+
+        with timed('cmdb'):
+            if not storage.update_state(name, -1, idx, out):
+                log('No more %s available' % name)
+                continue
+
+            if not storage.assign_cmdb(name, var, var2, forced, out):
+                # give the role back
+                storage.update_state(name, 1, idx, out)
+                continue
+        # var can be an entry of the cached cmdb
+        var = dict(var)
+        var['edeploy-profile'] = name
+        break
     else:
         if len(valid_roles) == 0:
-            fatal_error('No more role available in %s' % (state_filename,))
+            fatal_error('No more role available in %s' % (state_filename,),
+                        out)
         else:
             fatal_error(
                 'Unable to match requirements on the following roles in %s: %s'
-                % (state_filename, ', '.join(valid_roles)))
+                % (state_filename,
+                   ', '.join([names[idx][0] for idx in valid_roles])), out)
 
-    sys.stdout.write('''#!/usr/bin/env python
-#EDEPLOY_PROFILE = %s
-''' % name)
+    if use_pxemngr and pxemngr_url:
+        log("Adding pxemngr url to configure script: %s" % pxemngr_url)
+    else:
+        pxemngr_url = None
+    if metadata_url:
+        log("Adding metadata url to configure script: %s" % metadata_url)
 
-    cfg = open(cfg_dir + name + '.configure').read(-1)
+    with timed('render'):
+        out.writelines(cfg.render(var, pxemngr_url, metadata_url))
 
-    sys.stdout.write('''
-import commands
-import os
-import sys
+    log('Sending configure script')
 
-import hpacucli
-import ipmi
-import time
 
-def run(cmd):
-    sys.stderr.write('+ ' + cmd + '\\n')
-    status, output = commands.getstatusoutput(cmd)
-    sys.stderr.write(output + '\\n')
-    if status != 0:
-        sys.stderr.write("Command '%s' failed\\n" % cmd)
-        sys.stderr.write("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\\n")
-        sys.stderr.write("!!! Configure script exited prematurely !!!\\n")
-        sys.stderr.write("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\\n")
-        sys.exit(status)
+def process_form(form, config_get, out=None):
+    '''Process the fields of an upload request: a hw file, a log file
+or a failure report.'''
+    # Log form fields
+    for key in form:
+        if key == 'file':
+            log('form[%s]: %d bytes' % (key, field_size(form[key])))
+        else:
+            log('form[%s]: "%s"' % (key, form.getvalue(key)))
 
-def set_role(role, version, disk):
-    with open('/vars', 'a') as f:
-        f.write("ROLE=%s\\nVERS=%s\\nDISK=%s\\n" % (role,
-                                                    version,
-                                                    disk))
-        f.write("PROFILE=%s\\n" % var['edeploy-profile'])
+    section = form.getvalue('section', 'SERVER')
 
-def config(name, mode='w', basedir='/post_rsync', fmod=0644, uid=0, gid=0):
-    path = basedir + name
-    dir_ = '/'.join(path.split('/')[:-1])
-    if not os.path.exists(dir_):
-        os.makedirs(dir_)
-    f = open(path, mode)
-    os.fchmod(f.fileno(), fmod)
-    os.fchown(f.fileno(), uid, gid)
-    return f
+    # If the filename ends with a .log, we need to process it as a log file
+    if ('file' in form) and (form['file'].filename.endswith('.log.gz')):
+        save_log(config_get, section, get_cfg_dir(config_get, section),
+                 form['file'], out)
+        return
 
-var = ''')
+    if 'file' not in form:
+        fatal_error('No file passed to the CGI', out)
 
-    pprint.pprint(var)
+    process_hw(config_get, section, form['file'].file,
+               form.getvalue('failure', ''), out)
 
-    sys.stdout.write(cfg)
 
-    if use_pxemngr and pxemngr_url:
-        log("Adding pxemngr url to configure script: %s" % pxemngr_url)
-        print '''
-run('echo "PXEMNGR_URL=%s" >> /vars')
-''' % pxemngr_url
+def render_form(form, config_get):
+    '''Process the form and return the response body. Errors are
+reported in the body as for the CGI.'''
+    out = StringIO.StringIO()
+    try:
+        process_form(form, config_get, out)
+    except SystemExit:
+        pass
+    except Exception, err:
+        warning_error(str(err), out)
+    return out.getvalue()
 
-    if metadata_url:
-        log("Adding metadata url to configure script: %s" % metadata_url)
-        print '''
-run('echo "METADATA_URL=%s" >> /vars')
-''' % metadata_url
 
-    log('Sending configure script')
-    with open(state_filename, 'w') as state_file:
-        pprint.pprint(names, stream=state_file)
+def render_request(parse_form, config_get, content_length):
+    '''Return the response body of a request whose form is returned by
+parse_form, unless the request is rejected by check_request_size.'''
+    out = StringIO.StringIO()
+    try:
+        check_request_size(config_get, content_length, out)
+    except SystemExit:
+        return out.getvalue()
+    return render_form(parse_form(), config_get)
+
+
+# Size of the chunks sent to the clients
+_CHUNK_SIZE = 16384
+
+
+def accepts_gzip(accept_encoding):
+    'Test if an Accept-Encoding header value allows gzip.'
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() not in ('gzip', 'x-gzip', '*'):
+            continue
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    if float(value) == 0:
+                        break
+                except ValueError:
+                    break
+        else:
+            return True
+    return False
+
+
+def encode_response(body, accept_encoding=''):
+    '''Return the headers and the chunks of the response for body,
+compressed with gzip when accept_encoding allows it.'''
+    headers = [('Content-Type', 'text/x-python'),
+               ('Vary', 'Accept-Encoding')]
+    if accepts_gzip(accept_encoding):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(body) + compressor.flush()
+        headers.append(('Content-Encoding', 'gzip'))
+    headers.append(('Content-Length', str(len(body))))
+    return headers, [body[pos:pos + _CHUNK_SIZE]
+                     for pos in xrange(0, len(body), _CHUNK_SIZE)]
+
+
+def main():
+    '''CGI entry point.'''
+
+    config_get = load_config()
+
+    # parse hw file given in argument or passed to cgi script
+    if len(sys.argv) >= 3 and sys.argv[1] == '-f':
+        failure_role = ''
+        if len(sys.argv) >= 5 and sys.argv[3] == '-F':
+            failure_role = sys.argv[4]
+        try:
+            process_hw(config_get, 'SERVER', open(sys.argv[2]), failure_role)
+        except Exception, err:
+            fatal_error(str(err))
+        finally:
+            close_stdout()
+            run_hooks()
+    elif len(sys.argv) >= 3 and sys.argv[1] == '-s':
+        serve(sys.argv[2])
+    elif len(sys.argv) >= 2 and sys.argv[1] == '-H':
+        # retry the failed hooks, from cron when running as a CGI
+        get_hook_queue(config_get, 'SERVER',
+                       get_cfg_dir(config_get, 'SERVER'))
+        run_hooks()
+    else:
+        cgitb.enable()
+
+        log('Called from %s' % os.getenv('REMOTE_ADDR', '<no address>'))
+
+        headers, chunks = encode_response(
+            render_request(cgi.FieldStorage, config_get,
+                           os.getenv('CONTENT_LENGTH')),
+            os.getenv('HTTP_ACCEPT_ENCODING', ''))
+        for header in headers:
+            print '%s: %s' % header
+        print                                   # blank line, end of headers
+        sys.stdout.writelines(chunks)
+        close_stdout()
+        run_hooks()
+
+
+def application(environ, start_response):
+    '''WSGI entry point. Serves the same form protocol as the CGI entry
+point.'''
+    log('Called from %s' % environ.get('REMOTE_ADDR', '<no address>'))
+
+    def parse_form():
+        'Parse the form of the request.'
+        return cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ)
+    headers, chunks = encode_response(
+        render_request(parse_form, load_config(),
+                       environ.get('CONTENT_LENGTH')),
+        environ.get('HTTP_ACCEPT_ENCODING', ''))
+    start_response('200 OK', headers)
+    run_hooks(background=True)
+    return chunks
+
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn,
+                          wsgiref.simple_server.WSGIServer):
+    'WSGI server handling each request in its own thread.'
+    daemon_threads = True
+
+
+def serve(address):
+    'Run the WSGI application standalone on [address:]port.'
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+    else:
+        host, port = '', address
+    server = wsgiref.simple_server.make_server(
+        host, int(port), application, server_class=ThreadingWSGIServer)
+    log('Serving on %s:%s' % (host or '*', port))
+    server.serve_forever()
 
 if __name__ == "__main__":
     try:
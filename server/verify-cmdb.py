@@ -19,8 +19,8 @@
 import sys
 
 
-def generate(g):
-    return []
+def generate(model, overrides=None):
+    return (overrides or {}).values()
 
 key = sys.argv[1]
 val = sys.argv[2]
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+'''Compare the wire codecs of health_protocol.
+
+Typical messages are encoded and decoded with the pickle codec of the
+legacy protocol version and with the current binary codec.'''
+
+import getopt
+import glob
+import os
+import sys
+import time
+
+from health_messages import Health_Message as HM
+import health_protocol as HP
+
+_DIR = os.path.dirname(os.path.realpath(__file__))
+_SAMPLES = os.path.join(_DIR, '..', 'health', '*.hw')
+
+
+def print_help():
+    'Print the usage.'
+    print "bench-health-codec help"
+    print "======================="
+    print
+    print "bench-health-codec reports the frame size and the encoding and"
+    print "decoding throughput of the messages exchanged by health-client"
+    print "and health-server for the legacy pickle codec and the binary one."
+    print
+    print "-h                 : Print this help"
+    print "-n <count>         : Encodings per message (default: 2000)"
+    print
+    print "bench-health-codec -n 500 ../health/*.hw"
+
+
+def messages(hw):
+    'Return the (name, message) to measure with hw as the host profile.'
+    ack = HM(HM.ACK, HM.CPU, HM.START)
+    starting = HM(HM.MODULE, HM.CPU, HM.STARTING)
+    connect = HM(HM.CONNECT)
+    connect.hw = hw
+    connect.need_ack = True
+    network = HM(HM.MODULE, HM.NETWORK, HM.START)
+    network.running_time = 10
+    network.block_size = '0'
+    network.ports_list = dict((('10.0.0.%d' % idx, 4242), 10000 + idx)
+                              for idx in range(32))
+    network.peer_servers = [(('10.0.0.%d' % idx, 4242), '10.0.0.%d' % idx)
+                            for idx in range(32)]
+    network.my_peer_name = '10.0.0.1'
+    completed = HM(HM.MODULE, HM.CPU, HM.COMPLETED)
+    completed.hw = hw + [('cpu', 'logical', 'bogomips', '12345.67')]
+    return [('ACK', ack), ('STARTING', starting), ('CONNECT', connect),
+            ('NETWORK START', network), ('COMPLETED', completed)]
+
+
+def measure(msg, version, count):
+    '''Return the frame size and the messages encoded and decoded per
+second of msg with the version codec.'''
+    start = time.time()
+    for _ in xrange(count):
+        data = HP.encode_hm_message(msg, version)
+    encode_time = time.time() - start
+    payload = data[4:]
+    start = time.time()
+    for _ in xrange(count):
+        HP.decode_hm_message(payload)
+    decode_time = time.time() - start
+    return (len(data), count / max(encode_time, 1e-9),
+            count / max(decode_time, 1e-9))
+
+
+def main():
+    'Command line entry point.'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:')
+    except getopt.GetoptError, excpt:
+        print 'Error: %s' % excpt
+        print_help()
+        sys.exit(2)
+
+    count = 2000
+    for opt, arg in opts:
+        if opt == '-h':
+            print_help()
+            sys.exit(0)
+        elif opt == '-n':
+            count = int(arg)
+
+    filenames = []
+    for pattern in args or [_SAMPLES]:
+        filenames.extend(sorted(glob.glob(pattern)))
+    if not filenames:
+        sys.stderr.write('No sample .hw file found\n')
+        sys.exit(1)
+    hw = eval(open(filenames[0]).read(-1))
+
+    # peers of the legacy protocol send pickles
+    HP.ACCEPT_LEGACY = True
+    print '%-14s %-7s %8s %12s %12s' % ('message', 'codec', 'bytes',
+                                        'encode/s', 'decode/s')
+    for name, msg in messages(hw):
+        for codec, version in (('pickle', HP.LEGACY_VERSION),
+                               ('binary', HM.protocol_version)):
+            decoded = HP.decode_hm_message(
+                HP.encode_hm_message(msg, version)[4:])
+            if decoded.hw != msg.hw:
+                sys.stderr.write('%s: %s round trip failed\n' %
+                                 (name, codec))
+                sys.exit(1)
+            size, encoded, decoded = measure(msg, version, count)
+            print '%-14s %-7s %8d %12.0f %12.0f' % (name, codec, size,
+                                                    encoded, decoded)
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,7 @@ import atexit
 import json
 import logging
 import sys
+import time
 
 from socket import socket, AF_INET, SOCK_STREAM
 from health_messages import Health_Message as HM
@@ -31,6 +32,8 @@ import health_protocol as HP
 
 s = socket(AF_INET, SOCK_STREAM)
 connected = False
+clock_offset = 0
+clock_rtt = 0
 
 
 def invalid_message(msg):
@@ -149,6 +152,8 @@ def encode_hardware(hrdw_json, msg):
 def connect_to_server(hostname):
     global s
     global connected
+    global clock_offset
+    global clock_rtt
     try:
         s.connect((hostname, 20000))
     except:
@@ -162,6 +167,10 @@ def connect_to_server(hostname):
     hrdw_json = json.loads(open(sys.argv[1]).read(-1))
     encode_hardware(hrdw_json, msg)
 
+    # measured before CONNECT, whose ACK is delayed by the inventory upload
+    clock_offset, clock_rtt = HP.measure_peer_clock(s)
+    HP.logger.info("Clock offset with the server: %.6f (round trip %.6f)" %
+                   (clock_offset, clock_rtt))
     HP.send_hm_message(s, msg, True)
     while True:
         try:
@@ -183,8 +192,13 @@ def connect_to_server(hostname):
             return True
             break
 
-        hrdw_json = json.loads(open(sys.argv[1]).read(-1))
-        encode_hardware(hrdw_json, msg)
+        # the server keeps the inventory sent with CONNECT so only the
+        # results of the benchmarks are sent back
+        msg.hw = []
+        msg.hw_delta = True
+        # used to start the benchmarks at the time asked by the server
+        msg.clock_offset = clock_offset
+        msg.clock_rtt = clock_rtt
 
         handlers = {HM.NONE: none,
                     HM.CONNECT: connect,
@@ -16,11 +16,9 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-from SocketServer import BaseRequestHandler, ThreadingTCPServer
 import ConfigParser
-import socket
-import struct
 from health_messages import Health_Message as HM
+import health_core as HC
 import health_libs as HL
 import health_protocol as HP
 import logging
@@ -35,11 +33,7 @@ import shutil
 import getopt
 
 
-socket_list = {}
-lock_socket_list = threading.RLock()
-hosts = {}
-lock_host = threading.RLock()
-hosts_state = {}
+registry = HC.HostRegistry()
 results_cpu = {}
 results_memory = {}
 results_network = {}
@@ -86,8 +80,9 @@ def disable_jitter():
     running_jitter = False
 
 
-def start_time(host):
-    timestamp = time.time()
+def start_time(host, timestamp=None):
+    if timestamp is None:
+        timestamp = time.time()
 
     global start_jitter
     if host not in start_jitter:
@@ -103,122 +98,71 @@ def stop_time(host):
     stop_jitter[host] = timestamp
 
 
-class SocketHandler(BaseRequestHandler):
-    global hosts
-    global lock_host
-    timeout = 5
-    disable_nagle_algorithm = False  # Set TCP_NODELAY socket option
-
-    def handle(self):
-        lock_socket_list.acquire()
-        socket_list[self.client_address] = self.request
-        lock_socket_list.release()
-
-        HP.logger.debug('Got connection from %s' % self.client_address[0])
-        while True:
-            msg = HP.recv_hm_message(socket_list[self.client_address])
-            if not msg:
-                continue
-            if msg.message != HM.ACK:
-
-                # If we do receive a STARTING message, let's record the starting time
-                # No need to continue processing the packet, we can wait the next one
-                if msg.action == HM.STARTING:
-                    start_time(self.client_address)
-                    continue
-
-                if msg.message == HM.DISCONNECT:
-                    HP.logger.debug('Disconnecting from %s' %
-                                    self.client_address[0])
+def schedule_start(host, msg, start):
+    '''Send a START message asking host to begin at the server time start
+    and record its expected start.'''
+    start_time(host, registry.schedule_start(host, msg, start))
 
-                    lock_host.acquire()
-                    del hosts[self.client_address]
-                    del hosts_state[self.client_address]
-                    lock_host.release()
 
-                    socket_list[self.client_address].close()
+def handle_message(host, msg):
+    # If we do receive a STARTING message, let's record the starting time
+    # No need to continue processing the packet, we can wait the next one
+    if msg.action == HM.STARTING:
+        start_time(host, HC.started_at(host, msg))
+        return
 
-                    lock_socket_list.acquire()
-                    del socket_list[self.client_address]
-                    lock_socket_list.release()
-                    return
-                else:
-                    lock_host.acquire()
-                    hosts[self.client_address] = msg
-                    hosts_state[self.client_address] = NOTHING_RUN
-                    lock_host.release()
+    registry.update(host, msg)
 
-                    if msg.message == HM.MODULE and msg.action == HM.COMPLETED:
-                        if running_jitter is True:
-                            stop_time(self.client_address)
+    if msg.message == HM.MODULE and msg.action == HM.COMPLETED:
+        if running_jitter is True:
+            stop_time(host)
 
-                        if msg.module == HM.CPU:
-                            cpu_completed(self.client_address, msg)
-                        elif msg.module == HM.MEMORY:
-                            memory_completed(self.client_address, msg)
-                        elif msg.module == HM.NETWORK:
-                            network_completed(self.client_address, msg)
-                        elif msg.module == HM.STORAGE:
-                            storage_completed(self.client_address, msg)
+        if msg.module == HM.CPU:
+            cpu_completed(host, msg)
+        elif msg.module == HM.MEMORY:
+            memory_completed(host, msg)
+        elif msg.module == HM.NETWORK:
+            network_completed(host, msg)
+        elif msg.module == HM.STORAGE:
+            storage_completed(host, msg)
 
 
 def createAndStartServer():
     global serv
-    ThreadingTCPServer.allow_reuse_address = True
-    serv = ThreadingTCPServer(('', 20000), SocketHandler,
-                              bind_and_activate=False)
-    l_onoff = 1
-    l_linger = 0
-    serv.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
-                           struct.pack('ii', l_onoff, l_linger))
-    serv.server_bind()
-    serv.server_activate()
-    HP.logger.info('Starting server')
+    serv = HC.EventServer(('', 20000), registry, handle_message)
     serv.serve_forever()        # blocking method
 
 
 def cpu_completed(host, msg):
-    global hosts_state
     global results_cpu
-    hosts_state[host] &= ~CPU_RUN
+    registry.clear_running(host, CPU_RUN)
     results_cpu[host] = msg.hw
 
 
 def memory_completed(host, msg):
-    global hosts_state
     global results_memory
-    hosts_state[host] &= ~MEMORY_RUN
+    registry.clear_running(host, MEMORY_RUN)
     results_memory[host] = msg.hw
 
 
 def network_completed(host, msg):
-    global hosts_state
     global results_network
-    hosts_state[host] &= ~NETWORK_RUN
+    registry.clear_running(host, NETWORK_RUN)
     results_network[host] = msg.hw
 
 
 def storage_completed(host, msg):
-    global hosts_state
     global results_storage
-    hosts_state[host] &= ~STORAGE_RUN
+    registry.clear_running(host, STORAGE_RUN)
     results_storage[host] = msg.hw
 
 
 def get_host_list(item):
-    global hosts
-    global hosts_state
-    selected_hosts = {}
-    for host in hosts.keys():
-        if hosts_state[host] & item == item:
-            selected_hosts[host] = True
-
-    return selected_hosts
+    return dict.fromkeys(registry.running(item), True)
 
 
 def compute_affinity(bench=[]):
     affinity = {}
-    global hosts
 
     def acceptable_host(host_list, host):
         if (len(host_list) == 0):
@@ -227,8 +171,8 @@ def compute_affinity(bench=[]):
             return True
         return False
 
-    for host in hosts.keys():
-        hw = hosts[host].hw
+    for host in registry.addresses():
+        hw = registry.hw(host)
         system_id = HL.get_value(hw, "system", "product", "serial")
 
         if len(bench) > 0:
@@ -311,8 +255,8 @@ def dump_affinity(bench, bench_type):
 
 
 def start_cpu_bench(bench):
-    global hosts_state
     nb_hosts = bench['nb-hosts']
+    start = time.time() + bench['start-delay']
     msg = HM(HM.MODULE, HM.CPU, HM.START)
     msg.cpu_instances = bench['cores']
     msg.running_time = bench['runtime']
@@ -321,17 +265,14 @@ def start_cpu_bench(bench):
         if nb_hosts == 0:
             break
         if host not in get_host_list(CPU_RUN).keys():
-            hosts_state[host] |= CPU_RUN
+            registry.set_running(host, CPU_RUN)
             nb_hosts = nb_hosts - 1
-            lock_socket_list.acquire()
-            start_time(host)
-            HP.send_hm_message(socket_list[host], msg)
-            lock_socket_list.release()
+            schedule_start(host, msg, start)
 
 
 def start_memory_bench(bench):
-    global hosts_state
     nb_hosts = bench['nb-hosts']
+    start = time.time() + bench['start-delay']
     msg = HM(HM.MODULE, HM.MEMORY, HM.START)
     msg.cpu_instances = bench['cores']
     msg.block_size = bench['block-size']
@@ -342,17 +283,14 @@ def start_memory_bench(bench):
         if nb_hosts == 0:
             break
         if host not in get_host_list(MEMORY_RUN).keys():
-            hosts_state[host] |= MEMORY_RUN
+            registry.set_running(host, MEMORY_RUN)
             nb_hosts = nb_hosts - 1
-            lock_socket_list.acquire()
-            start_time(host)
-            HP.send_hm_message(socket_list[host], msg)
-            lock_socket_list.release()
+            schedule_start(host, msg, start)
 
 
 def start_storage_bench(bench):
-    global hosts_state
     nb_hosts = bench['nb-hosts']
+    start = time.time() + bench['start-delay']
     msg = HM(HM.MODULE, HM.STORAGE, HM.START)
     msg.block_size = bench['block-size']
     msg.access = bench['access']
@@ -365,16 +303,12 @@ def start_storage_bench(bench):
         if nb_hosts == 0:
             break
         if host not in get_host_list(STORAGE_RUN).keys():
-            hosts_state[host] |= STORAGE_RUN
+            registry.set_running(host, STORAGE_RUN)
             nb_hosts = nb_hosts - 1
-            lock_socket_list.acquire()
-            start_time(host)
-            HP.send_hm_message(socket_list[host], msg)
-            lock_socket_list.release()
+            schedule_start(host, msg, start)
 
 
 def prepare_network_bench(bench, mode):
-    global hosts_state
     nb_hosts = bench['nb-hosts']
     msg = HM(HM.MODULE, HM.NETWORK, mode)
     msg.network_test = bench['mode']
@@ -387,12 +321,10 @@ def prepare_network_bench(bench, mode):
             if nb_hosts == 0:
                 break
             if host not in get_host_list(NETWORK_RUN).keys():
-                hosts_state[host] |= NETWORK_RUN
+                registry.set_running(host, NETWORK_RUN)
                 nb_hosts = nb_hosts - 1
-                lock_socket_list.acquire()
                 msg.my_peer_name = bench['ip-list'][host]
-                HP.send_hm_message(socket_list[host], msg)
-                lock_socket_list.release()
+                registry.send(host, msg)
 
     string_mode = ""
     if mode == HM.INIT:
@@ -413,8 +345,8 @@ def prepare_network_bench(bench, mode):
 
 
 def start_network_bench(bench):
-    global hosts_state
     nb_hosts = bench['nb-hosts']
+    start = time.time() + bench['start-delay']
     msg = HM(HM.MODULE, HM.NETWORK, HM.START)
     msg.block_size = bench['block-size']
     msg.running_time = bench['runtime']
@@ -444,11 +376,8 @@ def start_network_bench(bench):
                     for peer_server in arity_group:
                         if peer_server not in get_host_list(NETWORK_RUN).keys():
                             msg.my_peer_name = bench['ip-list'][peer_server]
-                            hosts_state[peer_server] |= NETWORK_RUN
-                            lock_socket_list.acquire()
-                            start_time(peer_server)
-                            HP.send_hm_message(socket_list[peer_server], msg)
-                            lock_socket_list.release()
+                            registry.set_running(peer_server, NETWORK_RUN)
+                            schedule_start(peer_server, msg, start)
                     arity_group = []
                     ip_list = {}
                 # We shall break to switch to another hypervisor
@@ -459,21 +388,17 @@ def start_network_bench(bench):
 
 def disconnect_clients():
     global serv
-    global hosts
     msg = HM(HM.DISCONNECT)
-    HP.logger.info("Asking %d hosts to disconnect" % len(hosts.keys()))
-    for host in hosts.keys():
-        lock_socket_list.acquire()
-        HP.send_hm_message(socket_list[host], msg)
-        lock_socket_list.release()
+    HP.logger.info("Asking %d hosts to disconnect" % registry.count())
+    for host in registry.addresses():
+        registry.send(host, msg)
 
-    while(hosts.keys()):
+    while(registry.count()):
         time.sleep(1)
-        HP.logger.info("Still %d hosts connected" % len(hosts.keys()))
+        HP.logger.info("Still %d hosts connected" % registry.count())
 
     HP.logger.info("All hosts disconnected")
     serv.shutdown()
-    serv.socket.close()
 
 
 def save_hw(items, name, hwdir):
@@ -486,10 +411,9 @@ def save_hw(items, name, hwdir):
 
 
 def dump_hosts(log_dir):
-    global hosts
     unique_hosts_list = []
-    for host in hosts.keys():
-        uuid = HL.get_value(hosts[host].hw, "system", "product", "serial")
+    for host in registry.addresses():
+        uuid = HL.get_value(registry.hw(host), "system", "product", "serial")
         if uuid not in unique_hosts_list:
             unique_hosts_list.append(uuid)
     pprint.pprint(unique_hosts_list, stream=open(log_dir+"/hosts", 'w'))
@@ -621,6 +545,8 @@ def parse_job_config(bench, job, component, log_dir):
     bench['name'] = get_default_value(job, 'name', '')
     bench['affinity'] = get_default_value(job, 'affinity', SCHED_FAIR)
     bench['runtime'] = get_default_value(job, 'runtime', bench['runtime'])
+    bench['start-delay'] = get_default_value(job, 'start-delay',
+                                             bench['start-delay'])
     affinity_list = get_default_value(job, 'affinity-hosts', '')
     affinity_hosts = []
     if affinity_list:
@@ -669,7 +595,8 @@ def select_vms_from_networks(bench):
     hosts_selected_ip = {}
     for hv in bench['hosts-list']:
         for host in bench['hosts-list'][hv]:
-            ipv4_list = HL.get_multiple_values(hosts[host].hw, "network", "*", "ipv4")
+            ipv4_list = HL.get_multiple_values(registry.hw(host), "network",
+                                               "*", "ipv4")
             match_network = False
             # Let's check if one of the IP of a host match at least one network
             # If so, let's save the resulting IP
@@ -929,7 +856,6 @@ def do_cpu_job(bench_all, current_job, log_dir, total_runtime):
 
 
 def non_interactive_mode(filename, title):
-    global hosts
     total_runtime = 0
     name = "undefined"
     bench_all = {}
@@ -956,6 +882,7 @@ def non_interactive_mode(filename, title):
         return
 
     bench_all['runtime'] = get_default_value(job, 'runtime', 10)
+    bench_all['start-delay'] = get_default_value(job, 'start-delay', 2)
     bench_all['required-hypervisors'] = get_default_value(job, 'required-hypervisors', 0)
 
     log_dir = prepare_log_dir(name)
@@ -969,14 +896,14 @@ def non_interactive_mode(filename, title):
     else:
         HP.logger.info("Expecting %d hosts to start job %s" %
                        (bench_all['required-hosts'], name))
-    hosts_count = len(hosts.keys())
+    hosts_count = registry.count()
     previous_hosts_count = hosts_count
     while (int(hosts_count) < bench_all['required-hosts']):
         if (hosts_count != previous_hosts_count):
             HP.logger.info("Still %d hosts to connect" % (bench_all['required-hosts'] - int(hosts_count)))
             previous_hosts_count = hosts_count
             dump_hosts(log_dir)
-        hosts_count = len(hosts.keys())
+        hosts_count = registry.count()
         time.sleep(1)
 
     dump_hosts(log_dir)
@@ -19,6 +19,7 @@ from health_messages import Health_Message as HM
 import health_protocol as HP
 import health_libs as HL
 import logging
+import time
 
 
 class Health_Bench():
@@ -55,10 +56,19 @@ class Health_Bench():
         HL.check_mce_status(self.message.hw)
         HP.send_hm_message(self.socket, self.message)
 
+    def wait_start(self):
+        '''Wait for the start time asked by the server, converted to the
+        local clock.'''
+        delay = HP.wait_start(self.message)
+        if delay < 0:
+            self.logger.warning("Starting %.3f seconds late" % -delay)
+
     def starting(self, module):
+        self.wait_start()
         self.message.message = HM.MODULE
         self.message.module = module
         self.message.action = HM.STARTING
+        self.message.timestamp = time.time()
         HP.send_hm_message(self.socket, self.message)
 
     def __init__(self, msg, socket, logger):
@@ -0,0 +1,385 @@
+#
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+'''Event driven core of the health server.
+
+A single thread multiplexes the sockets of all the health clients with
+epoll (or poll) and decodes their Health_Message. The connected hosts
+and their state are kept in a HostRegistry which other threads use to
+select hosts and to queue messages for them.'''
+
+import errno
+import fcntl
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from health_messages import Health_Message as HM
+import health_protocol as HP
+
+_WRITE_SIZE = 65536
+# reads per poll event so a busy client does not starve the others
+_MAX_READS = 16
+
+# first protocol version able to start the benchmarks at a given time
+SCHEDULED_START_VERSION = 5
+# start skew tolerated before warning, in seconds
+MAX_CLOCK_ERROR = 0.01
+
+_EVENTS_IN = select.POLLIN | select.POLLPRI
+_EVENTS_ERR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+
+class Host(object):
+    '''State of a connected health client. hw is the inventory sent with
+CONNECT, msg is the last message received from the host and state is a
+mask of the benchmarks running on it.'''
+
+    def __init__(self, address, connection):
+        self.address = address
+        self.connection = connection
+        self.hw = []
+        self.msg = None
+        self.state = 0
+
+
+class HostRegistry(object):
+    '''Hosts connected to the server. The methods can be called from any
+thread.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def register(self, address, connection):
+        'Record a new connection.'
+        with self._lock:
+            self._hosts[address] = Host(address, connection)
+
+    def unregister(self, address):
+        'Forget a closed connection.'
+        with self._lock:
+            self._hosts.pop(address, None)
+
+    def update(self, address, msg):
+        '''Record the last message of a host and reset its state. The hw
+of a message holding a delta is completed with the inventory.'''
+        with self._lock:
+            host = self._hosts[address]
+            if msg.hw_delta:
+                msg.hw = host.hw + msg.hw
+                msg.hw_delta = False
+            elif msg.message == HM.CONNECT:
+                host.hw = msg.hw
+            host.msg = msg
+            host.state = 0
+
+    def addresses(self):
+        'Return the addresses of the hosts which sent a message.'
+        with self._lock:
+            return [address for address, host in self._hosts.items()
+                    if host.msg is not None]
+
+    def count(self):
+        'Return the number of hosts which sent a message.'
+        return len(self.addresses())
+
+    def hw(self, address):
+        'Return the hardware description sent by a host.'
+        with self._lock:
+            return self._hosts[address].hw
+
+    def version(self, address):
+        'Return the protocol version of a host.'
+        with self._lock:
+            return self._hosts[address].connection.version
+
+    def running(self, item):
+        'Return the addresses of the hosts running all the item benchmarks.'
+        with self._lock:
+            return [address for address, host in self._hosts.items()
+                    if host.msg is not None and host.state & item == item]
+
+    def set_running(self, address, item):
+        'Mark the item benchmarks as running on a host.'
+        with self._lock:
+            self._hosts[address].state |= item
+
+    def clear_running(self, address, item):
+        'Mark the item benchmarks as done on a host.'
+        with self._lock:
+            host = self._hosts.get(address)
+            if host:
+                host.state &= ~item
+
+    def send(self, address, msg):
+        '''Queue a message for a host. It is encoded at once so msg can be
+modified afterwards.'''
+        msg.need_ack = False
+        HP.logger.debug("Sent %s/%s/%s to %s" %
+                        (msg.get_message_type(), msg.get_module_type(),
+                         msg.get_action_type(), address))
+        with self._lock:
+            connection = self._hosts[address].connection
+        connection.send(HP.encode_hm_message(msg, connection.version))
+
+    def schedule_start(self, address, msg, start):
+        '''Send a START message asking a host to begin at the server time
+start. Hosts of older protocol versions begin at once. Return the time
+at which the host is expected to start.'''
+        if self.version(address) >= SCHEDULED_START_VERSION:
+            msg.start_at = start
+        else:
+            msg.start_at = 0
+            start = time.time()
+        self.send(address, msg)
+        return start
+
+
+def started_at(address, msg):
+    '''Return the server time at which a host started the benchmark of a
+STARTING message.'''
+    if not msg.timestamp:
+        return time.time()
+    started = msg.timestamp + msg.clock_offset
+    if msg.clock_rtt / 2.0 > MAX_CLOCK_ERROR:
+        HP.logger.warning("Clock offset of %s only known within %.3f seconds"
+                          % (str(address), msg.clock_rtt / 2.0))
+    if msg.start_at and abs(started - msg.start_at) > MAX_CLOCK_ERROR:
+        HP.logger.warning("%s started %.3f seconds after the expected time"
+                          % (str(address), started - msg.start_at))
+    return started
+
+
+class _Connection(object):
+    'Buffers of a client socket.'
+
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.reader = HP.FrameReader()
+        self.outbuf = bytearray()
+        self.lock = threading.Lock()
+        # protocol version of the last message received from the peer
+        self.version = HM.protocol_version
+
+    def send(self, data):
+        'Queue data to send from any thread.'
+        with self.lock:
+            self.outbuf.extend(data)
+        self.server.want_write(self)
+
+    def read(self):
+        'Read what is available. Return the complete messages received.'
+        messages = []
+        for _ in xrange(_MAX_READS):
+            try:
+                msg = self.reader.recv(self.sock)
+            except socket.error, xcpt:
+                if xcpt.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            except EOFError:
+                # process the messages received before, the end of file
+                # is reported again by the next poll
+                if messages:
+                    break
+                raise
+            if msg is not None:
+                messages.append(msg)
+        return messages
+
+    def write(self):
+        'Send what can be sent. Return True if nothing is left to send.'
+        with self.lock:
+            try:
+                sent = self.sock.send(bytes(self.outbuf[:_WRITE_SIZE]))
+            except socket.error, xcpt:
+                if xcpt.errno in (errno.EAGAIN, errno.EINTR):
+                    return False
+                raise
+            del self.outbuf[:sent]
+            return not self.outbuf
+
+
+def _set_nonblocking(fd):
+    'Set the O_NONBLOCK flag of a file descriptor.'
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class EventServer(object):
+    '''Accept the health clients on address and call handler(address,
+msg) from the event loop for each valid message except ACK and
+DISCONNECT. ACK and NACK replies are sent by the server, which also
+closes the connections on DISCONNECT.'''
+
+    def __init__(self, address, registry, handler, backlog=128):
+        self.registry = registry
+        self.handler = handler
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        l_onoff = 1
+        l_linger = 0
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                               struct.pack('ii', l_onoff, l_linger))
+        self.socket.bind(address)
+        self.socket.listen(backlog)
+        self.socket.setblocking(0)
+        self.address = self.socket.getsockname()
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+        else:
+            self._poller = select.poll()
+        self._poller.register(self.socket.fileno(), _EVENTS_IN)
+        self._wake_r, self._wake_w = os.pipe()
+        _set_nonblocking(self._wake_r)
+        _set_nonblocking(self._wake_w)
+        self._poller.register(self._wake_r, _EVENTS_IN)
+        self._wake_lock = threading.Lock()
+        self._connections = {}
+        self._writers = set()
+        self._writers_lock = threading.Lock()
+        self._running = False
+
+    def _wake(self):
+        'Interrupt the poll of the event loop.'
+        with self._wake_lock:
+            # the event loop is already stopped
+            if self._wake_w is None:
+                return
+            try:
+                os.write(self._wake_w, 'x')
+            except OSError, xcpt:
+                # the pipe is already full of wake ups
+                if xcpt.errno != errno.EAGAIN:
+                    raise
+
+    def want_write(self, connection):
+        'Ask the event loop to send the queued data of a connection.'
+        with self._writers_lock:
+            self._writers.add(connection)
+        self._wake()
+
+    def shutdown(self):
+        'Stop the event loop and close all the sockets.'
+        self._running = False
+        self._wake()
+
+    def _accept(self):
+        'Accept the pending connections.'
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error, xcpt:
+                if xcpt.errno in (errno.EAGAIN, errno.EINTR,
+                                  errno.ECONNABORTED):
+                    return
+                raise
+            sock.setblocking(0)
+            connection = _Connection(self, sock, address)
+            self._connections[sock.fileno()] = connection
+            self.registry.register(address, connection)
+            self._poller.register(sock.fileno(), _EVENTS_IN)
+            HP.logger.debug('Got connection from %s' % address[0])
+
+    def _close(self, connection):
+        'Close a connection and forget its host.'
+        fileno = connection.sock.fileno()
+        self._poller.unregister(fileno)
+        del self._connections[fileno]
+        self.registry.unregister(connection.address)
+        connection.sock.close()
+
+    def _start_writers(self):
+        'Poll for output the connections with data to send.'
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except OSError, xcpt:
+            if xcpt.errno != errno.EAGAIN:
+                raise
+        with self._writers_lock:
+            writers = self._writers
+            self._writers = set()
+        for connection in writers:
+            fileno = connection.sock.fileno()
+            if self._connections.get(fileno) is connection:
+                self._poller.modify(fileno, _EVENTS_IN | select.POLLOUT)
+
+    def _receive(self, connection):
+        'Process the messages received on a connection.'
+        for msg in connection.read():
+            connection.version = msg.protocol_version
+            reply = HP.check_hm_message(msg, connection.address)
+            if reply is not None:
+                connection.send(HP.encode_hm_message(reply,
+                                                     connection.version))
+            if msg.message == HM.DISCONNECT:
+                HP.logger.debug('Disconnecting from %s' %
+                                connection.address[0])
+                raise EOFError()
+            # NONE messages only measure the clock (measure_peer_clock)
+            if msg.message not in (HM.INVALID, HM.ACK, HM.NONE):
+                self.handler(connection.address, msg)
+
+    def _process(self, fileno, event):
+        'Process an event of a client socket.'
+        connection = self._connections.get(fileno)
+        if connection is None:
+            return
+        try:
+            if event & select.POLLOUT and connection.write():
+                self._poller.modify(fileno, _EVENTS_IN)
+            if event & (_EVENTS_IN | _EVENTS_ERR):
+                self._receive(connection)
+        except EOFError:
+            self._close(connection)
+        except Exception, xcpt:
+            HP.logger.error('Closing connection from %s: %s' %
+                            (connection.address[0], str(xcpt)))
+            self._close(connection)
+
+    def serve_forever(self):
+        'Run the event loop until shutdown is called.'
+        HP.logger.info('Starting server')
+        self._running = True
+        while self._running:
+            try:
+                events = self._poller.poll(-1)
+            except (IOError, select.error), xcpt:
+                if xcpt.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fileno, event in events:
+                if fileno == self.socket.fileno():
+                    self._accept()
+                elif fileno == self._wake_r:
+                    self._start_writers()
+                else:
+                    self._process(fileno, event)
+        for connection in self._connections.values():
+            self._close(connection)
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
+        self.socket.close()
+        with self._wake_lock:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_w = None
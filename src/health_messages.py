@@ -17,7 +17,7 @@
 
 
 class Health_Message():
-    protocol_version = 3
+    protocol_version = 5
 
     INVALID = 0
     NONE = 1 << 0
@@ -82,6 +82,16 @@ class Health_Message():
 
     need_ack = False
     hw = []
+    # hw only holds the items added to the inventory sent with CONNECT
+    hw_delta = False
+
+    # time of the sender when an ACK or a STARTING message is sent
+    timestamp = 0
+    # time of the server at which a START has to begin (0: at once)
+    start_at = 0
+    # server time minus client time and round trip of its measure
+    clock_offset = 0
+    clock_rtt = 0
 
     running_time = 0
     cpu_instances = 0
@@ -20,6 +20,7 @@ import logging
 import pickle
 import socket
 import struct
+import time
 import zlib
 from health_messages import Health_Message as HM
 logger = 0
@@ -41,16 +42,415 @@ def start_log(filename, level=logging.INFO):
     logger.info('Starting logger')
 
 
+# Protocol versions up to LEGACY_VERSION send zlib compressed pickles of
+# the messages. Newer versions send a header with the message, module and
+# action followed by the other attributes of the message encoded by
+# _Encoder. Bodies bigger than COMPRESS_MIN bytes are compressed.
+LEGACY_VERSION = 3
+COMPRESS_MIN = 1024
+# refuse the frames announcing a bigger payload
+MAX_FRAME = 64 * 1024 * 1024
+# allow to unpickle the messages of the peers using LEGACY_VERSION
+ACCEPT_LEGACY = True
+
+_MAGIC = 0xed
+_HEADER = struct.Struct('!BBBHHH')
+_FLAG_ACK = 1 << 0
+_FLAG_ZLIB = 1 << 1
+_HEADER_FIELDS = ('message', 'module', 'action', 'need_ack',
+                  'protocol_version')
+# attributes accepted in the body, declared with their default value in
+# Health_Message
+_BODY_FIELDS = frozenset(('hw', 'hw_delta', 'timestamp', 'start_at',
+                          'clock_offset', 'clock_rtt', 'running_time',
+                          'cpu_instances', 'block_size', 'mode', 'access',
+                          'device', 'rampup_time', 'network_test',
+                          'network_connection', 'ports_list',
+                          'peer_servers', 'my_peer_name', 'port_base'))
+
+# protocol version of the peers of the blocking sockets
+_peer_versions = {}
+
+_LENGTH = struct.Struct('!I')
+_INT = struct.Struct('!q')
+_FLOAT = struct.Struct('!d')
+
+
+class _Encoder(object):
+    '''Compact binary encoding of the python values used in the messages.
+Each value starts with a one byte tag. Strings are interned: a string
+already seen in the body is sent as its index in the table of the
+strings seen so far, which shrinks the repeated keys of the hw lists.'''
+
+    def __init__(self):
+        self.out = []
+        self.strings = {}
+
+    def varint(self, value):
+        'Append an unsigned integer in 7 bits groups.'
+        out = self.out
+        while value > 0x7f:
+            out.append(chr(0x80 | (value & 0x7f)))
+            value >>= 7
+        out.append(chr(value))
+
+    def encode(self, value):
+        'Append a value.'
+        out = self.out
+        if isinstance(value, str):
+            index = self.strings.get(value)
+            if index is None:
+                self.strings[value] = len(self.strings)
+                out.append('s')
+                self.varint(len(value))
+                out.append(value)
+            else:
+                out.append('r')
+                self.varint(index)
+        elif value is None:
+            out.append('N')
+        elif value is True:
+            out.append('T')
+        elif value is False:
+            out.append('F')
+        elif isinstance(value, (int, long)):
+            if -(1 << 63) <= value < (1 << 63):
+                out.append('i')
+                out.append(_INT.pack(value))
+            else:
+                out.append('L')
+                self.encode(str(value))
+        elif isinstance(value, float):
+            out.append('d')
+            out.append(_FLOAT.pack(value))
+        elif isinstance(value, unicode):
+            out.append('u')
+            self.encode(value.encode('utf-8'))
+        elif isinstance(value, (tuple, list)):
+            out.append('t' if isinstance(value, tuple) else 'l')
+            self.varint(len(value))
+            for item in value:
+                self.encode(item)
+        elif isinstance(value, dict):
+            out.append('m')
+            self.varint(len(value))
+            for key, item in value.items():
+                self.encode(key)
+                self.encode(item)
+        else:
+            raise TypeError('Cannot encode %r' % (value,))
+
+
+class _Decoder(object):
+    'Decoding of the values encoded by _Encoder.'
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.strings = []
+
+    def read(self, size):
+        'Return the next size bytes.'
+        end = self.pos + size
+        if end > len(self.data):
+            raise ValueError('Truncated message')
+        value = self.data[self.pos:end]
+        self.pos = end
+        return value
+
+    def varint(self):
+        'Return an unsigned integer.'
+        value = shift = 0
+        while True:
+            try:
+                byte = ord(self.data[self.pos])
+            except IndexError:
+                raise ValueError('Truncated message')
+            self.pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def decode(self):
+        'Return the next value.'
+        try:
+            tag = self.data[self.pos]
+        except IndexError:
+            raise ValueError('Truncated message')
+        self.pos += 1
+        # most of the strings of the hw lists are references
+        if tag == 'r':
+            index = self.varint()
+            if index >= len(self.strings):
+                raise ValueError('Invalid string reference %d' % index)
+            return self.strings[index]
+        elif tag == 's':
+            value = self.read(self.varint())
+            self.strings.append(value)
+            return value
+        elif tag == 't':
+            return tuple([self.decode() for _ in xrange(self.varint())])
+        elif tag == 'N':
+            return None
+        elif tag == 'T':
+            return True
+        elif tag == 'F':
+            return False
+        elif tag == 'i':
+            return _INT.unpack(self.read(_INT.size))[0]
+        elif tag == 'L':
+            return long(self.decode())
+        elif tag == 'd':
+            return _FLOAT.unpack(self.read(_FLOAT.size))[0]
+        elif tag == 'u':
+            return self.decode().decode('utf-8')
+        elif tag == 'l':
+            return [self.decode() for _ in xrange(self.varint())]
+        elif tag == 'm':
+            value = {}
+            for _ in xrange(self.varint()):
+                key = self.decode()
+                value[key] = self.decode()
+            return value
+        raise ValueError('Invalid tag %r' % tag)
+
+
+def encode_hm_message(data, version=HM.protocol_version):
+    '''Return the bytes sent on the wire for a message to a peer using
+    the version protocol.'''
+    if version <= LEGACY_VERSION:
+        to_be_sent = zlib.compress(pickle.dumps(data))
+        return struct.pack('!I', len(to_be_sent)) + to_be_sent
+    attrs = dict((key, value) for key, value in vars(data).items()
+                 if key not in _HEADER_FIELDS)
+    flags = _FLAG_ACK if data.need_ack else 0
+    body = ''
+    if attrs:
+        encoder = _Encoder()
+        encoder.encode(attrs)
+        body = ''.join(encoder.out)
+        if len(body) > COMPRESS_MIN:
+            body = zlib.compress(body)
+            flags |= _FLAG_ZLIB
+    header = _HEADER.pack(_MAGIC, HM.protocol_version, flags, data.message,
+                          data.module, data.action)
+    return struct.pack('!I', _HEADER.size + len(body)) + header + body
+
+
+def _is_legacy(payload):
+    'Tell if a payload is a pickle of the legacy protocol.'
+    if payload[0] in (_MAGIC, chr(_MAGIC)):
+        return False
+    if not ACCEPT_LEGACY:
+        raise ValueError('Legacy message refused')
+    return True
+
+
+def _decode_legacy(pickled):
+    'Return the message of an uncompressed legacy payload.'
+    msg = pickle.loads(pickled)
+    msg.protocol_version = LEGACY_VERSION
+    return msg
+
+
+def _decode_header(payload):
+    '''Return the message built from the header of a payload and the
+    flags of the header.'''
+    if len(payload) < _HEADER.size:
+        raise ValueError('Truncated message')
+    _, version, flags, message, module, action = \
+        _HEADER.unpack_from(payload)
+    msg = HM(message, module, action)
+    msg.need_ack = bool(flags & _FLAG_ACK)
+    msg.protocol_version = version
+    return msg, flags
+
+
+def decode_hm_message(payload):
+    '''Return the message of a payload received after its length. Its
+    protocol_version attribute is the version used by the peer.'''
+    if _is_legacy(payload):
+        return _decode_legacy(zlib.decompress(payload))
+    msg, flags = _decode_header(payload)
+    body = payload[_HEADER.size:]
+    if body and flags & _FLAG_ZLIB:
+        body = zlib.decompress(body)
+    return _decode_body(msg, body)
+
+
+def _decode_body(msg, body):
+    '''Set the attributes of msg encoded in an uncompressed body. Only
+    the _BODY_FIELDS are set, the other attributes sent by the peer are
+    ignored.'''
+    if body:
+        decoder = _Decoder(body)
+        attrs = decoder.decode()
+        if not isinstance(attrs, dict) or decoder.pos != len(body):
+            raise ValueError('Invalid message body')
+        for key, value in attrs.items():
+            if key in _BODY_FIELDS:
+                setattr(msg, key, value)
+            else:
+                logger.debug('Ignoring the unknown field %r' % (key,))
+    return msg
+
+
+class FrameReader(object):
+    '''Incremental reader of the frames of a stream. The payload of a
+frame is received with recv_into in a bytearray of its announced length
+and compressed payloads are decompressed as they arrive.'''
+
+    def __init__(self):
+        self._length = bytearray(_LENGTH.size)
+        self._reset()
+
+    def _reset(self):
+        'Wait for the length of the next frame.'
+        self._buf = self._length
+        self._view = memoryview(self._buf)
+        self._pos = 0
+        self._in_payload = False
+        self._inflater = None
+        self._fed = 0
+        self._chunks = []
+
+    def started(self):
+        'Tell if a part of a frame was received.'
+        return self._pos > 0 or self._in_payload
+
+    def recv(self, sock):
+        '''Receive the available data of the current frame from sock.
+Return the decoded message when the frame is complete, else None. Raise
+EOFError when the peer closed the connection.'''
+        nbytes = sock.recv_into(self._view[self._pos:])
+        if nbytes == 0:
+            raise EOFError()
+        self._pos += nbytes
+        if self._in_payload:
+            self._inflate()
+        if self._pos < len(self._buf):
+            return None
+        if not self._in_payload:
+            length = _LENGTH.unpack_from(self._buf)[0]
+            if length == 0 or length > MAX_FRAME:
+                raise ValueError('Invalid frame length %d' % length)
+            self._buf = bytearray(length)
+            self._view = memoryview(self._buf)
+            self._pos = 0
+            self._in_payload = True
+            return None
+        try:
+            return self._decode()
+        finally:
+            self._reset()
+
+    def _inflate(self):
+        'Decompress the compressed part of the payload received so far.'
+        if self._inflater is None:
+            if _is_legacy(self._buf):
+                start = 0
+            elif self._pos < _HEADER.size:
+                return
+            elif self._buf[2] & _FLAG_ZLIB:
+                start = _HEADER.size
+            else:
+                # nothing to decompress
+                return
+            self._inflater = zlib.decompressobj()
+            self._fed = start
+        if self._pos > self._fed:
+            self._chunks.append(self._inflater.decompress(
+                buffer(self._buf, self._fed, self._pos - self._fed)))
+            self._fed = self._pos
+
+    def _decode(self):
+        'Return the message of the received payload.'
+        if self._inflater is not None:
+            self._chunks.append(self._inflater.flush())
+            data = ''.join(self._chunks)
+            if _is_legacy(self._buf):
+                return _decode_legacy(data)
+            msg = _decode_header(self._buf)[0]
+            return _decode_body(msg, data)
+        msg = _decode_header(self._buf)[0]
+        return _decode_body(msg, str(self._buf[_HEADER.size:]))
+
+
+def check_hm_message(msg, peer):
+    '''Validate a message received from peer. Invalid messages are turned
+    into INVALID ones. Return the ACK or NACK message to send back when the
+    message needs one, else None.'''
+    if msg.is_valid() is False:
+        logger.error("Message %d is not part of the valid message_list" %
+                     msg.message)
+        reply = None
+        if (msg.need_ack is True) and (msg.message != HM.DISCONNECT):
+            reply = HM(HM.NACK)
+        msg.message = HM.INVALID
+        return reply
+    logger.debug("Received %s/%s/%s from %s (need_ack=%r)" %
+                 (msg.get_message_type(), msg.get_module_type(),
+                  msg.get_action_type(), peer, msg.need_ack))
+    if (msg.need_ack is True) and (msg.message != HM.DISCONNECT):
+        reply = HM(HM.ACK)
+        reply.module = msg.module
+        reply.action = msg.action
+        # lets the peer measure the clock offset
+        reply.timestamp = time.time()
+        return reply
+    return None
+
+
+def measure_clock(sent, ack, received):
+    '''Return the offset of the peer clock from the ACK of a message sent
+    and received at the local times sent and received, and the round trip
+    of the measure. Return (0, 0) without a stamped ACK.'''
+    if ack is None or not ack.timestamp:
+        return 0, 0
+    return ack.timestamp - (sent + received) / 2.0, received - sent
+
+
+def measure_peer_clock(sock, count=3):
+    '''Measure the clock of the peer with count small NONE messages,
+    so the transfer of a big message doesn't add to the round trip. Return
+    the (offset, round trip) of measure_clock with the shortest round trip.
+    Must be called before other messages are expected from the peer as
+    send_hm_message drops them.'''
+    best = None
+    for _ in range(count):
+        sent = time.time()
+        ack = send_hm_message(sock, HM(HM.NONE), True)
+        measure = measure_clock(sent, ack, time.time())
+        if best is None or measure[1] < best[1]:
+            best = measure
+    return best
+
+
+def wait_start(msg):
+    '''Wait until the start_at time of the server in msg, converted to the
+    local clock with its clock_offset. Return the delay waited, negative
+    when late.'''
+    if not msg.start_at:
+        return 0
+    delay = msg.start_at - msg.clock_offset - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    return delay
+
+
 def send_hm_message(sock, data, need_ack=False):
+    '''Send a message. When need_ack is True, wait for the answer of
+    the peer and return it.'''
     global logger
     data.need_ack = need_ack
     logger.debug("Sent %s/%s/%s to %s (need_ack=%r)" %
                  (data.get_message_type(), data.get_module_type(),
                   data.get_action_type(), sock.getpeername(),
                   data.need_ack))
-    to_be_sent = zlib.compress(pickle.dumps(data))
-    sock.sendall(struct.pack('!I', len(to_be_sent)))
-    sock.sendall(to_be_sent)
+    version = _peer_versions.get(sock.getpeername(), HM.protocol_version)
+    sock.sendall(encode_hm_message(data, version))
+    msg = None
     if data.need_ack is True:
         msg = HM()
         while True:
@@ -59,6 +459,7 @@ def send_hm_message(sock, data, need_ack=False):
                 msg = recv_hm_message(sock)
             except:
                 logger.error("Broken socket, exiting")
+                msg = None
                 break
 
             if msg.message == HM.ACK:
@@ -68,50 +469,44 @@ def send_hm_message(sock, data, need_ack=False):
                 logger.error("Received NACK from %s on message %s" %
                              (sock.getpeername(), (data.get_message_type())))
                 break
+            if msg.message == HM.DISCONNECTED:
+                logger.error("Disconnected while waiting for ACK")
+                break
+    return msg
 
 
 def recv_hm_message(sock):
     global logger
+    reader = FrameReader()
+    msg = None
     try:
-        lengthbuf = recvall(sock, 4)
+        while msg is None:
+            msg = reader.recv(sock)
     except socket.error, e:
         if e[0] in [errno.ECONNRESET, errno.EBADF, errno.ESHUTDOWN, errno.ENOTCONN, errno.EHOSTUNREACH, errno.ECONNREFUSED]:
             return HM(HM.DISCONNECTED)
         logger.error("recv_hm_message :" + e[1])
         return HM(HM.INVALID)
+    except EOFError:
+        if reader.started():
+            logger.error("Received incomplete message")
+        return HM(HM.DISCONNECTED)
 
-    try:
-        length = struct.unpack('!I', lengthbuf)
-    except:
-        logger.error("Received incomplete message")
-        return HM(HM.INVALID)
-
-    msg = pickle.loads(zlib.decompress(recvall(sock, int(length[0]))))
-    if msg.is_valid() is False:
-        logger.error("Message %d is not part of the valid message_list" %
-                     msg.message)
-        if (msg.need_ack is True) and (msg.message != HM.DISCONNECT):
-            send_hm_message(sock, HM(HM.NACK), False)
-        msg.message = HM.INVALID
-    else:
-        logger.debug("Received %s/%s/%s from %s (need_ack=%r)" %
-                     (msg.get_message_type(), msg.get_module_type(),
-                      msg.get_action_type(), sock.getpeername(),
-                      msg.need_ack))
-        if (msg.need_ack is True) and (msg.message != HM.DISCONNECT):
-            message = HM(HM.ACK)
-            message.module = msg.module
-            message.action = msg.action
-            send_hm_message(sock, message, False)
+    # answer in the protocol version of the peer
+    _peer_versions[sock.getpeername()] = msg.protocol_version
+    reply = check_hm_message(msg, sock.getpeername())
+    if reply is not None:
+        send_hm_message(sock, reply, False)
     return msg
 
 
 def recvall(sock, count):
-    buf = b''
-    while count:
-        newbuf = sock.recv(count)
-        if not newbuf:
+    buf = bytearray(count)
+    view = memoryview(buf)
+    pos = 0
+    while pos < count:
+        nbytes = sock.recv_into(view[pos:])
+        if not nbytes:
             return None
-        buf += newbuf
-        count -= len(newbuf)
+        pos += nbytes
     return buf
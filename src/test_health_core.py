@@ -0,0 +1,256 @@
+#
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import socket
+import struct
+import threading
+import time
+import unittest
+
+from health_messages import Health_Message as HM
+import health_core
+import health_protocol as HP
+
+HP.logger = logging.getLogger('test_health_core')
+HP.logger.addHandler(logging.NullHandler())
+
+
+class LogRecorder(logging.Handler):
+    'Keep the messages of the records.'
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+HW = [('system', 'product', 'serial', 'S1')]
+
+
+def wait_for(func, timeout=5):
+    'Wait until func returns a true value.'
+    end = time.time() + timeout
+    while not func() and time.time() < end:
+        time.sleep(0.01)
+    return func()
+
+
+class TestEventServer(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = health_core.HostRegistry()
+        self.received = []
+        self.server = health_core.EventServer(
+            ('127.0.0.1', 0), self.registry, self.handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.clients = []
+
+    def tearDown(self):
+        for sock in self.clients:
+            sock.close()
+        self.server.shutdown()
+        self.thread.join(5)
+
+    def handler(self, host, msg):
+        self.registry.update(host, msg)
+        self.received.append((host, msg))
+
+    def connect(self):
+        sock = socket.create_connection(self.server.address)
+        sock.settimeout(5)
+        self.clients.append(sock)
+        msg = HM(HM.CONNECT)
+        msg.hw = HW
+        self.ack = HP.send_hm_message(sock, msg, True)
+        return sock
+
+    def test_connect(self):
+        self.connect()
+        self.connect()
+        self.assertEqual(self.registry.count(), 2)
+        host = self.registry.addresses()[0]
+        self.assertEqual(self.registry.hw(host), HW)
+        self.assertEqual(len(self.received), 2)
+        self.assertEqual(self.received[0][1].message, HM.CONNECT)
+
+    def test_clock(self):
+        sent = time.time()
+        self.connect()
+        self.assertEqual(self.ack.message, HM.ACK)
+        # the ACK is stamped with the server time
+        self.assertTrue(sent <= self.ack.timestamp <= time.time())
+        host = self.registry.addresses()[0]
+        self.assertEqual(self.registry.version(host), HM.protocol_version)
+
+    def test_measure_peer_clock(self):
+        sock = socket.create_connection(self.server.address)
+        sock.settimeout(5)
+        self.clients.append(sock)
+        sent = time.time()
+        offset, rtt = HP.measure_peer_clock(sock)
+        self.assertTrue(0 < rtt <= time.time() - sent)
+        self.assertTrue(abs(offset) <= rtt)
+        # the NONE messages don't register the host
+        self.assertEqual(self.registry.count(), 0)
+        self.assertEqual(self.received, [])
+
+    def test_schedule_start(self):
+        sock = self.connect()
+        host = self.registry.addresses()[0]
+        msg = HM(HM.MODULE, HM.CPU, HM.START)
+        start = time.time() + 2
+        self.assertEqual(self.registry.schedule_start(host, msg, start),
+                         start)
+        self.assertEqual(HP.recv_hm_message(sock).start_at, start)
+
+    def test_schedule_start_legacy(self):
+        sock = socket.create_connection(self.server.address)
+        sock.settimeout(5)
+        self.clients.append(sock)
+        msg = HM(HM.CONNECT)
+        msg.need_ack = True
+        sock.sendall(HP.encode_hm_message(msg, HP.LEGACY_VERSION))
+        self.assertTrue(wait_for(self.registry.count))
+        host = self.registry.addresses()[0]
+        self.assertTrue(self.registry.version(host) <
+                        health_core.SCHEDULED_START_VERSION)
+        msg = HM(HM.MODULE, HM.CPU, HM.START)
+        before = time.time()
+        # an old client starts at once
+        started = self.registry.schedule_start(host, msg, before + 2)
+        self.assertTrue(before <= started <= time.time())
+        self.assertEqual(msg.start_at, 0)
+
+    def test_send(self):
+        sock = self.connect()
+        host = self.registry.addresses()[0]
+        msg = HM(HM.MODULE, HM.CPU, HM.START)
+        self.registry.send(host, msg)
+        msg.action = HM.STOP
+        reply = HP.recv_hm_message(sock)
+        self.assertEqual((reply.message, reply.module, reply.action),
+                         (HM.MODULE, HM.CPU, HM.START))
+
+    def test_running(self):
+        self.connect()
+        host = self.registry.addresses()[0]
+        self.registry.set_running(host, 1)
+        self.registry.set_running(host, 2)
+        self.assertEqual(self.registry.running(3), [host])
+        self.registry.clear_running(host, 1)
+        self.assertEqual(self.registry.running(3), [])
+        self.assertEqual(self.registry.running(2), [host])
+
+    def test_legacy_client(self):
+        sock = socket.create_connection(self.server.address)
+        sock.settimeout(5)
+        self.clients.append(sock)
+        msg = HM(HM.CONNECT)
+        msg.need_ack = True
+        sock.sendall(HP.encode_hm_message(msg, HP.LEGACY_VERSION))
+        self.assertTrue(wait_for(self.registry.count))
+        self.registry.send(self.registry.addresses()[0], HM(HM.DISCONNECT))
+        # the ACK and the DISCONNECT are pickled for an old client
+        for message in (HM.ACK, HM.DISCONNECT):
+            length = struct.unpack('!I', HP.recvall(sock, 4))[0]
+            payload = HP.recvall(sock, length)
+            self.assertEqual(payload[0], ord('x'))
+            self.assertEqual(HP.decode_hm_message(str(payload)).message,
+                             message)
+
+    def test_hw_delta(self):
+        sock = self.connect()
+        host = self.registry.addresses()[0]
+        result = [('cpu', 'logical', 'loops_per_sec', '1000')]
+        msg = HM(HM.MODULE, HM.CPU, HM.COMPLETED)
+        msg.hw = result
+        msg.hw_delta = True
+        HP.send_hm_message(sock, msg, True)
+        self.assertEqual(self.received[1][1].hw, HW + result)
+        self.assertFalse(self.received[1][1].hw_delta)
+        # a full result from an old client is kept as is
+        msg.hw = HW + result
+        msg.hw_delta = False
+        HP.send_hm_message(sock, msg, True)
+        self.assertEqual(self.received[2][1].hw, HW + result)
+        self.assertEqual(self.registry.hw(host), HW)
+
+    def test_big_result(self):
+        sock = self.connect()
+        msg = HM(HM.MODULE, HM.STORAGE, HM.COMPLETED)
+        msg.hw = [('disk', 'sd%d' % idx, 'smart_%d' % (idx * 7919), str(idx))
+                  for idx in range(20000)]
+        # the result is processed even if the client closes at once
+        sock.sendall(HP.encode_hm_message(msg))
+        sock.close()
+        self.assertTrue(wait_for(lambda: len(self.received) == 2))
+        self.assertEqual(self.received[1][1].hw, msg.hw)
+
+    def test_disconnect(self):
+        sock = self.connect()
+        HP.send_hm_message(sock, HM(HM.DISCONNECT))
+        self.assertTrue(wait_for(lambda: self.registry.count() == 0))
+
+    def test_close(self):
+        sock = self.connect()
+        sock.close()
+        self.assertTrue(wait_for(lambda: self.registry.count() == 0))
+
+
+class TestStartedAt(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = LogRecorder()
+        HP.logger.addHandler(self.recorder)
+        self.msg = HM(HM.MODULE, HM.CPU, HM.STARTING)
+        self.msg.start_at = 2000.0
+        self.msg.timestamp = 1500.0
+        self.msg.clock_offset = 500.0
+        self.msg.clock_rtt = 0.002
+
+    def tearDown(self):
+        HP.logger.removeHandler(self.recorder)
+
+    def test_on_time(self):
+        self.msg.timestamp += health_core.MAX_CLOCK_ERROR / 2
+        self.assertEqual(health_core.started_at('host', self.msg),
+                         2000.0 + health_core.MAX_CLOCK_ERROR / 2)
+        self.assertEqual(self.recorder.messages, [])
+
+    def test_late(self):
+        self.msg.timestamp += health_core.MAX_CLOCK_ERROR * 2
+        health_core.started_at('host', self.msg)
+        self.assertEqual(self.recorder.messages,
+                         ['host started 0.020 seconds after the expected '
+                          'time'])
+
+    def test_inaccurate_clock(self):
+        self.msg.clock_rtt = health_core.MAX_CLOCK_ERROR * 4
+        health_core.started_at('host', self.msg)
+        self.assertEqual(self.recorder.messages,
+                         ['Clock offset of host only known within 0.020 '
+                          'seconds'])
+
+    def test_old_client(self):
+        msg = HM(HM.MODULE, HM.CPU, HM.STARTING)
+        before = time.time()
+        self.assertTrue(before <= health_core.started_at('host', msg) <=
+                        time.time())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,239 @@
+#
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import socket
+import struct
+import time
+import unittest
+
+from health_messages import Health_Message as HM
+import health_protocol as HP
+
+HW = [('disk', 'sda%d' % idx, key, str(idx))
+      for idx in range(100) for key in ('size', 'vendor', 'model')]
+
+
+def round_trip(msg, version=HM.protocol_version):
+    'Encode and decode a message.'
+    data = HP.encode_hm_message(msg, version)
+    length = struct.unpack('!I', data[:4])[0]
+    assert length == len(data) - 4
+    return HP.decode_hm_message(data[4:])
+
+
+class ChunkedSocket(object):
+    'Socket returning the data in chunks of size bytes.'
+
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+
+    def recv_into(self, view):
+        chunk = self.data[:min(self.size, len(view))]
+        self.data = self.data[len(chunk):]
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def read_frames(data, size):
+    'Return the messages read from data received in chunks of size bytes.'
+    sock = ChunkedSocket(data, size)
+    reader = HP.FrameReader()
+    messages = []
+    while sock.data:
+        msg = reader.recv(sock)
+        if msg is not None:
+            messages.append(msg)
+    assert not reader.started()
+    return messages
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_small(self):
+        msg = HM(HM.ACK, HM.CPU, HM.COMPLETED)
+        data = HP.encode_hm_message(msg)
+        # header only
+        self.assertEqual(len(data), 13)
+        msg = HP.decode_hm_message(data[4:])
+        self.assertEqual((msg.message, msg.module, msg.action),
+                         (HM.ACK, HM.CPU, HM.COMPLETED))
+        self.assertEqual(msg.protocol_version, HM.protocol_version)
+        self.assertFalse(msg.need_ack)
+        self.assertEqual(msg.hw, [])
+
+    def test_hw(self):
+        msg = HM(HM.CONNECT)
+        msg.hw = HW
+        msg.need_ack = True
+        data = HP.encode_hm_message(msg)
+        self.assertTrue(ord(data[6]) & HP._FLAG_ZLIB)
+        self.assertTrue(len(data) < len(HP.encode_hm_message(
+            msg, HP.LEGACY_VERSION)))
+        msg = HP.decode_hm_message(data[4:])
+        self.assertEqual(msg.hw, HW)
+        self.assertTrue(msg.need_ack)
+
+    def test_values(self):
+        msg = HM(HM.MODULE, HM.NETWORK, HM.START)
+        msg.ports_list = {('10.0.0.1', 4242): 10000}
+        msg.peer_servers = [(('10.0.0.1', 4242), '10.0.0.1')]
+        msg.running_time = 1 << 70
+        msg.rampup_time = -3
+        msg.block_size = u'4k\xe9'
+        msg.hw = [('cpu', 'logical', 'number', 2.5), None, True, False]
+        decoded = round_trip(msg)
+        for attr in ('ports_list', 'peer_servers', 'running_time',
+                     'rampup_time', 'block_size', 'hw'):
+            self.assertEqual(getattr(decoded, attr), getattr(msg, attr))
+        self.assertEqual(decoded.mode, HM.FORKED)
+
+    def test_legacy(self):
+        msg = HM(HM.CONNECT)
+        msg.hw = HW
+        decoded = round_trip(msg, HP.LEGACY_VERSION)
+        self.assertEqual(decoded.hw, HW)
+        self.assertEqual(decoded.protocol_version, HP.LEGACY_VERSION)
+        HP.ACCEPT_LEGACY = False
+        try:
+            self.assertRaises(ValueError, round_trip, msg, HP.LEGACY_VERSION)
+        finally:
+            HP.ACCEPT_LEGACY = True
+
+    def test_invalid(self):
+        msg = HM(HM.CONNECT)
+        msg.hw = [('system', 'product', 'name', 'test')]
+        payload = HP.encode_hm_message(msg)[4:]
+        self.assertRaises(ValueError, HP.decode_hm_message, payload[:-1])
+        self.assertRaises(ValueError, HP.decode_hm_message, payload + 'N')
+        self.assertRaises(ValueError, HP.decode_hm_message, payload[:5])
+        # reference to a string not yet seen
+        self.assertRaises(ValueError, HP.decode_hm_message,
+                          payload[:HP._HEADER.size] + 'm\x01r\x00N')
+        msg.hw = [object()]
+        self.assertRaises(TypeError, HP.encode_hm_message, msg)
+
+    def test_body_fields(self):
+        for field in HP._BODY_FIELDS:
+            self.assertTrue(hasattr(HM, field), field)
+        encoder = HP._Encoder()
+        encoder.encode({'running_time': 10, 'get_message_type': 'x',
+                        'unknown': 1, '__class__': None})
+        decoded = HP.decode_hm_message(
+            HP._HEADER.pack(HP._MAGIC, HM.protocol_version, 0, HM.MODULE,
+                            HM.CPU, HM.START) + ''.join(encoder.out))
+        self.assertEqual(decoded.running_time, 10)
+        self.assertEqual(decoded.get_message_type(), 'MODULE')
+        self.assertFalse(hasattr(decoded, 'unknown'))
+        self.assertEqual(decoded.__class__, HM)
+
+
+class TestFrameReader(unittest.TestCase):
+
+    def setUp(self):
+        self.connect = HM(HM.CONNECT)
+        self.connect.hw = HW
+        self.ack = HM(HM.ACK)
+        self.start = HM(HM.MODULE, HM.CPU, HM.START)
+        self.start.running_time = 10
+
+    def test_chunks(self):
+        data = ''.join(HP.encode_hm_message(msg)
+                       for msg in (self.connect, self.ack, self.start))
+        for size in (1, 7, 4096):
+            messages = read_frames(data, size)
+            self.assertEqual([msg.message for msg in messages],
+                             [HM.CONNECT, HM.ACK, HM.MODULE])
+            self.assertEqual(messages[0].hw, HW)
+            self.assertEqual(messages[2].running_time, 10)
+
+    def test_legacy(self):
+        data = HP.encode_hm_message(self.connect, HP.LEGACY_VERSION) + \
+            HP.encode_hm_message(self.ack, HP.LEGACY_VERSION)
+        messages = read_frames(data, 100)
+        self.assertEqual(messages[0].hw, HW)
+        self.assertEqual(messages[1].protocol_version, HP.LEGACY_VERSION)
+
+    def test_invalid_length(self):
+        for length in (0, HP.MAX_FRAME + 1):
+            self.assertRaises(ValueError, HP.FrameReader().recv,
+                              ChunkedSocket(struct.pack('!I', length), 4))
+
+    def test_eof(self):
+        server, client = socket.socketpair()
+        client.sendall(HP.encode_hm_message(self.connect)[:100])
+        client.close()
+        self.assertEqual(HP.recv_hm_message(server).message,
+                         HM.DISCONNECTED)
+        server.close()
+
+    def test_recvall(self):
+        self.assertEqual(HP.recvall(ChunkedSocket('abcdef', 2), 5),
+                         bytearray('abcde'))
+        self.assertEqual(HP.recvall(ChunkedSocket('abc', 2), 5), None)
+
+
+class FakeTime(object):
+    'Clock for the time module functions used by health_protocol.'
+
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+class TestClock(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime(1000.0)
+        HP.time = self.clock
+
+    def tearDown(self):
+        HP.time = time
+
+    def test_measure_clock(self):
+        ack = HM(HM.ACK)
+        ack.timestamp = 2000.5
+        # the server stamped the ACK in the middle of the round trip
+        self.assertEqual(HP.measure_clock(1000.0, ack, 1001.0), (1000, 1))
+        self.assertEqual(HP.measure_clock(1000.0, None, 1001.0), (0, 0))
+        # ACK of a server which does not stamp its messages
+        self.assertEqual(HP.measure_clock(1000.0, HM(HM.ACK), 1001.0),
+                         (0, 0))
+
+    def test_wait_start(self):
+        msg = HM(HM.MODULE, HM.CPU, HM.START)
+        self.assertEqual(HP.wait_start(msg), 0)
+        self.assertEqual(self.clock.sleeps, [])
+        # the server clock is 500 seconds ahead
+        msg.start_at = 1502.5
+        msg.clock_offset = 500
+        self.assertEqual(HP.wait_start(msg), 2.5)
+        self.assertEqual(self.clock.sleeps, [2.5])
+        self.assertEqual(self.clock.now, msg.start_at - msg.clock_offset)
+        # too late to wait
+        self.assertEqual(HP.wait_start(msg), 0)
+        msg.start_at = 1499
+        self.assertEqual(HP.wait_start(msg), -3.5)
+        self.assertEqual(self.clock.sleeps, [2.5])
+
+if __name__ == "__main__":
+    unittest.main()